@@ -1,22 +1,16 @@
 import os
-import time
 import uuid
 
 import streamlit as st
-from bson import ObjectId
-from db import get_collections
-from rec_core import (
-    build_match,
-    combined_text,
-    fallback_parse_query_to_filters,
-    reasons,
-    score_item,
+from metrics import start_metrics_server, traced
+from rec_client import (
+    PARSE_FALLBACK,
+    PARSE_LIMIT,
+    PARSE_VERTEX,
+    ServiceError,
+    get_recommender,
 )
-from similar_vector import similar_items_by_vector
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from streamlit_scroll_to_top import scroll_to_here
-from vertex_guard import cached_ttl_parse
 
 st.set_page_config(
     page_title="Real Estate Recommendation Agent (Demo)",
@@ -50,6 +44,9 @@ st.set_page_config(
 # Rate limit Vertex calls
 MAX_CALLS_PER_SESSION = 10
 MAX_SIMILAR_CLICKS = 5
+PAGE_SIZE = 12
+# RAG needs Atlas Vector Search or a local vector index (off for the demo)
+RAG_ENABLED = os.getenv("RAG_ENABLED", "0") == "1"
 
 if "vertex_calls" not in st.session_state:
     st.session_state["vertex_calls"] = 0
@@ -57,23 +54,9 @@ if "similar_clicks" not in st.session_state:
     st.session_state["similar_clicks"] = 0
 
 
-def parse_with_guard(q: str):
-    if not q.strip():
-        print("Empty query received for parsing.")
-        return {}
-    try:
-        if st.session_state["vertex_calls"] >= MAX_CALLS_PER_SESSION:
-            st.info("Vertex上限に到達: フォールバック解析を使用します。")
-            return fallback_parse_query_to_filters(q)
-        out = cached_ttl_parse(q, ttl_sec=600)
-        st.session_state["vertex_calls"] += 1
-        return out
-    except Exception as e:
-        st.warning(f"Vertex利用不可: フォールバック解析 ({e})")
-        return fallback_parse_query_to_filters(q)
-
-
-PROPS, EVENTS = get_collections()
+# Retrieval, scoring and Mongo live behind REC (see rec_client.py)
+REC = get_recommender()
+start_metrics_server()
 if "user_id" not in st.session_state:
     st.session_state["user_id"] = str(uuid.uuid4())[:8]
 if "search_run" not in st.session_state:
@@ -141,38 +124,19 @@ with col2:
     search_btn = st.button("検索実行", use_container_width=True)
 
 
-def collect_filters():
+def sidebar_filters():
+    """Sidebar conditions alone, in the same keys the parsed filters use."""
     f = {}
-    # ✨ Rate-limited Vertex call here
-    if q.strip():
-        f.update(parse_with_guard(q))
-    st.info(f"自然言語の解析結果: {f}")
-    # sidebar overrides
     if wards:
-        f["wards"].extend(wards)
+        f["wards"] = list(wards)
     if budget_max_man and budget_max_man > 0:
-        side_budget_max = budget_max_man * 10_000
-        if "budget_max" in f:
-            f["budget_max"] = min(f["budget_max"], side_budget_max)
-        else:
-            f["budget_max"] = side_budget_max
+        f["budget_max"] = budget_max_man * 10_000
     if walk_max:
-        side_walk_max = walk_max
-        if "walk_max" in f:
-            f["walk_max"] = min(f["walk_max"], side_walk_max)
-        else:
-            f["walk_max"] = side_walk_max
+        f["walk_max"] = walk_max
     if min_rooms:
-        if "min_rooms" in f:
-            f["min_rooms"] = max(f["min_rooms"], min_rooms)
-        else:
-            f["min_rooms"] = min_rooms
-
+        f["min_rooms"] = min_rooms
     if min_area and min_area > 0:
-        if "min_area_sqm" in f:
-            f["min_area_sqm"] = max(f["min_area_sqm"], min_area)
-        else:
-            f["min_area_sqm"] = min_area
+        f["min_area_sqm"] = min_area
     if pet_ok:
         f["pet_ok"] = True
     if bal_ok:
@@ -186,114 +150,42 @@ def collect_filters():
     return f
 
 
-def log_event(item_id: str, action: str):
-    EVENTS.insert_one(
-        {
-            "user_id": st.session_state["user_id"],
-            "item_id": str(item_id),
-            "action": action,
-            "ts": time.time(),
-        }
+@traced("ui_search")
+def collect_filters_and_recommend():
+    res = REC.search(
+        q,
+        sidebar_filters(),
+        k=PAGE_SIZE,
+        allow_vertex=st.session_state["vertex_calls"] < MAX_CALLS_PER_SESSION,
+        warm_embedding=RAG_ENABLED,
     )
+    if res["parse_source"] == PARSE_VERTEX:
+        st.session_state["vertex_calls"] += 1
+    elif res["parse_source"] == PARSE_LIMIT:
+        st.info("Vertex上限に到達: フォールバック解析を使用します。")
+    elif res["parse_source"] == PARSE_FALLBACK:
+        st.warning(f"Vertex利用不可: フォールバック解析 ({res['parse_error']})")
+    st.info(f"自然言語の解析結果: {res['parsed']}")
+    return res
 
 
-def recommend(filters):
-    match = build_match(filters)
-    cursor = PROPS.find(
-        match,
-        # Get only necessary fields if needed
-        # {
-        #     "name": 1,
-        #     "address": 1,
-        #     "image": 1,
-        #     "url": 1,
-        #     "price_yen": 1,
-        #     "area_sqm": 1,
-        #     "rooms": 1,
-        #     "ldk": 1,
-        #     "layout_raw": 1,
-        #     "size": 1,
-        #     "station_name": 1,
-        #     "station_walk_minutes": 1,
-        #     "flags": 1,
-        #     "description": 1,
-        # },
-    ).limit(1000)
-
-    seen_names = set()
-    unique_items = []
-    for item in list(cursor):
-        name = item.get("name")
-        if name not in seen_names:
-            unique_items.append(item)
-            if name:
-                seen_names.add(name)
-
-    items = unique_items
-    for it in items:
-        it["_score"] = score_item(it, filters)
-        it["_reasons"] = reasons(it, filters)
-    items.sort(key=lambda x: x["_score"], reverse=True)
-    return items[:12]
-
-
-def ui_similar(seed_id: str, filters: dict):
-    # 1) try vector search
-    vec = similar_items_by_vector(PROPS, seed_id, filters)
-    if vec:
-        return vec
-    # 2) fallback to your existing TF-IDF
-    return similar_items(seed_id, filters)
-
-
-def similar_items(seed_id: str, filters):
-    seed = PROPS.find_one(
-        {"_id": ObjectId(seed_id)},
-        {
-            "name": 1,
-            "description": 1,
-            "address": 1,
-            "flags": 1,
-            "station_line": 1,
-            "station_name": 1,
-        },
-    )
-    if not seed:
-        return []
-    match = build_match(filters)
-    cands = list(
-        PROPS.find(
-            match,
-            {
-                "_id": 1,
-                "name": 1,
-                "image": 1,
-                "url": 1,
-                "description": 1,
-                "address": 1,
-                "flags": 1,
-                "price_yen": 1,
-                "area_sqm": 1,
-                "rooms": 1,
-                "layout_raw": 1,
-                "size": 1,
-                "station_name": 1,
-                "station_walk_minutes": 1,
-                "station_line": 1,
-            },
-        ).limit(400)
-    )
-    texts = [combined_text(seed)] + [combined_text(c) for c in cands]
-    tf = TfidfVectorizer(min_df=2).fit_transform(texts)
-    sims = cosine_similarity(tf[0:1], tf[1:]).ravel()
-    paired = list(zip(cands, sims))
-    paired.sort(key=lambda x: x[1], reverse=True)
-    top = [p[0] for p in paired[:9]]
-    for it in top:
-        it["_reasons"] = ["似ている説明/設備/駅情報（類似検索）"]
-    return top
+def log_event(item_id: str, action: str):
+    REC.log_event(st.session_state["user_id"], item_id, action)
+
+
+def show_page(offset: int):
+    """Another page of the last search, sliced from the cached ranking."""
+    try:
+        page = REC.results_page(st.session_state["last_filters"], offset, k=PAGE_SIZE)
+    except ServiceError as e:
+        st.error(f"検索サービスに接続できません: {e}")
+        return
+    st.session_state["recommended_items"] = page["items"]
+    st.session_state["result_total"] = page["total"]
+    st.session_state["result_offset"] = offset
 
 
+@traced("render_cards")
 def render_cards(items, key_prefix=""):
     if not items:
         st.info("該当する物件が見つかりませんでした。")
@@ -344,21 +236,45 @@ if run_btn or search_btn:
         st.session_state["search_run"] = False  # Don't show results if query is empty
     else:
         with st.spinner("物件を検索中..."):
-            filters = collect_filters()
-            st.session_state["last_filters"] = filters
-            recommended_items = recommend(filters)
-            st.session_state["recommended_items"] = recommended_items
+            try:
+                res = collect_filters_and_recommend()
+            except ServiceError as e:
+                st.error(f"検索サービスに接続できません: {e}")
+                st.stop()
+            st.session_state["last_filters"] = res["filters"]
+            st.session_state["recommended_items"] = res["items"]
+            st.session_state["result_total"] = res["total"]
+            st.session_state["result_offset"] = 0
+
 
 if st.session_state.get("search_run") and not st.session_state["show_similar"]:
     st.info(f"適用されたフィルター: {st.session_state.get('last_filters', {})}")
     st.subheader("おすすめ物件")
     render_cards(st.session_state.get("recommended_items", []), key_prefix="rec")
+    offset = st.session_state.get("result_offset", 0)
+    total = st.session_state.get("result_total", 0)
+    if total > PAGE_SIZE:
+        prev_col, info_col, next_col = st.columns([1, 2, 1])
+        with prev_col:
+            if st.button("前へ", disabled=offset == 0, use_container_width=True):
+                show_page(max(0, offset - PAGE_SIZE))
+                st.rerun()
+        with info_col:
+            st.caption(
+                f"{offset + 1}–{min(offset + PAGE_SIZE, total)}件目 / 全{total}件"
+            )
+        with next_col:
+            if st.button(
+                "次へ", disabled=offset + PAGE_SIZE >= total, use_container_width=True
+            ):
+                show_page(offset + PAGE_SIZE)
+                st.rerun()
 
     # --- RAG summary section ---
     st.markdown("---")
     st.subheader("AIによる要約と推奨（RAG）")
     if st.button("AIの要約を見る", use_container_width=True):
-        if True:
+        if not RAG_ENABLED:
             st.info(
                 "Currently disabled for demo purposes as MongoDB Atlas free tier has limitations."
             )
@@ -366,30 +282,36 @@ if st.session_state.get("search_run") and not st.session_state["show_similar"]:
         if not q.strip():
             st.warning("検索クエリを入力してください。")
             st.stop()
-        from rag_generate import generate_summary
-        from rag_retrieval import retrieve_semantic
+        from rag_generate import generate_summary_stream
 
         with st.spinner("AIが候補を要約中..."):
-            # Retrieve (semantic) using the user's query text + filters
+            # Semantic retrieval on the query text + filters, re-ranked with
+            # the business score
             filters = st.session_state["last_filters"]
-            sem_items = retrieve_semantic(PROPS, q, filters, k=300, limit=20)
-            print(f"RAG retrieved {len(sem_items)} items.")
-            # Optionally re-rank with your business score
-            for it in sem_items:
-                it["_score"] = 0.55 * it.get("vector_score", 0) + 0.45 * score_item(
-                    it, filters
-                )
-                it["_reasons"] = reasons(it, filters)
-            sem_items.sort(key=lambda x: x["_score"], reverse=True)
+            sem_items = REC.rag_candidates(q, filters, limit=20)
             st.markdown("**AIが抽出した候補（上位）**")
             render_cards(sem_items[:9], key_prefix="rag")
 
-            # Generate summary (true RAG)
+            # Generate summary (true RAG), streamed: each recommendation is
+            # shown as soon as Gemini has finished writing it
+            st.markdown("**AIのおすすめ**")
+            stream = generate_summary_stream(q or "ユーザー条件未入力", sem_items[:12])
+            shown = 0
             try:
-                summary_json = generate_summary(
-                    q or "ユーザー条件未入力", sem_items[:12]
-                )
-                st.code(summary_json, language="json")
+                for rec in stream:
+                    shown += 1
+                    st.markdown(f"**{shown}. {rec.get('name', '')}**")
+                    st.caption(rec.get("reason", ""))
+                    if rec.get("url"):
+                        st.link_button("詳細を見る", rec["url"])
+                if not shown:
+                    st.info(stream.text or "合致候補なし")
+                if stream.cached:
+                    st.caption(
+                        "同じ条件・同じ候補の回答をキャッシュから表示しています。"
+                    )
+                with st.expander("生成されたJSON"):
+                    st.code(stream.text, language="json")
             except Exception as e:
                 st.warning(f"要約生成に失敗しました: {e}")
 
@@ -398,7 +320,11 @@ if st.session_state.get("show_similar") and (sid := st.session_state.get("simila
     st.subheader("似た物件")
     with st.spinner("似た物件を探しています..."):
         filters = st.session_state.get("last_filters", {})
-        similar_items_list = ui_similar(sid, filters)
+        try:
+            similar_items_list = REC.similar(sid, filters)
+        except ServiceError as e:
+            st.error(f"検索サービスに接続できません: {e}")
+            similar_items_list = []
         render_cards(similar_items_list, key_prefix="sim")
 
     if st.button("検索結果に戻る", use_container_width=True):
@@ -0,0 +1,386 @@
+# checks.py
+# Behaviour checks for code paths that need no MongoDB or cloud credentials.
+#
+#   uv run bench/checks.py            # all checks
+#   uv run bench/checks.py --only nlu
+#
+# Prints one line per check and exits 1 when any of them fails.
+import argparse
+import io
+import os
+import socket
+import sys
+import tempfile
+import threading
+import traceback
+from typing import Callable, Dict
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AGENT_DIR)
+
+CHECKS: Dict[str, Callable[[], None]] = {}
+
+
+def check(group: str):
+    def register(fn):
+        CHECKS[f"{group}.{fn.__name__}"] = fn
+        return fn
+
+    return register
+
+
+# ---------- modules copied into both images ----------
+SHARED_MARK = "# Kept identical to "
+
+
+@check("shared")
+def copies_are_identical():
+    """Each "Kept identical to" module matches its copy in the other image."""
+    repo = os.path.dirname(AGENT_DIR)
+
+    def body(path: str) -> list:
+        with open(path, encoding="utf-8") as f:
+            return [ln for ln in f if not ln.startswith(SHARED_MARK)]
+
+    pairs = 0
+    for image, other in (("agent", "embed"), ("embed", "agent")):
+        for name in sorted(os.listdir(os.path.join(repo, image))):
+            path = os.path.join(repo, image, name)
+            if not name.endswith(".py"):
+                continue
+            with open(path, encoding="utf-8") as f:
+                if SHARED_MARK + f"{other}/{name}" not in f.read():
+                    continue
+            copy = os.path.join(repo, other, name)
+            assert os.path.exists(copy), f"{image}/{name}: {other}/{name} is missing"
+            assert body(path) == body(copy), f"{image}/{name} != {other}/{name}"
+            pairs += 1
+    assert pairs, "no shared modules found"
+
+
+# ---------- local query parser ----------
+# query -> (expected filters, fully explained locally?)
+LOCAL_PARSE_CASES = [
+    ("6000万円以下", {"budget_max": 60_000_000}, True),
+    ("6,000万円", {"budget_max": 60_000_000}, True),
+    ("６，０００万円", {"budget_max": 60_000_000}, True),
+    ("1億2,000万円", {"budget_max": 120_000_000}, True),
+    (
+        "品川区で6,000万円以下、徒歩10分以内、ペット可",
+        {
+            "budget_max": 60_000_000,
+            "walk_max": 10,
+            "pet_ok": True,
+            "wards": ["品川区"],
+        },
+        True,
+    ),
+    ("3LDK以上 60m2以上", {"min_rooms": 3, "min_area_sqm": 60}, True),
+    # a station does not imply its ward: 自由が丘 listings include 世田谷区奥沢
+    (
+        "自由が丘駅から徒歩10分の物件を教えてください",
+        {"walk_max": 10, "station_name": "自由が丘"},
+        True,
+    ),
+    ("大岡山 ペット可", {"station_name": "大岡山", "pet_ok": True}, True),
+    # opposite direction of the filter: left to Gemini
+    ("6000万円以上", {"budget_max": 60_000_000}, False),
+    ("徒歩10分以上", {"walk_max": 10}, False),
+    ("3LDK以下", {"min_rooms": 3}, False),
+    ("60m2以下", {"min_area_sqm": 60}, False),
+]
+
+
+@check("nlu")
+def local_parse_cases():
+    from local_nlu import local_parse
+
+    for q, want, complete in LOCAL_PARSE_CASES:
+        got, coverage = local_parse(q)
+        assert got == want, f"{q!r}: {got} != {want}"
+        assert (coverage >= 1.0) == complete, f"{q!r}: coverage {coverage:.2f}"
+
+
+@check("nlu")
+def fallback_strips_thousands_separators():
+    from rec_core import fallback_parse_query_to_filters
+
+    f = fallback_parse_query_to_filters("品川区で6,000万円以下、徒歩10分以内、ペット可")
+    assert f["budget_max"] == 60_000_000, f
+    assert f["wards"] == ["品川区"], f
+
+
+# ---------- shared parse cache ----------
+class FakeRedis:
+    """RESP2 server on localhost for AUTH/SELECT/MGET/SET; drop() cuts clients."""
+
+    def __init__(self, password: str):
+        self.password = password
+        self.data: Dict[str, str] = {}
+        self.log = []
+        self._conns = []
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            self._conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        from parse_cache import _read_reply
+
+        f = conn.makefile("rwb")
+        try:
+            while True:
+                cmd, *args = _read_reply(f)
+                self.log.append(cmd)
+                f.write(self._reply(cmd, args))
+                f.flush()
+        except (OSError, ValueError):
+            pass
+
+    def _reply(self, cmd: str, args) -> bytes:
+        if cmd == "AUTH":
+            return b"+OK\r\n" if args == [self.password] else b"-ERR invalid\r\n"
+        if cmd == "SELECT":
+            return b"+OK\r\n"
+        if cmd == "SET":
+            self.data[args[0]] = args[1]
+            return b"+OK\r\n"
+        if cmd == "MGET":
+            out = [b"*%d\r\n" % len(args)]
+            for k in args:
+                v = self.data.get(k)
+                if v is None:
+                    out.append(b"$-1\r\n")
+                else:
+                    b = v.encode("utf-8")
+                    out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+            return b"".join(out)
+        return b"-ERR unknown command\r\n"
+
+    def drop(self):
+        for conn in self._conns:
+            conn.shutdown(socket.SHUT_RDWR)
+        self._conns.clear()
+
+
+@check("parse_cache")
+def read_reply_types():
+    from parse_cache import _read_reply
+
+    def read(raw: bytes):
+        return _read_reply(io.BytesIO(raw))
+
+    assert read(b"+OK\r\n") == "OK"
+    assert read(b":42\r\n") == 42
+    assert read(b"$-1\r\n") is None
+    assert read(b"*-1\r\n") is None
+    assert read("$6\r\n品川\r\n".encode()) == "品川"
+    assert read(b"*2\r\n$1\r\na\r\n$-1\r\n") == ["a", None]
+    for raw, err in [(b"-ERR x\r\n", ValueError), (b"", ConnectionError)]:
+        try:
+            read(raw)
+        except err:
+            continue
+        raise AssertionError(f"{raw!r} did not raise {err.__name__}")
+
+
+@check("parse_cache")
+def redis_round_trip_and_reconnect():
+    from parse_cache import RedisParseCache
+
+    server = FakeRedis("pw")
+    cache = RedisParseCache(f"redis://:pw@127.0.0.1:{server.port}/2", timeout=2)
+    parsed = {"budget_max": 60_000_000, "wards": ["品川区"]}
+    cache.set_many({"nlu:v:a": parsed}, ttl=60)
+    assert cache.get_many(["nlu:v:a", "nlu:v:b"]) == [parsed, None]
+    assert server.log[:2] == ["AUTH", "SELECT"], server.log
+
+    server.drop()
+    try:
+        cache.get_many(["nlu:v:a"])
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError("a dropped connection was not reported")
+    # the next call reconnects and authenticates again
+    assert cache.get_many(["nlu:v:a"]) == [parsed]
+    assert server.log.count("AUTH") == 2, server.log
+
+    bad = RedisParseCache(f"redis://:wrong@127.0.0.1:{server.port}/0", timeout=2)
+    for _ in range(2):  # the unauthenticated socket is not reused
+        try:
+            bad.get_many(["nlu:v:a"])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a rejected AUTH was not reported")
+
+
+@check("parse_cache")
+def query_log_rotates():
+    from parse_cache import log_query, top_queries
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "queries.txt")
+        for i in range(2000):
+            log_query(f"品川区 {i % 3}LDK", path, max_mb=0.01)
+        assert os.path.getsize(path) <= 0.01 * 1024 * 1024
+        assert os.path.exists(path + ".1")
+        assert sorted(os.listdir(d)) == ["queries.txt", "queries.txt.1"]
+        assert len(top_queries(path)) == 3
+
+
+# ---------- SQLite caches: a hit is a read ----------
+@check("caches")
+def embed_cache_hits_do_not_write():
+    from embed_cache import EmbeddingCache, _text_hash
+
+    with tempfile.TemporaryDirectory() as d:
+        cache = EmbeddingCache(os.path.join(d, "embed.sqlite3"))
+        cache.put_many("m", "q", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+        conn = cache._conn()
+        before = conn.total_changes
+        assert cache.get_many("m", "q", ["a", "b", "c"]) == [[1, 2], [3, 4], None]
+        assert conn.total_changes == before, "a fresh hit wrote last_used"
+        # entries older than the touch interval still move up the LRU order
+        with conn:
+            conn.execute("UPDATE embeddings SET last_used = 0")
+        cache.get_many("m", "q", ["a"])
+        used = dict(conn.execute("SELECT text_hash, last_used FROM embeddings"))
+        assert used[_text_hash("a")] > 0 and used[_text_hash("b")] == 0, used
+
+
+@check("caches")
+def rag_cache_hits_do_not_write():
+    from rag_cache import RagAnswerCache
+
+    with tempfile.TemporaryDirectory() as d:
+        cache = RagAnswerCache(os.path.join(d, "rag.sqlite3"))
+        cache.put("k", "answer", [("id1", "h1")])
+        conn = cache._conn()
+        before = conn.total_changes
+        assert cache.get("k") == "answer"
+        assert conn.total_changes == before, "a fresh hit wrote last_used"
+        with conn:
+            conn.execute("UPDATE answers SET last_used = 0")
+        before = conn.total_changes
+        assert cache.get("k") == "answer"
+        assert conn.total_changes == before + 1, "an old hit was not touched"
+
+
+# ---------- cached result sets ----------
+@check("results")
+def rankings_shared_between_workers():
+    import recommender
+    from bson import ObjectId
+    from parse_cache import SQLiteParseCache
+    from ttl_cache import TTLCache
+
+    docs = [
+        {"_id": ObjectId(), "name": f"n{i}", "_score": 1 - i / 100} for i in range(30)
+    ]
+
+    class Props:
+        aggregations = 0
+
+        def aggregate(self, pipeline):
+            self.aggregations += 1
+            return [dict(d) for d in docs]
+
+        def find(self, query, projection=None):
+            wanted = set(query["_id"]["$in"])
+            return [dict(d) for d in docs if d["_id"] in wanted]
+
+    props, filters = Props(), {"budget_max": 60_000_000}
+    saved = recommender.get_shared_parse_cache, recommender.RESULT_CACHE
+    with tempfile.TemporaryDirectory() as d:
+        shared = SQLiteParseCache(os.path.join(d, "shared.sqlite3"))
+        recommender.get_shared_parse_cache = lambda: shared
+        try:
+            first = recommender.recommend(props, filters, k=12)
+            # another worker: empty in-process cache, same shared store
+            recommender.RESULT_CACHE = TTLCache(maxsize=8, ttl=60)
+            page = recommender.recommend(props, filters, k=12, offset=12)
+        finally:
+            recommender.get_shared_parse_cache, recommender.RESULT_CACHE = saved
+    assert props.aggregations == 1, props.aggregations
+    assert page["total"] == first["total"] == 30
+    assert [it["_id"] for it in page["items"]] == [d["_id"] for d in docs[12:24]]
+
+
+# ---------- HTTP service ----------
+def call_app(path: str, messages: list, method: str = "POST") -> list:
+    """Run service.app for one request; returns the messages it sent."""
+    import asyncio
+
+    from service import app
+
+    sent, pending = [], iter(messages)
+
+    async def receive():
+        return next(pending)
+
+    async def send(msg):
+        sent.append(msg)
+
+    asyncio.run(app({"type": "http", "method": method, "path": path}, receive, send))
+    return sent
+
+
+@check("service")
+def handler_connection_errors_are_500():
+    import service
+
+    def reset(body):
+        raise ConnectionResetError("connection reset by MongoDB")
+
+    service.ROUTES[("POST", "/_check_reset")] = reset
+    try:
+        sent = call_app("/_check_reset", [{"type": "http.request", "body": b"{}"}])
+        assert sent[0]["status"] == 500, sent
+        # a client that leaves before sending its body gets no response
+        assert call_app("/_check_reset", [{"type": "http.disconnect"}]) == []
+    finally:
+        del service.ROUTES[("POST", "/_check_reset")]
+
+
+@check("service")
+def metrics_route_serves_prometheus_text():
+    from metrics import REGISTRY
+
+    REGISTRY.inc("check.metrics_route")
+    sent = call_app("/metrics", [{"type": "http.request", "body": b""}], "GET")
+    assert sent[0]["status"] == 200, sent
+    assert dict(sent[0]["headers"])[b"content-type"].startswith(b"text/plain")
+    assert b"agent_check_metrics_route_total 1" in sent[1]["body"], sent[1]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline behaviour checks.")
+    ap.add_argument("--only", default="", help="comma-separated check prefixes")
+    args = ap.parse_args()
+
+    only = [p for p in args.only.split(",") if p]
+    failed = 0
+    for name, fn in CHECKS.items():
+        if only and not any(name.startswith(p) for p in only):
+            continue
+        try:
+            fn()
+        except Exception:
+            failed += 1
+            print(f"[check] FAIL {name}")
+            traceback.print_exc()
+        else:
+            print(f"[check] ok   {name}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# import_budget.py
+# Startup check: importing the agent modules must stay cheap and must not
+# pull in the cloud SDKs or sklearn (those load on first use, see clients.py).
+#
+#   uv run bench/import_budget.py --budget-ms 1500
+#
+# Runs the imports in a fresh interpreter, prints JSON and exits 1 when a
+# heavy module was imported or the total exceeded the budget.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "rec_core",
+    "local_nlu",
+    "metrics",
+    "clients",
+    "parse_cache",
+    "vertex_nlu",
+    "vertex_guard",
+    "rag_retrieval",
+    "rag_generate",
+    "search_pipeline",
+    "similar_vector",
+    "quantize",
+    "projection",
+    "tfidf_index",
+    "bm25_index",
+    "recommender",
+    "rec_client",
+]
+# must not be in sys.modules after importing MODULES
+HEAVY = ["vertexai", "google.genai", "google.cloud.aiplatform", "sklearn", "scipy"]
+
+_PROBE = """
+import json, sys, time
+mods, heavy = json.loads(sys.argv[1]), json.loads(sys.argv[2])
+out = {"modules": {}, "errors": {}}
+t0 = time.perf_counter()
+for m in mods:
+    t = time.perf_counter()
+    try:
+        __import__(m)
+    except Exception as e:
+        out["errors"][m] = f"{type(e).__name__}: {e}"
+    out["modules"][m] = round((time.perf_counter() - t) * 1000, 2)
+out["total_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+out["heavy_loaded"] = [h for h in heavy if h in sys.modules]
+print(json.dumps(out))
+"""
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Agent import-time budget check.")
+    ap.add_argument(
+        "--budget-ms",
+        type=float,
+        default=float(os.getenv("IMPORT_BUDGET_MS", "1500")),
+        help="max total import time of MODULES (env IMPORT_BUDGET_MS)",
+    )
+    args = ap.parse_args()
+
+    proc = subprocess.run(
+        [sys.executable, "-c", _PROBE, json.dumps(MODULES), json.dumps(HEAVY)],
+        cwd=AGENT_DIR,
+        env={**os.environ, "PYTHONPATH": AGENT_DIR},
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        sys.exit(1)
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+    report["budget_ms"] = args.budget_ms
+    report["ok"] = (
+        not report["heavy_loaded"]
+        and not report["errors"]
+        and report["total_ms"] <= args.budget_ms
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    if not report["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
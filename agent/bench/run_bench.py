@@ -0,0 +1,616 @@
+# run_bench.py
+# Benchmarks for the recommendation hot paths over synthetic listings.
+# Results are JSON so runs can be diffed between versions.
+#
+#   uv run bench/run_bench.py --sizes 10000,100000 --out bench.json
+#   uv run bench/run_bench.py --only score,tfidf --baseline bench.json
+#
+# With --baseline, cases whose p50 grew by more than --threshold are listed
+# and the exit code is 1.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBED_DIR = os.path.join(os.path.dirname(AGENT_DIR), "embed")
+sys.path.insert(0, AGENT_DIR)
+sys.path.append(EMBED_DIR)  # agent modules win on name clashes (embed_cache)
+
+import numpy as np  # noqa: E402
+from synthetic import TYPICAL_FILTERS, make_embeddings, make_listings  # noqa: E402
+
+Result = Dict[str, Any]
+CASES: Dict[str, Callable[[List[dict], argparse.Namespace], List[Result]]] = {}
+
+
+def case(group: str):
+    def register(fn):
+        CASES[f"{group}.{fn.__name__}"] = fn
+        return fn
+
+    return register
+
+
+def measure(name: str, n: int, fn: Callable[[], Any], repeat: int, items: int = 1):
+    """Run fn once to warm up, then `repeat` timed runs."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    p50 = statistics.median(times)
+    return {
+        "name": name,
+        "n": n,
+        "runs": repeat,
+        "items": items,
+        "mean_ms": statistics.fmean(times) * 1e3,
+        "p50_ms": p50 * 1e3,
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))] * 1e3,
+        "min_ms": times[0] * 1e3,
+        "per_item_us": p50 / max(items, 1) * 1e6,
+    }
+
+
+def skipped(name: str, n: int, e: BaseException) -> Result:
+    return {"name": name, "n": n, "skipped": f"{type(e).__name__}: {e}"}
+
+
+# ---------------------------------------------------------
+# Cases
+# ---------------------------------------------------------
+@case("filters")
+def build_match(docs, args):
+    from rec_core import build_match
+
+    calls = 1000
+
+    def run():
+        for _ in range(calls // len(TYPICAL_FILTERS)):
+            for f in TYPICAL_FILTERS:
+                build_match(f)
+
+    return [measure("filters.build_match", len(docs), run, args.repeat, calls)]
+
+
+@case("filters")
+def split_for_vectorsearch(docs, args):
+    name = "filters.split_for_vectorsearch"
+    try:
+        from rag_retrieval import _safe_build_match, _split_filters_for_vectorsearch
+    except Exception as e:  # missing optional dependency
+        return [skipped(name, len(docs), e)]
+    matches = [_safe_build_match(f) for f in TYPICAL_FILTERS]
+    calls = 1000
+
+    def run():
+        for _ in range(calls // len(matches)):
+            for m in matches:
+                _split_filters_for_vectorsearch(m)
+
+    return [measure(name, len(docs), run, args.repeat, calls)]
+
+
+@case("score")
+def score_candidates(docs, args):
+    """score_item + reasons over the 1000-row candidate set recommend() ranks."""
+    from rec_core import columns_from_docs, match_mask, reasons, score_batch, score_item
+
+    cols = columns_from_docs(docs)
+    out = []
+    for i, f in enumerate(TYPICAL_FILTERS):
+        rows = np.flatnonzero(match_mask(cols, f))[:1000]
+        cands = [docs[r] for r in rows]
+        out.append(
+            measure(
+                f"score.score_item_reasons[{i}]",
+                len(docs),
+                lambda: [(score_item(c, f), reasons(c, f)) for c in cands],
+                args.repeat,
+                len(cands),
+            )
+        )
+        sub = {k: v[rows] for k, v in cols.items()}
+        out.append(
+            measure(
+                f"score.score_batch[{i}]",
+                len(docs),
+                lambda: score_batch(sub, f),
+                args.repeat,
+                len(cands),
+            )
+        )
+    return out
+
+
+@case("score")
+def match_all_rows(docs, args):
+    from rec_core import columns_from_docs, match_mask, score_batch
+
+    out = [
+        measure(
+            "score.columns_from_docs",
+            len(docs),
+            lambda: columns_from_docs(docs),
+            max(1, args.repeat // 2),
+            len(docs),
+        )
+    ]
+    cols = columns_from_docs(docs)
+    f = TYPICAL_FILTERS[1]
+    out.append(
+        measure(
+            "score.match_mask+score_batch",
+            len(docs),
+            lambda: score_batch(cols, f)[match_mask(cols, f)],
+            args.repeat,
+            len(docs),
+        )
+    )
+    return out
+
+
+@case("text")
+def search_text(docs, args):
+    from rec_core import combined_text
+
+    out = [
+        measure(
+            "text.combined_text",
+            len(docs),
+            lambda: [combined_text(d) for d in docs],
+            args.repeat,
+            len(docs),
+        )
+    ]
+    try:
+        from search_text import build_search_text
+    except Exception as e:
+        return out + [skipped("text.build_search_text", len(docs), e)]
+    out.append(
+        measure(
+            "text.build_search_text",
+            len(docs),
+            lambda: [build_search_text(d) for d in docs],
+            args.repeat,
+            len(docs),
+        )
+    )
+    return out
+
+
+@case("tfidf")
+def similar_items(docs, args):
+    from bm25_index import char_ngrams
+    from rec_core import columns_from_docs, combined_text, match_mask
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    from tfidf_index import tfidf_index_from_docs
+
+    out = [
+        measure(
+            "tfidf.build_index",
+            len(docs),
+            lambda: tfidf_index_from_docs(docs),
+            max(1, args.repeat // 2),
+            len(docs),
+        )
+    ]
+    index = tfidf_index_from_docs(docs)
+    f = TYPICAL_FILTERS[0]
+    seeds = [str(docs[i]["_id"]) for i in range(0, len(docs), max(1, len(docs) // 20))]
+    out.append(
+        measure(
+            "tfidf.similar_precomputed",
+            len(docs),
+            lambda: [index.similar(s, f, k=9) for s in seeds],
+            args.repeat,
+            len(seeds),
+        )
+    )
+
+    # the per-request fallback in recommender.similar_by_tfidf
+    cols = columns_from_docs(docs)
+    cands = [docs[r] for r in np.flatnonzero(match_mask(cols, f))[:400]]
+
+    def refit():
+        for s in seeds:
+            seed = docs[int(index.row_of[s])]
+            texts = [combined_text(seed)] + [combined_text(c) for c in cands]
+            tf = TfidfVectorizer(analyzer=char_ngrams, min_df=2).fit_transform(texts)
+            cosine_similarity(tf[0:1], tf[1:]).ravel()
+
+    out.append(
+        measure("tfidf.similar_refit", len(docs), refit, args.repeat, len(seeds))
+    )
+    return out
+
+
+@case("bm25")
+def lexical_search(docs, args):
+    from bm25_index import bm25_index_from_docs
+    from rag_retrieval import rrf_scores
+
+    out = [
+        measure(
+            "bm25.build_index",
+            len(docs),
+            lambda: bm25_index_from_docs(docs),
+            max(1, args.repeat // 2),
+            len(docs),
+        )
+    ]
+    index = bm25_index_from_docs(docs)
+    print(
+        f"  bm25: {len(index.terms)} terms, "
+        f"{index.postings.nbytes / 1e6:.2f} MB postings, "
+        f"{index.nbytes / 1e6:.2f} MB total"
+    )
+    # exact building/station names plus a free-text query
+    queries = [docs[i]["name"] for i in range(0, len(docs), max(1, len(docs) // 20))]
+    queries += [f"{d.get('station_name', '')}駅 徒歩 ペット可" for d in docs[:20]]
+    mask = index.mask(TYPICAL_FILTERS[0])
+    out.append(
+        measure(
+            "bm25.search",
+            len(docs),
+            lambda: [index.search(q, k=50, mask=mask) for q in queries],
+            args.repeat,
+            len(queries),
+        )
+    )
+    rankings = [index.search(q, k=50)[0].tolist() for q in queries[:2]]
+    out.append(
+        measure(
+            "bm25.rrf_fuse", len(docs), lambda: rrf_scores(*rankings), args.repeat, 1
+        )
+    )
+    return out
+
+
+def recall_at_k(truth: List[np.ndarray], got: List[np.ndarray], k: int) -> float:
+    return float(
+        np.mean(
+            [
+                len(set(t[:k].tolist()) & set(g[:k].tolist())) / k
+                for t, g in zip(truth, got)
+            ]
+        )
+    )
+
+
+@case("quant")
+def quantized_search(docs, args):
+    """Compact-code scan + float rescoring vs exact float search (recall@10)."""
+    import vector_index as vi
+    from rec_core import columns_from_docs
+
+    X = make_embeddings(len(docs), seed=args.seed)
+    codes = vi.int8_codes(X)
+    index = vi.LocalVectorIndex(
+        X,
+        np.asarray([str(d["_id"]) for d in docs], dtype="U24"),
+        columns_from_docs(docs),
+        codes=codes,
+        code_norms=np.linalg.norm(codes.astype(np.float32), axis=1),
+        bits=np.packbits(X > 0, axis=1),
+    )
+    print(
+        f"  bytes/vector: float32={X.shape[1] * 4} int8={codes.shape[1]} "
+        f"binary={index.bits.shape[1]}"
+    )
+    # queries near stored listings, like "similar" seeds and paraphrases
+    rng = np.random.default_rng(args.seed + 1)
+    Q = X[rng.integers(0, len(X), 20)]
+    Q = Q + rng.standard_normal(Q.shape).astype(np.float32) * 0.03
+    mask = index.mask(TYPICAL_FILTERS[0])
+    truth, _ = index.search_many(Q, 10, mask=mask, quantization="off")
+    out = [
+        measure(
+            "quant.search[float]",
+            len(docs),
+            lambda: index.search_many(Q, 10, mask=mask, quantization="off"),
+            args.repeat,
+            len(Q),
+        )
+    ]
+    rescore = vi.VECTOR_RESCORE
+    try:
+        for mode, factor in (("int8", 1), ("int8", 4), ("binary", 4), ("binary", 10)):
+            vi.VECTOR_RESCORE = factor
+            r = measure(
+                f"quant.search[{mode},x{factor}]",
+                len(docs),
+                lambda: index.search_many(Q, 10, mask=mask, quantization=mode),
+                args.repeat,
+                len(Q),
+            )
+            got, _ = index.search_many(Q, 10, mask=mask, quantization=mode)
+            r["recall_at_10"] = recall_at_k(truth, got, 10)
+            print(f"  {r['name']}: recall@10={r['recall_at_10']:.3f}")
+            out.append(r)
+        # one query per call, as the app searches: int8 uses integer dot
+        # products here instead of the batched float matmul above
+        vi.VECTOR_RESCORE = 4
+        for mode in ("off", "int8"):
+            out.append(
+                measure(
+                    f"quant.search1[{'float' if mode == 'off' else mode}]",
+                    len(docs),
+                    lambda: [
+                        index.search(q, 10, mask=mask, quantization=mode) for q in Q
+                    ],
+                    args.repeat,
+                    len(Q),
+                )
+            )
+    finally:
+        vi.VECTOR_RESCORE = rescore
+    return out
+
+
+@case("reduced")
+def reduced_dim_search(docs, args):
+    """
+    Full 768-dim vs projected (PCA / truncated) vectors on the local index:
+    latency, vector memory and recall@10 for the similar_items_by_vector and
+    retrieve_semantic query shapes.
+    """
+    import vector_index as vi
+    from projection import fit_pca, truncation
+    from rec_core import columns_from_docs, match_mask
+
+    X = make_embeddings(len(docs), seed=args.seed)
+    ids = np.asarray([str(d["_id"]) for d in docs], dtype="U24")
+    cols = columns_from_docs(docs)
+    mask = match_mask(cols, TYPICAL_FILTERS[0])
+    rng = np.random.default_rng(args.seed + 2)
+    seeds = rng.integers(0, len(X), 20)
+    # similar: a stored listing's own vector; semantic: a nearby query text
+    queries = (
+        X[seeds]
+        + rng.standard_normal((len(seeds), X.shape[1])).astype(np.float32) * 0.05
+    )
+    sample = X[: min(len(X), 20_000)]
+    spaces = {"full": None}
+    for dim in (256, 128):
+        spaces[f"pca{dim}"] = fit_pca(sample, dim)
+        spaces[f"truncate{dim}"] = truncation(X.shape[1], dim)
+
+    out, truth = [], {}
+    for label, projection in spaces.items():
+        V = X if projection is None else projection.apply(X)
+        index = vi.LocalVectorIndex(V, ids, cols)
+        print(f"  {label}: {V.nbytes / 1e6:.1f} MB of vectors")
+        shapes = {
+            "similar": (V[seeds], 20),  # _similar_items_local
+            "semantic": (
+                queries if projection is None else projection.apply(queries),
+                30,  # retrieve_semantic limit
+            ),
+        }
+        for shape, (Q, k) in shapes.items():
+            r = measure(
+                f"reduced.{shape}[{label}]",
+                len(docs),
+                lambda: index.search_many(Q, k, mask=mask, quantization="off"),
+                args.repeat,
+                len(Q),
+            )
+            got, _ = index.search_many(Q, k, mask=mask, quantization="off")
+            truth.setdefault(shape, got)
+            r["recall_at_10"] = recall_at_k(truth[shape], got, 10)
+            r["vector_bytes"] = int(V.nbytes)
+            print(f"  {r['name']}: recall@10={r['recall_at_10']:.3f}")
+            out.append(r)
+    return out
+
+
+# ---------- embedding ETL with in-memory collection + fake embedder ----------
+class FakeCollection:
+    """Just enough of a pymongo collection for embed_batch.run_pipeline."""
+
+    class _Cursor(list):
+        def batch_size(self, n):
+            return self
+
+    def __init__(self, docs: List[dict]):
+        self.docs = {d["_id"]: d for d in docs}
+        self._lock = threading.Lock()
+
+    def find(self, query, projection=None):
+        return self._Cursor(self.docs.values())
+
+    def bulk_write(self, ops, ordered=True):
+        with self._lock:
+            for op in ops:
+                self.docs[op._filter["_id"]].update(op._doc["$set"])
+
+
+def fake_embedder(latency_s: float, dim: int = 768):
+    def embed(texts: List[str]) -> List[List[float]]:
+        time.sleep(latency_s)  # one remote round trip per batch
+        rng = np.random.default_rng(len(texts))
+        return rng.standard_normal((len(texts), dim), dtype=np.float32).tolist()
+
+    return embed
+
+
+@case("etl")
+def embed_pipeline(docs, args):
+    name = "etl.run_pipeline"
+    os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+    os.environ.setdefault("EMBED_STATS_EVERY_SEC", "3600")
+    try:
+        import embed_batch
+    except Exception as e:  # e.g. pymongo missing
+        return [skipped(name, len(docs), e)]
+
+    embed = fake_embedder(args.embed_latency_ms / 1000)
+
+    def run():
+        # fresh copies: every run re-embeds everything
+        col = FakeCollection([dict(d) for d in docs])
+        embed_batch.run_pipeline(col, {}, embed_fn=embed)
+
+    return [measure(name, len(docs), run, max(1, args.repeat // 2), len(docs))]
+
+
+# ---------- large find payloads per wire compressor (needs a MongoDB) ----------
+@case("mongo")
+def find_payload(docs, args):
+    """
+    Full-collection find through mongo_client.build_client with each wire
+    compressor, with and without the stored embeddings. Seeds (and drops) a
+    scratch collection, so it only runs with MONGO_BENCH_URI set.
+    """
+    name = "mongo.find"
+    uri = os.getenv("MONGO_BENCH_URI", "")
+    if not uri:
+        return [skipped(name, len(docs), RuntimeError("MONGO_BENCH_URI not set"))]
+    try:
+        from mongo_client import available_compressors, build_client
+        from pymongo.errors import PyMongoError
+        from rec_core import RECOMMEND_PROJECTION
+    except Exception as e:
+        return [skipped(name, len(docs), e)]
+
+    n = min(len(docs), args.mongo_docs)
+    rng = np.random.default_rng(args.seed)
+    seed_docs = [
+        {**d, "embedding": rng.standard_normal(768, dtype=np.float32).tolist()}
+        for d in docs[:n]
+    ]
+    setup = build_client(uri, compressors="")
+    col = setup[os.getenv("MONGO_BENCH_DB", "bench")]["listings_bench"]
+    try:
+        col.drop()
+        col.insert_many(seed_docs, ordered=False)
+    except PyMongoError as e:
+        setup.close()
+        return [skipped(name, len(docs), e)]
+    out = []
+    try:
+        for comp in ["none", *available_compressors("zstd,snappy,zlib")]:
+            client = build_client(uri, compressors="" if comp == "none" else comp)
+            bench_col = client[col.database.name][col.name]
+            for label, projection in (
+                ("full", None),
+                ("recommend_projection", RECOMMEND_PROJECTION),
+            ):
+                out.append(
+                    measure(
+                        f"{name}[{comp},{label}]",
+                        len(docs),
+                        lambda: list(bench_col.find({}, projection).batch_size(1000)),
+                        args.repeat,
+                        n,
+                    )
+                )
+            client.close()
+    finally:
+        col.drop()
+        setup.close()
+    return out
+
+
+# ---------------------------------------------------------
+# Runner
+# ---------------------------------------------------------
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=AGENT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: List[Result], baseline: List[Result], threshold: float):
+    base = {(r["name"], r["n"]): r for r in baseline if "p50_ms" in r}
+    regressions = []
+    for r in results:
+        b = base.get((r["name"], r["n"]))
+        if b and "p50_ms" in r and r["p50_ms"] > b["p50_ms"] * threshold:
+            regressions.append(
+                {
+                    "name": r["name"],
+                    "n": r["n"],
+                    "p50_ms": r["p50_ms"],
+                    "baseline_p50_ms": b["p50_ms"],
+                    "ratio": r["p50_ms"] / b["p50_ms"],
+                }
+            )
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Synthetic-data benchmarks.")
+    ap.add_argument("--sizes", default="10000", help="comma-separated doc counts")
+    ap.add_argument("--only", default="", help="comma-separated case prefixes")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--embed-latency-ms", type=float, default=50.0)
+    ap.add_argument("--mongo-docs", type=int, default=20000, help="mongo.* cap")
+    ap.add_argument("--out", default="", help="write JSON results here")
+    ap.add_argument("--baseline", default="", help="earlier --out file")
+    ap.add_argument("--threshold", type=float, default=1.2)
+    args = ap.parse_args()
+
+    only = [p for p in args.only.split(",") if p]
+    selected = [c for c in CASES if not only or any(c.startswith(p) for p in only)]
+    results: List[Result] = []
+    for n in [int(s) for s in args.sizes.split(",")]:
+        t0 = time.perf_counter()
+        docs = make_listings(n, seed=args.seed)
+        print(f"[bench] generated {n} listings in {time.perf_counter() - t0:.1f}s")
+        for name in selected:
+            for r in CASES[name](docs, args):
+                results.append(r)
+                if "skipped" in r:
+                    print(f"[bench] {r['name']:<34} n={n:<8} skipped ({r['skipped']})")
+                else:
+                    print(
+                        f"[bench] {r['name']:<34} n={n:<8} p50={r['p50_ms']:9.2f}ms "
+                        f"{r['per_item_us']:9.2f}us/item"
+                    )
+
+    report = {
+        "meta": {
+            "git_rev": _git_rev(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        report["regressions"] = compare(results, baseline, args.threshold)
+        for r in report["regressions"]:
+            print(
+                f"[bench] REGRESSION {r['name']} n={r['n']}: "
+                f"{r['baseline_p50_ms']:.2f}ms -> {r['p50_ms']:.2f}ms "
+                f"(x{r['ratio']:.2f})"
+            )
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# synthetic.py
+# Synthetic SUUMO-like listings for benchmarks: realistic price / area /
+# walk / flag distributions and Japanese text, deterministic per seed.
+from datetime import datetime
+from typing import Any, Dict, List
+
+import numpy as np
+from bson import ObjectId
+from local_nlu import STATION_WARDS
+
+LINE = "東急大井町線"
+TOWNS = {
+    "品川区": ["大井", "二葉", "戸越", "中延", "旗の台", "荏原"],
+    "大田区": ["北千束", "石川町", "南千束"],
+    "目黒区": ["緑が丘", "自由が丘", "八雲", "柿の木坂"],
+    "世田谷区": ["奥沢", "尾山台", "等々力", "上野毛", "玉川"],
+    "高津区": ["溝口", "二子", "久本"],
+}
+NAME_PARTS = [
+    "パーク",
+    "ライオンズ",
+    "ザ・",
+    "プラウド",
+    "ブリリア",
+    "シティ",
+    "グラン",
+]
+NAME_TAILS = ["ハウス", "レジデンス", "マンション", "ヒルズ", "テラス", "コート"]
+DESCRIPTIONS = [
+    "駅近で日当たり良好。",
+    "リノベーション済みの室内、システムキッチン付き。",
+    "閑静な住宅街に位置し、生活施設が充実。",
+    "オートロック・宅配ボックス完備。",
+    "眺望良好、陽光差し込む明るいお部屋。",
+    "管理体制良好、ペット飼育規約あり。",
+    "スーパー・公園まで徒歩5分圏内。",
+]
+LAYOUTS = {0: "ワンルーム", 1: "1LDK", 2: "2LDK", 3: "3LDK", 4: "4LDK"}
+
+
+def make_listings(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """n listing docs shaped like the scraper's output (plus a few gaps)."""
+    rng = np.random.default_rng(seed)
+    stations = list(STATION_WARDS)
+    st_idx = rng.integers(0, len(stations), n)
+    rooms = rng.choice([0, 1, 2, 3, 4], n, p=[0.1, 0.3, 0.35, 0.2, 0.05])
+    area = np.clip(rng.normal(25 + 18 * rooms, 8), 15, 160).round(2)
+    # price ~ area x a lognormal unit price (~1.0M yen/㎡)
+    price = (area * rng.lognormal(np.log(1_000_000), 0.3, n)).round(-4)
+    walk = np.clip(rng.gamma(2.2, 3.5, n).round(), 1, 25).astype(int)
+    flag_p = {
+        "pet_ok": 0.35,
+        "balcony": 0.8,
+        "south_facing": 0.45,
+        "corner": 0.25,
+        "tower_mansion": 0.05,
+    }
+    flags = {k: rng.random(n) < p for k, p in flag_p.items()}
+    gaps = rng.random((n, 3)) < [0.03, 0.02, 0.02]  # price / walk / area missing
+    name_a = rng.integers(0, len(NAME_PARTS), n)
+    name_b = rng.integers(0, len(NAME_TAILS), n)
+    name_c = rng.integers(0, max(1, n // 4), n)  # ~4 listings per building
+    desc = rng.integers(0, len(DESCRIPTIONS), (n, 2))
+    # consecutive ObjectIds, as if inserted in one scrape
+    base = int.from_bytes(ObjectId.from_datetime(datetime(2025, 1, 1)).binary, "big")
+
+    docs = []
+    for i in range(n):
+        station = stations[st_idx[i]]
+        ward = STATION_WARDS[station]
+        towns = TOWNS[ward]
+        town = towns[i % len(towns)]
+        city = "神奈川県川崎市" if ward == "高津区" else "東京都"
+        d: Dict[str, Any] = {
+            "_id": ObjectId((base + i).to_bytes(12, "big")),
+            "name": f"{NAME_PARTS[name_a[i]]}{station}{NAME_TAILS[name_b[i]]}{name_c[i]}",
+            "description": DESCRIPTIONS[desc[i, 0]] + DESCRIPTIONS[desc[i, 1]],
+            "category": "中古マンション",
+            "address": f"{city}{ward}{town}{1 + i % 6}丁目",
+            "station_line": LINE,
+            "station_name": station,
+            "layout_raw": LAYOUTS[int(rooms[i])],
+            "rooms": int(rooms[i]),
+            "size": f"{area[i]}m2",
+            "flags": {k: bool(v[i]) for k, v in flags.items()},
+        }
+        if not gaps[i, 0]:
+            d["price_yen"] = int(price[i])
+        if not gaps[i, 1]:
+            d["station_walk_minutes"] = int(walk[i])
+        if not gaps[i, 2]:
+            d["area_sqm"] = float(area[i])
+        docs.append(d)
+    return docs
+
+
+def make_embeddings(n: int, dim: int = 768, seed: int = 0) -> np.ndarray:
+    """
+    (n, dim) float32 unit vectors shaped like text embeddings: a shared
+    offset, topic clusters and a low-rank spread, plus isotropic noise.
+    """
+    rng = np.random.default_rng(seed)
+    offset = rng.standard_normal(dim) * 0.5
+    topics = rng.standard_normal((64, dim))
+    basis = rng.standard_normal((48, dim))
+    x = (
+        offset
+        + topics[rng.integers(0, len(topics), n)] * 0.6
+        + (rng.standard_normal((n, len(basis))) @ basis) * 0.25
+        + rng.standard_normal((n, dim)) * 0.6
+    ).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+# The searches the app sees most: sidebar defaults plus parsed queries
+TYPICAL_FILTERS: List[Dict[str, Any]] = [
+    {"walk_max": 10, "min_rooms": 1},
+    {"walk_max": 10, "min_rooms": 1, "wards": ["品川区"], "budget_max": 60_000_000},
+    {"walk_max": 10, "min_rooms": 1, "station_name": "自由が丘", "pet_ok": True},
+    {
+        "budget_max": 80_000_000,
+        "wards": ["目黒区", "世田谷区"],
+        "walk_max": 12,
+        "min_rooms": 2,
+        "min_area_sqm": 50,
+        "south_ok": True,
+        "bal_ok": True,
+    },
+]
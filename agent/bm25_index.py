@@ -0,0 +1,311 @@
+# bm25_index.py
+# Lexical BM25 index over combined_text with character bigram/trigram
+# tokens, so Japanese names (駅名, 物件名) match without a word segmenter.
+#
+# Layout of an index directory:
+#   terms.npy      sorted n-gram vocabulary
+#   df.npy         documents per term
+#   offsets.npy    byte offset of each term's postings in postings.bin
+#   postings.bin   per term: doc-row deltas, then term frequencies (varints)
+#   doc_len.npy    tokens per document
+#   ids.npy        ObjectId hex strings, row i <-> document i
+#   columns.npz    filter columns (see rec_core.columns_from_docs)
+#   meta.json      {"n", "avgdl", "k1", "b", "ngrams"}
+#
+# Build offline:  uv run --env-file .env bm25_index.py build
+# retrieve_semantic fuses it with the vector results (see rag_retrieval.py).
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import unicodedata
+from array import array
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from rec_core import columns_from_docs, combined_text, match_mask, top_k_indices
+
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "./bm25_index")
+BM25_K1 = 1.2
+BM25_B = 0.75
+NGRAMS = (2, 3)
+
+_SPLIT = re.compile(r"[\W_]+")
+
+
+def char_ngrams(text: str, ns: Tuple[int, ...] = NGRAMS) -> List[str]:
+    """
+    NFKC/lowercased character n-grams of each run of word characters.
+    Runs shorter than the smallest n are kept whole (e.g. 「駅」).
+    """
+    out: List[str] = []
+    for seg in _SPLIT.split(unicodedata.normalize("NFKC", text).lower()):
+        if not seg:
+            continue
+        if len(seg) < ns[0]:
+            out.append(seg)
+            continue
+        for n in ns:
+            out.extend(seg[i : i + n] for i in range(len(seg) - n + 1))
+    return out
+
+
+# ---------- varint (LEB128) coding, vectorized ----------
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    v = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(v), dtype=np.int64)
+    rest = v >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    return nbytes
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    v = np.asarray(values, dtype=np.uint64)
+    nbytes = varint_lengths(v)
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for j in range(int(nbytes.max(initial=0))):
+        sel = nbytes > j
+        byte = (v[sel] >> np.uint64(7 * j)) & np.uint64(0x7F)
+        more = (nbytes[sel] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[sel] + j] = (byte | more).astype(np.uint8)
+    return out
+
+
+def decode_varints(buf: np.ndarray) -> np.ndarray:
+    buf = np.asarray(buf, dtype=np.uint8)
+    if not len(buf):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    pos = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    parts = (buf & 0x7F).astype(np.uint64) << (7 * pos).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+class BM25Index:
+    def __init__(
+        self,
+        terms: np.ndarray,
+        df: np.ndarray,
+        offsets: np.ndarray,
+        postings: np.ndarray,
+        doc_len: np.ndarray,
+        ids: np.ndarray,
+        columns: Dict[str, np.ndarray],
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ):
+        self.terms = terms
+        self.df = df
+        self.offsets = offsets
+        self.postings = postings
+        self.doc_len = doc_len
+        self.ids = ids
+        self.columns = columns
+        self.k1 = k1
+        self.b = b
+        n = len(ids)
+        self.avgdl = float(doc_len.mean()) if n else 0.0
+        # per-document part of the BM25 denominator, computed once
+        self._norm = (k1 * (1 - b + b * doc_len / max(self.avgdl, 1e-9))).astype(
+            np.float32
+        )
+        df = df.astype(np.float64)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return int(
+            self.terms.nbytes
+            + self.df.nbytes
+            + self.offsets.nbytes
+            + self.postings.nbytes
+            + self.doc_len.nbytes
+        )
+
+    # ---------- persistence ----------
+    @classmethod
+    def load(cls, path: str = BM25_INDEX_DIR) -> "BM25Index":
+        with open(os.path.join(path, "meta.json")) as fh:
+            meta = json.load(fh)
+        postings_path = os.path.join(path, "postings.bin")
+        if os.path.getsize(postings_path):
+            postings = np.memmap(postings_path, dtype=np.uint8, mode="r")
+        else:  # mmap of an empty file is not allowed
+            postings = np.zeros(0, dtype=np.uint8)
+        with np.load(os.path.join(path, "columns.npz")) as z:
+            columns = {k: z[k] for k in z.files}
+        return cls(
+            np.load(os.path.join(path, "terms.npy")),
+            np.load(os.path.join(path, "df.npy")),
+            np.load(os.path.join(path, "offsets.npy")),
+            postings,
+            np.load(os.path.join(path, "doc_len.npy")),
+            np.load(os.path.join(path, "ids.npy")),
+            columns,
+            meta["k1"],
+            meta["b"],
+        )
+
+    def save(self, path: str = BM25_INDEX_DIR) -> None:
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "terms.npy"), self.terms)
+        np.save(os.path.join(path, "df.npy"), self.df)
+        np.save(os.path.join(path, "offsets.npy"), self.offsets)
+        np.asarray(self.postings).tofile(os.path.join(path, "postings.bin"))
+        np.save(os.path.join(path, "doc_len.npy"), self.doc_len)
+        np.save(os.path.join(path, "ids.npy"), self.ids)
+        np.savez(os.path.join(path, "columns.npz"), **self.columns)
+        with open(os.path.join(path, "meta.json"), "w") as fh:
+            json.dump(
+                {
+                    "n": len(self.ids),
+                    "avgdl": self.avgdl,
+                    "k1": self.k1,
+                    "b": self.b,
+                    "ngrams": list(NGRAMS),
+                },
+                fh,
+            )
+
+    # ---------- search ----------
+    def term_id(self, term: str) -> int:
+        i = int(np.searchsorted(self.terms, term))
+        return i if i < len(self.terms) and self.terms[i] == term else -1
+
+    def postings_of(self, t: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(rows, term frequencies) of term id t."""
+        vals = decode_varints(self.postings[self.offsets[t] : self.offsets[t + 1]])
+        df = int(self.df[t])
+        return np.cumsum(vals[:df]).astype(np.int64), vals[df:].astype(np.float32)
+
+    def mask(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Row mask with build_match semantics (None = no filtering)."""
+        return match_mask(self.columns, filters) if filters else None
+
+    def scores(self, query: str) -> np.ndarray:
+        out = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(char_ngrams(query)):
+            t = self.term_id(term)
+            if t < 0:
+                continue
+            rows, tf = self.postings_of(t)
+            out[rows] += self.idf[t] * tf * (self.k1 + 1) / (tf + self._norm[rows])
+        return out
+
+    def search(
+        self, query: str, k: int = 20, mask: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k rows with a positive BM25 score: (rows, scores), best first."""
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0.0
+        top = top_k_indices(scores, k)
+        top = top[scores[top] > 0]
+        return top, scores[top]
+
+
+@lru_cache(maxsize=1)
+def get_bm25_index() -> Optional[BM25Index]:
+    """Loaded once per process; None if no index has been built."""
+    try:
+        return BM25Index.load(BM25_INDEX_DIR)
+    except FileNotFoundError:
+        print(f"[bm25_index] no index at {BM25_INDEX_DIR}; vector-only retrieval.")
+        return None
+
+
+# ---------------------------------------------------------
+# Offline build
+# ---------------------------------------------------------
+def bm25_index_from_docs(docs: Iterable[Dict[str, Any]]) -> BM25Index:
+    vocab: Dict[str, int] = {}
+    term_ids, rows, tfs, doc_len = array("i"), array("i"), array("I"), array("I")
+    ids: List[str] = []
+    kept: List[Dict[str, Any]] = []
+    for row, d in enumerate(docs):
+        grams = char_ngrams(combined_text(d))
+        for term, tf in Counter(grams).items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            rows.append(row)
+            tfs.append(tf)
+        doc_len.append(len(grams))
+        ids.append(str(d["_id"]))
+        kept.append(d)
+
+    # renumber terms in sorted order so lookups are a binary search
+    terms = np.asarray(sorted(vocab))
+    new_id = np.empty(len(vocab), dtype=np.int64)
+    new_id[[vocab[t] for t in terms.tolist()]] = np.arange(len(vocab))
+    t_arr = new_id[np.frombuffer(term_ids, dtype=np.int32)]
+    r_arr = np.frombuffer(rows, dtype=np.int32).astype(np.int64)
+    tf_arr = np.frombuffer(tfs, dtype=np.uint32)
+    order = np.lexsort((r_arr, t_arr))
+    t_arr, r_arr, tf_arr = t_arr[order], r_arr[order], tf_arr[order]
+
+    df = np.bincount(t_arr, minlength=len(terms)).astype(np.uint32)
+    # first posting of a term stores its row, the rest store gaps
+    deltas = np.diff(r_arr, prepend=0)
+    first = np.concatenate(([0], np.cumsum(df)[:-1])).astype(np.int64)
+    deltas[first[df > 0]] = r_arr[first[df > 0]]
+    # one value stream: per term its deltas, then its term frequencies
+    n_terms = np.asarray(df, dtype=np.int64)[t_arr]
+    base = 2 * first[t_arr]
+    j = np.arange(len(t_arr)) - first[t_arr]
+    values = np.empty(2 * len(t_arr), dtype=np.uint64)
+    values[base + j] = deltas
+    values[base + n_terms + j] = tf_arr
+    postings = encode_varints(values)
+    byte_end = np.concatenate(([0], np.cumsum(varint_lengths(values))))
+    offsets = byte_end[np.concatenate((2 * first, [len(values)]))]
+
+    cols = columns_from_docs(kept)
+    # plain unicode arrays so the file loads without pickle
+    cols = {k: v.astype(str) if v.dtype == object else v for k, v in cols.items()}
+    return BM25Index(
+        terms,
+        df,
+        offsets,
+        postings,
+        np.frombuffer(doc_len, dtype=np.uint32).copy(),
+        np.asarray(ids, dtype="U24"),
+        cols,
+    )
+
+
+def build_bm25_index(PROPS, path: str = BM25_INDEX_DIR) -> BM25Index:
+    from tfidf_index import TEXT_PROJECTION
+
+    index = bm25_index_from_docs(PROPS.find({}, TEXT_PROJECTION).batch_size(1000))
+    index.save(path)
+    return index
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build the BM25 n-gram index.")
+    ap.add_argument("command", choices=["build"])
+    ap.add_argument("--out", default=BM25_INDEX_DIR)
+    args = ap.parse_args()
+
+    from db import get_collections
+
+    PROPS, _ = get_collections()
+    index = build_bm25_index(PROPS, args.out)
+    print(
+        f"Indexed {len(index)} listings, {len(index.terms)} terms, "
+        f"{len(index.postings) / 1e6:.1f} MB of postings into {args.out}"
+    )
+
+
+if __name__ == "__main__":
+    main()
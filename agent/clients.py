@@ -0,0 +1,84 @@
+# clients.py
+# Lazy, process-wide registry of model clients (Vertex / GenAI).
+#
+# Importing the agent modules never builds a client or imports the cloud
+# SDKs; each client is created on first use. warm_up() builds selected
+# clients ahead of time, e.g. at startup with WARM_CLIENTS=genai,embedding_model.
+import importlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Optional
+
+PROJECT_ID = os.getenv("PROJECT_ID", "dev-projects-476011")
+LOCATION = os.getenv("LOCATION", "asia-northeast1")
+WARM_CLIENTS = os.getenv("WARM_CLIENTS", "")
+
+# client name -> module that registers it (imported by warm_up)
+CLIENT_MODULES = {
+    "genai": "vertex_nlu",
+    "embedding_model": "rag_retrieval",
+    "rag_model": "rag_generate",
+}
+
+_REGISTRY: Dict[str, Callable[[], Any]] = {}
+
+
+def lazy_client(name: str):
+    """Register a zero-arg factory; returns the memoized getter."""
+
+    def register(factory: Callable[[], Any]) -> Callable[[], Any]:
+        getter = lru_cache(maxsize=1)(factory)
+        _REGISTRY[name] = getter
+        return getter
+
+    return register
+
+
+@lru_cache(maxsize=1)
+def init_vertexai() -> None:
+    import vertexai
+
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+
+
+def warm_up(names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """
+    Build the named clients (default: all known) in parallel.
+    Returns {name: seconds} or {name: "error: ..."}; never raises.
+    """
+    names = list(names or CLIENT_MODULES)
+    for name in names:
+        if name not in _REGISTRY and name in CLIENT_MODULES:
+            importlib.import_module(CLIENT_MODULES[name])
+
+    def build(name: str):
+        t0 = time.perf_counter()
+        try:
+            _REGISTRY[name]()
+            return name, round(time.perf_counter() - t0, 3)
+        except Exception as e:
+            return name, f"error: {e}"
+
+    known = [n for n in names if n in _REGISTRY]
+    with ThreadPoolExecutor(max_workers=max(1, len(known))) as ex:
+        out = dict(ex.map(build, known))
+    for name in set(names) - set(known):
+        out[name] = "error: unknown client"
+    print(f"[clients] warm-up: {out}")
+    return out
+
+
+@lru_cache(maxsize=1)
+def warm_up_from_env() -> None:
+    """
+    Startup hook: warm WARM_CLIENTS (comma-separated) once per process, on a
+    background thread so the first page render does not wait for it.
+    """
+    names = [n.strip() for n in WARM_CLIENTS.split(",") if n.strip()]
+    if names:
+        threading.Thread(
+            target=warm_up, args=(names,), name="warm-clients", daemon=True
+        ).start()
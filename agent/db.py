@@ -1,12 +1,13 @@
 import os
 from functools import lru_cache
 
-import pymongo
+from mongo_client import get_client, read_only
 
 
 @lru_cache(maxsize=1)
 def get_collections():
-    client = pymongo.MongoClient(os.environ["MONGO_URI"])
-    db = client[os.environ.get("DB_NAME", "suumo")]
+    db = get_client()[os.environ.get("DB_NAME", "suumo")]
     coll_name = os.environ.get("MONGO_COLLECTION_NAME", "suumo")  # ← add this
-    return db[coll_name], db["events"]
+    # listings are only read here: route them per MONGO_READ_PREFERENCE;
+    # events are written, so they stay on the primary
+    return read_only(db[coll_name]), db["events"]
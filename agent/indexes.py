@@ -0,0 +1,139 @@
+# indexes.py
+# Index provisioning for the query shapes emitted by rec_core.build_match,
+# plus an explain() checker that fails if any of them is a collection scan.
+#
+#   uv run --env-file .env indexes.py ensure   # create/update indexes
+#   uv run --env-file .env indexes.py check    # exit 1 on any COLLSCAN
+import argparse
+import itertools
+import sys
+from typing import Any, Dict, List
+
+from pymongo import ASCENDING, IndexModel
+from rec_core import FLAG_KEYS, build_match
+
+
+def _flag_index(flag: str) -> IndexModel:
+    # Filters only ever ask for flags.* == True, so index just those docs
+    path = f"flags.{flag}"
+    return IndexModel(
+        [
+            (path, ASCENDING),
+            ("price_yen", ASCENDING),
+            ("station_walk_minutes", ASCENDING),
+        ],
+        name=f"{path}_price_walk",
+        partialFilterExpression={path: True},
+    )
+
+
+# Equality (flags) first, then the range fields most queries carry
+# (price_yen, station_walk_minutes), so the planner always has a
+# selective prefix whichever subset of filters is present.
+INDEXES: List[IndexModel] = [
+    IndexModel(
+        [("price_yen", ASCENDING), ("station_walk_minutes", ASCENDING)],
+        name="price_walk",
+    ),
+    IndexModel(
+        [("station_walk_minutes", ASCENDING), ("price_yen", ASCENDING)],
+        name="walk_price",
+    ),
+    IndexModel([("rooms", ASCENDING), ("price_yen", ASCENDING)], name="rooms_price"),
+    IndexModel([("area_sqm", ASCENDING), ("price_yen", ASCENDING)], name="area_price"),
+    # unanchored regex (wards / station) can still scan these instead of docs
+    IndexModel(
+        [("station_name", ASCENDING), ("price_yen", ASCENDING)],
+        name="station_price",
+    ),
+    IndexModel([("address", ASCENDING)], name="address"),
+    # listing_snapshot watermark polling
+    IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    *[_flag_index(flag) for _, flag in FLAG_KEYS],
+]
+
+
+def ensure_indexes(PROPS) -> List[str]:
+    return PROPS.create_indexes(INDEXES)
+
+
+# ---------------------------------------------------------
+# Explain-plan checker
+# ---------------------------------------------------------
+# One value per filter key, in the shapes the NLU / sidebar produce
+SAMPLE_VALUES: Dict[str, Any] = {
+    "budget_max": 60_000_000,
+    "wards": ["品川区"],
+    "station_name": "大井町",
+    "walk_max": 10,
+    "min_rooms": 1,
+    "min_area_sqm": 45,
+    **{key: True for key, _ in FLAG_KEYS},
+}
+
+
+def representative_filters(max_keys: int = 2) -> List[Dict[str, Any]]:
+    """Every filter key alone and in pairs, plus the app's typical searches."""
+    keys = list(SAMPLE_VALUES)
+    out: List[Dict[str, Any]] = []
+    for r in range(1, max_keys + 1):
+        for combo in itertools.combinations(keys, r):
+            out.append({k: SAMPLE_VALUES[k] for k in combo})
+    # sidebar defaults (walk 10, 1+ rooms) + a parsed query
+    out += [
+        {"walk_max": 10, "min_rooms": 1},
+        {"walk_max": 10, "min_rooms": 1, "wards": ["品川区"], "budget_max": 60_000_000},
+        {"walk_max": 10, "min_rooms": 1, "station_name": "自由が丘", "pet_ok": True},
+        {k: SAMPLE_VALUES[k] for k in keys},
+    ]
+    return out
+
+
+def _stages(plan: Any):
+    """Yield every stage name in an explain plan (classic or SBE layout)."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for v in plan.values():
+            yield from _stages(v)
+    elif isinstance(plan, list):
+        for v in plan:
+            yield from _stages(v)
+
+
+def check_plans(PROPS, filters_list=None) -> List[dict]:
+    """Explain each build_match query; return the ones whose plan has a COLLSCAN."""
+    failures = []
+    for f in filters_list or representative_filters():
+        match = build_match(f)
+        if not match:
+            continue  # an empty filter is a full scan by definition
+        plan = PROPS.find(match).explain()["queryPlanner"]["winningPlan"]
+        stages = set(_stages(plan))
+        if "COLLSCAN" in stages:
+            failures.append({"filters": f, "stages": sorted(stages)})
+    return failures
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Provision/check listing indexes.")
+    ap.add_argument("command", choices=["ensure", "check"])
+    args = ap.parse_args()
+
+    from db import get_collections
+
+    PROPS, _ = get_collections()
+    if args.command == "ensure":
+        print(f"Ensured indexes: {', '.join(ensure_indexes(PROPS))}")
+        return
+
+    failures = check_plans(PROPS)
+    for fail in failures:
+        print(f"COLLSCAN: {fail['filters']} -> {fail['stages']}")
+    if failures:
+        sys.exit(1)
+    print(f"OK: {len(representative_filters())} query shapes use an index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+# listing_snapshot.py
+# Compact columnar copy of the filter/scoring fields, kept warm in memory.
+#
+# One row per listing, fixed footprint (52 bytes):
+#   oid S12 | price_yen f8 | area_sqm f8 | station_walk_minutes f4 | rooms f4
+#   flags u1 (rec_core.FLAG_BITS) | wards u4 (bit i = WARD_LIST[i] in address)
+#   station i2 / name i4 / address i4 (codes into small string tables) | live ?
+#
+# Loaded once per process (get_snapshot) and refreshed incrementally, from a
+# change stream when the deployment supports one, otherwise from an
+# `updated_at` watermark plus the newest `_id`.
+from __future__ import annotations
+
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+from rec_core import (
+    FLAG_BITS,
+    WARD_LIST,
+    contains_any,
+    numeric_match_mask,
+    rank_unique_names,
+    score_batch,
+)
+
+SNAPSHOT_ENABLED = os.getenv("LISTING_SNAPSHOT", "0") == "1"
+SNAPSHOT_REFRESH_SEC = float(os.getenv("LISTING_SNAPSHOT_REFRESH_SEC", "30"))
+WATERMARK_FIELD = os.getenv("LISTING_SNAPSHOT_WATERMARK", "updated_at")
+
+SNAPSHOT_PROJECTION = {
+    "_id": 1,
+    "name": 1,
+    "price_yen": 1,
+    "area_sqm": 1,
+    "rooms": 1,
+    "station_walk_minutes": 1,
+    "station_name": 1,
+    "address": 1,
+    "flags": 1,
+    WATERMARK_FIELD: 1,
+}
+
+_COLUMNS = (
+    ("oid", "S12"),
+    ("price_yen", np.float64),
+    ("area_sqm", np.float64),
+    ("station_walk_minutes", np.float32),
+    ("rooms", np.float32),
+    ("flags", np.uint8),
+    ("wards", np.uint32),
+    ("station", np.int16),
+    ("name", np.int32),
+    ("address", np.int32),
+    ("live", np.bool_),
+)
+
+
+class _Table:
+    """String table: value <-> small integer code."""
+
+    __slots__ = ("values", "code_of")
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.code_of: Dict[str, int] = {}
+
+    def code(self, value: Optional[str]) -> int:
+        if not value:
+            return -1
+        c = self.code_of.get(value)
+        if c is None:
+            c = self.code_of[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+    def matching(self, needles: List[str]) -> np.ndarray:
+        """Codes whose value contains any needle (build_match regex semantics)."""
+        values = np.asarray(self.values, dtype=object)
+        return np.flatnonzero(contains_any(values, needles))
+
+
+class ListingSnapshot:
+    __slots__ = (
+        "cols",
+        "n",
+        "row_of",
+        "stations",
+        "names",
+        "addresses",
+        "watermark",
+        "last_oid",
+        "resume_token",
+        "use_change_stream",
+        "refreshed_at",
+        "lock",
+    )
+
+    def __init__(self, capacity: int = 1024):
+        self.cols = {k: np.zeros(capacity, dtype=t) for k, t in _COLUMNS}
+        self.n = 0
+        self.row_of: Dict[bytes, int] = {}
+        self.stations = _Table()
+        self.names = _Table()
+        self.addresses = _Table()
+        self.watermark: Any = None
+        self.last_oid: Optional[ObjectId] = None
+        self.resume_token = None
+        self.use_change_stream = True
+        self.refreshed_at = 0.0
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self.n
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a[: self.n].nbytes for a in self.cols.values())
+
+    # ---------- loading ----------
+    @classmethod
+    def load(cls, PROPS) -> "ListingSnapshot":
+        snap = cls(capacity=max(1024, PROPS.estimated_document_count()))
+        # open the change stream first so nothing written during the scan is lost
+        snap._open_change_stream(PROPS)
+        for d in PROPS.find({}, SNAPSHOT_PROJECTION).batch_size(5000):
+            snap.upsert(d)
+        snap.refreshed_at = time.time()
+        return snap
+
+    def upsert(self, d: Dict[str, Any]) -> None:
+        key = d["_id"].binary
+        with self.lock:
+            row = self.row_of.get(key)
+            if row is None:
+                row = self._grow()
+                self.row_of[key] = row
+            c = self.cols
+            c["oid"][row] = key
+            c["price_yen"][row] = _num(d.get("price_yen"))
+            c["area_sqm"][row] = _num(d.get("area_sqm"))
+            c["station_walk_minutes"][row] = _num(d.get("station_walk_minutes"))
+            c["rooms"][row] = _num(d.get("rooms"))
+            fl = d.get("flags") or {}
+            c["flags"][row] = sum(b for k, b in FLAG_BITS.items() if fl.get(k))
+            address = d.get("address") or ""
+            c["wards"][row] = sum(
+                1 << i for i, w in enumerate(WARD_LIST) if w in address
+            )
+            c["station"][row] = self.stations.code(d.get("station_name"))
+            c["name"][row] = self.names.code(d.get("name"))
+            c["address"][row] = self.addresses.code(address)
+            c["live"][row] = True
+
+            wm = d.get(WATERMARK_FIELD)
+            if wm is not None and (self.watermark is None or wm > self.watermark):
+                self.watermark = wm
+            if self.last_oid is None or d["_id"] > self.last_oid:
+                self.last_oid = d["_id"]
+
+    def delete(self, oid: ObjectId) -> None:
+        with self.lock:
+            row = self.row_of.get(oid.binary)
+            if row is not None:
+                self.cols["live"][row] = False
+
+    def _grow(self) -> int:
+        if self.n == len(self.cols["oid"]):
+            cap = max(1024, 2 * self.n)
+            for k, a in self.cols.items():
+                grown = np.zeros(cap, dtype=a.dtype)
+                grown[: self.n] = a
+                self.cols[k] = grown
+        self.n += 1
+        return self.n - 1
+
+    # ---------- incremental refresh ----------
+    def maybe_refresh(self, PROPS, min_interval: float = SNAPSHOT_REFRESH_SEC) -> int:
+        if time.time() - self.refreshed_at < min_interval:
+            return 0
+        return self.refresh(PROPS)
+
+    def refresh(self, PROPS) -> int:
+        """Apply changes since the last refresh; returns the number applied."""
+        with self.lock:
+            if self.use_change_stream:
+                try:
+                    applied = self._drain_change_stream(PROPS)
+                    self.refreshed_at = time.time()
+                    return applied
+                except PyMongoError as e:
+                    print(f"[snapshot] change stream unavailable ({e}); polling.")
+                    self.use_change_stream = False
+            applied = self._poll_watermark(PROPS)
+            self.refreshed_at = time.time()
+            return applied
+
+    def _open_change_stream(self, PROPS) -> None:
+        try:
+            with PROPS.watch(max_await_time_ms=1) as stream:
+                stream.try_next()
+                self.resume_token = stream.resume_token
+        except PyMongoError:
+            # standalone servers have no change streams
+            self.use_change_stream = False
+
+    def _drain_change_stream(self, PROPS) -> int:
+        applied = 0
+        with PROPS.watch(
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+            max_await_time_ms=1,
+        ) as stream:
+            while True:
+                ev = stream.try_next()
+                if ev is None:
+                    break
+                op = ev["operationType"]
+                if op == "delete":
+                    self.delete(ev["documentKey"]["_id"])
+                elif ev.get("fullDocument"):
+                    self.upsert(ev["fullDocument"])
+                applied += 1
+            self.resume_token = stream.resume_token
+        return applied
+
+    def _poll_watermark(self, PROPS) -> int:
+        since: List[dict] = []
+        if self.watermark is not None:
+            since.append({WATERMARK_FIELD: {"$gt": self.watermark}})
+        if self.last_oid is not None:
+            since.append({"_id": {"$gt": self.last_oid}})
+        query = {"$or": since} if since else {}
+        applied = 0
+        for d in PROPS.find(query, SNAPSHOT_PROJECTION).batch_size(5000):
+            self.upsert(d)
+            applied += 1
+        return applied
+
+    # ---------- in-memory build_match / scoring ----------
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Views in the layout rec_core.numeric_match_mask/score_batch expect."""
+        c, n = self.cols, self.n
+        return {
+            "price_yen": c["price_yen"][:n],
+            "area_sqm": c["area_sqm"][:n],
+            "station_walk_minutes": c["station_walk_minutes"][:n].astype(np.float64),
+            "rooms": c["rooms"][:n].astype(np.float64),
+            "flags": c["flags"][:n],
+        }
+
+    def mask(self, filters: Dict[str, Any], cols=None) -> np.ndarray:
+        """Rows matching build_match(filters)."""
+        n = self.n
+        cols = cols or self.columns()
+        mask = numeric_match_mask(cols, filters) & self.cols["live"][:n]
+        if filters.get("wards"):
+            known = [w for w in filters["wards"] if w in WARD_LIST]
+            if len(known) == len(filters["wards"]):
+                bits = sum(1 << WARD_LIST.index(w) for w in known)
+                mask &= (self.cols["wards"][:n] & bits) != 0
+            else:
+                codes = self.addresses.matching(filters["wards"])
+                mask &= np.isin(self.cols["address"][:n], codes)
+        if filters.get("station_name"):
+            codes = self.stations.matching([filters["station_name"]])
+            mask &= np.isin(self.cols["station"][:n], codes)
+        return mask
+
+    def recommend(self, filters: Dict[str, Any], k: int = 12) -> List[Tuple]:
+        """
+        [(ObjectId, score)] like build_recommend_pipeline without a candidate
+        limit: best listing per name, ties broken by _id.
+        """
+        with self.lock:
+            cols = self.columns()
+            rows = np.flatnonzero(self.mask(filters, cols))
+            if not len(rows):
+                return []
+            scores = score_batch({k_: v[rows] for k_, v in cols.items()}, filters)
+            oids = self.cols["oid"][rows]
+            names = self.cols["name"][rows]
+        keep = rank_unique_names(scores, names, oids, k)
+        # numpy strips trailing NUL bytes from S12 values; pad them back
+        return [(ObjectId(oids[i].ljust(12, b"\0")), float(scores[i])) for i in keep]
+
+
+def _num(v: Any) -> float:
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return np.nan
+    return float(v)
+
+
+@lru_cache(maxsize=1)
+def _load_snapshot() -> ListingSnapshot:
+    from db import get_collections
+
+    PROPS, _ = get_collections()
+    t0 = time.time()
+    snap = ListingSnapshot.load(PROPS)
+    print(
+        f"[snapshot] {len(snap)} listings, {snap.nbytes / 1e6:.1f} MB "
+        f"in {time.time() - t0:.1f}s"
+    )
+    return snap
+
+
+def get_snapshot() -> Optional[ListingSnapshot]:
+    """Warm, periodically refreshed snapshot; None unless LISTING_SNAPSHOT=1."""
+    if not SNAPSHOT_ENABLED:
+        return None
+    from db import get_collections
+
+    snap = _load_snapshot()
+    snap.maybe_refresh(get_collections()[0])
+    return snap
@@ -0,0 +1,230 @@
+# local_nlu.py
+# Fast local query parser: precompiled patterns for numbers (budget, walk,
+# rooms, area) plus one Aho-Corasick pass over a dictionary of wards,
+# stations, feature keywords and filler words.
+#
+# local_parse() also reports coverage: the share of the query's characters
+# explained by something it recognised. At 1.0 nothing is left for Gemini
+# to interpret, so recommender.parse_query can skip the round trip.
+import re
+from typing import Any, Dict, List, Tuple
+
+from rec_core import WARD_LIST, normalize_query
+
+# Tokyu Ōimachi Line, station -> ward (the area the demo data covers). Only
+# recognised, never turned into a ward filter: listings near a station often
+# sit in the next ward (自由が丘 / 奥沢), and Gemini does not add one either.
+STATION_WARDS = {
+    "大井町": "品川区",
+    "下神明": "品川区",
+    "戸越公園": "品川区",
+    "中延": "品川区",
+    "荏原町": "品川区",
+    "旗の台": "品川区",
+    "北千束": "大田区",
+    "大岡山": "大田区",
+    "緑が丘": "目黒区",
+    "自由が丘": "目黒区",
+    "九品仏": "世田谷区",
+    "尾山台": "世田谷区",
+    "等々力": "世田谷区",
+    "上野毛": "世田谷区",
+    "二子玉川": "世田谷区",
+    "二子新地": "高津区",
+    "高津": "高津区",
+    "溝の口": "高津区",
+}
+STATION_ALIASES = {"溝ノ口": "溝の口", "自由ヶ丘": "自由が丘", "旗ノ台": "旗の台"}
+
+FEATURE_WORDS = {
+    "ペット": "pet_ok",
+    "ペット可": "pet_ok",
+    "ペット相談": "pet_ok",
+    "バルコニー": "bal_ok",
+    "ベランダ": "bal_ok",
+    "南向き": "south_ok",
+    "南向": "south_ok",
+    "角部屋": "corner_ok",
+    "タワマン": "tower_ok",
+    "タワーマンション": "tower_ok",
+}
+
+# Words that carry no filter of their own ("以内"/"まで" only restate the
+# direction every numeric filter already has). "以上"/"以下" are claimed by
+# the numeric patterns when they agree with the filter's direction; the
+# opposite direction ("6000万円以上") stays unexplained and goes to Gemini.
+FILLER_WORDS = [
+    "駅",
+    "から",
+    "まで",
+    "徒歩",
+    "以内",
+    "の",
+    "で",
+    "を",
+    "に",
+    "が",
+    "は",
+    "と",
+    "かつ",
+    "付き",
+    "あり",
+    "OK",
+    "可",
+    "円",
+    "物件",
+    "マンション",
+    "部屋",
+    "エリア",
+    "周辺",
+    "近く",
+    "探して",
+    "教えて",
+    "ください",
+    "下さい",
+    "います",
+    "希望",
+    ",",
+    ".",
+    "、",
+    "。",
+    "・",
+    "/",
+]
+
+# (pattern, handler) applied in order on the NFKC-normalized query; spans
+# claimed by an earlier pattern are not reused by later ones
+# upper bounds (budget, walk) may end in 以下, lower bounds (rooms, area) in 以上
+_AT_MOST = r"(?:\s*以下)?"
+_AT_LEAST = r"(?:\s*以上)?"
+_OKU = re.compile(r"(\d+(?:\.\d+)?)\s*億(?:\s*(\d{1,4})\s*万)?(?:円)?" + _AT_MOST)
+_MAN = re.compile(r"(\d{3,6}(?:\.\d+)?)\s*万(?:円)?" + _AT_MOST)
+_WALK = re.compile(r"徒歩\s*(\d{1,2})\s*分" + _AT_MOST)
+_ROOMS = re.compile(r"([1-9])\s*S?(?:LDK|DK|K)(?![A-Z])" + _AT_LEAST, re.IGNORECASE)
+_AREA = re.compile(
+    r"(\d{2,3}(?:\.\d+)?)\s*(?:m2|平米|平方メートル)" + _AT_LEAST, re.IGNORECASE
+)
+# thousands separators ("6,000万円"); NFKC has already turned "，" into ","
+_THOUSANDS = re.compile(r"(?<=\d),(?=\d{3})")
+
+
+def _budget_oku(m: re.Match) -> Dict[str, Any]:
+    man = int(m.group(2)) * 10_000 if m.group(2) else 0
+    return {"budget_max": int(float(m.group(1)) * 100_000_000) + man}
+
+
+_PATTERNS = [
+    (_OKU, _budget_oku),
+    (_MAN, lambda m: {"budget_max": int(float(m.group(1)) * 10_000)}),
+    (_WALK, lambda m: {"walk_max": int(m.group(1))}),
+    (_ROOMS, lambda m: {"min_rooms": int(m.group(1))}),
+    (_AREA, lambda m: {"min_area_sqm": int(float(m.group(1)))}),
+]
+
+
+class AhoCorasick:
+    """Multi-pattern matcher: one pass over the text for every keyword."""
+
+    def __init__(self, keywords: Dict[str, Any]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[Tuple[int, Any]]] = [[]]  # (keyword length, payload)
+        for word, payload in keywords.items():
+            node = 0
+            for ch in word:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = self.goto[node][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append((len(word), payload))
+        # breadth-first failure links
+        queue = list(self.goto[0].values())
+        while queue:
+            node = queue.pop(0)
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                cand = self.goto[f].get(ch, 0)
+                self.fail[nxt] = cand if cand != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find_all(self, text: str) -> List[Tuple[int, int, Any]]:
+        """Every (start, end, payload) occurrence, overlaps included."""
+        hits = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, payload in self.out[node]:
+                hits.append((i + 1 - length, i + 1, payload))
+        return hits
+
+
+def _build_matcher() -> AhoCorasick:
+    kw: Dict[str, Any] = {w: ("filler", None) for w in FILLER_WORDS}
+    kw.update({k: ("flag", v) for k, v in FEATURE_WORDS.items()})
+    for st, ward in STATION_WARDS.items():
+        kw[st] = ("station", st)
+    for alias, st in STATION_ALIASES.items():
+        kw[alias] = ("station", st)
+    for ward in [*WARD_LIST, *STATION_WARDS.values()]:
+        kw[ward] = ("ward", ward)
+    return AhoCorasick(kw)
+
+
+_MATCHER = _build_matcher()
+
+
+def local_parse(q: str) -> Tuple[Dict[str, Any], float]:
+    """
+    (filters, coverage) with the same keys as fallback_parse_query_to_filters.
+    coverage is the share of non-space characters explained, 0.0 - 1.0; it
+    is capped below 1.0 when the query names more than one station.
+    """
+    text = _THOUSANDS.sub("", normalize_query(q))
+    taken = [False] * len(text)
+    f: Dict[str, Any] = {}
+
+    def claim(start: int, end: int) -> bool:
+        if any(taken[start:end]):
+            return False
+        taken[start:end] = [True] * (end - start)
+        return True
+
+    for pat, handler in _PATTERNS:
+        for m in pat.finditer(text):
+            if claim(m.start(), m.end()):
+                for k, v in handler(m).items():
+                    f.setdefault(k, v)
+
+    # leftmost-longest, non-overlapping dictionary matches
+    wards: List[str] = []
+    stations: List[str] = []
+    for start, end, (kind, value) in sorted(
+        _MATCHER.find_all(text), key=lambda h: (h[0], h[0] - h[1])
+    ):
+        if not claim(start, end):
+            continue
+        if kind == "flag":
+            f[value] = True
+        elif kind == "ward" and value not in wards:
+            wards.append(value)
+        elif kind == "station" and value not in stations:
+            stations.append(value)
+
+    if stations:
+        f["station_name"] = stations[0]
+    if wards:
+        f["wards"] = wards
+
+    chars = [i for i, ch in enumerate(text) if not ch.isspace()]
+    coverage = sum(taken[i] for i in chars) / len(chars) if chars else 0.0
+    if len(stations) > 1:
+        coverage = min(coverage, 0.99)  # Gemini picks the most relevant one
+    return f, coverage
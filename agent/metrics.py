@@ -0,0 +1,227 @@
+# metrics.py
+# Lightweight spans, latency histograms and counters for the agent.
+#
+#   METRICS_ENABLED=1      record spans/counters (off: span() is a shared
+#                          no-op and @traced returns the function unchanged)
+#   METRICS_PORT=9464      serve Prometheus text at http://:9464/metrics
+#   METRICS_JSONL=path     append one JSON line per finished span
+#
+# with span("mongo.find"):          # block
+#     ...
+# @traced("recommend")              # function
+# def recommend(filters): ...
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_JSONL = os.getenv("METRICS_JSONL", "")
+
+# seconds; Prometheus-style cumulative buckets (+Inf implied)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "trace_id", default=None
+)
+_parent: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "span_parent", default=None
+)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bucket bound holding the q-quantile (coarse, like Prometheus)."""
+        rank = q * self.count
+        seen = 0
+        for bound, c in zip((*BUCKETS, float("inf")), self.counts):
+            seen += c
+            if seen >= rank and c:
+                return bound
+        return 0.0
+
+
+class Registry:
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._jsonl = None
+        if METRICS_ENABLED and METRICS_JSONL:
+            self._jsonl = open(METRICS_JSONL, "a", encoding="utf-8")
+
+    def observe(self, name: str, seconds: float, **event) -> None:
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(seconds)
+            if self._jsonl is not None:
+                event.update(span=name, ms=round(seconds * 1000, 3))
+                self._jsonl.write(json.dumps(event, ensure_ascii=False) + "\n")
+                self._jsonl.flush()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def prometheus_text(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            if self.histograms:
+                lines.append("# TYPE agent_span_seconds histogram")
+            for name, h in sorted(self.histograms.items()):
+                cum = 0
+                for bound, c in zip((*BUCKETS, "+Inf"), h.counts):
+                    cum += c
+                    lines.append(
+                        f'agent_span_seconds_bucket{{span="{name}",le="{bound}"}} {cum}'
+                    )
+                lines.append(f'agent_span_seconds_sum{{span="{name}"}} {h.sum:.6f}')
+                lines.append(f'agent_span_seconds_count{{span="{name}"}} {h.count}')
+            for name, v in sorted(self.counters.items()):
+                metric = "agent_" + name.replace(".", "_").replace("-", "_") + "_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {v:g}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """{span: {count, mean_ms, p50_ms, p95_ms}} for logs / debugging."""
+        with self._lock:
+            return {
+                name: {
+                    "count": h.count,
+                    "mean_ms": h.sum / h.count * 1000 if h.count else 0.0,
+                    "p50_ms": h.quantile(0.5) * 1000,
+                    "p95_ms": h.quantile(0.95) * 1000,
+                }
+                for name, h in self.histograms.items()
+            }
+
+
+REGISTRY = Registry()
+
+
+class _Span:
+    __slots__ = ("name", "t0", "tokens")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        tokens = [_parent.set(self.name)]
+        if _trace_id.get() is None:
+            tokens.append(_trace_id.set(uuid.uuid4().hex[:12]))
+        self.tokens = tokens
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.t0
+        tokens = self.tokens
+        _parent.reset(tokens[0])
+        REGISTRY.observe(
+            self.name,
+            seconds,
+            ts=time.time(),
+            trace=_trace_id.get(),
+            parent=_parent.get(),
+            error=exc_type.__name__ if exc_type else None,
+        )
+        if len(tokens) > 1:
+            _trace_id.reset(tokens[1])
+        if exc_type is not None:
+            REGISTRY.inc(f"{self.name}.errors")
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str):
+    """Time a block; nested spans share the outermost span's trace id."""
+    return _Span(name) if METRICS_ENABLED else _NOOP
+
+
+def traced(name: str):
+    """Decorator form of span(); when disabled the function is returned as is."""
+
+    def wrap(fn):
+        if not METRICS_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with _Span(name):
+                return fn(*args, **kwargs)
+
+        return inner
+
+    return wrap
+
+
+def inc(name: str, value: float = 1) -> None:
+    if METRICS_ENABLED:
+        REGISTRY.inc(name, value)
+
+
+def observe(name: str, seconds: float) -> None:
+    if METRICS_ENABLED:
+        REGISTRY.observe(name, seconds, ts=time.time(), trace=_trace_id.get())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # keep scrapes out of the app log
+
+
+@lru_cache(maxsize=1)
+def start_metrics_server() -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics once per process when METRICS_ENABLED and METRICS_PORT."""
+    if not (METRICS_ENABLED and METRICS_PORT):
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"[metrics] serving /metrics on :{METRICS_PORT}")
+    return server
@@ -0,0 +1,280 @@
+# parse_cache.py
+# Shared (cross-process) store for parsed NLU filter dicts, so restarts,
+# rollouts and extra replicas reuse earlier Gemini parses.
+#
+#   NLU_SHARED_CACHE=sqlite  (default) file at NLU_SHARED_CACHE_PATH
+#   NLU_SHARED_CACHE=redis   any RESP server at NLU_REDIS_URL
+#   NLU_SHARED_CACHE=        disabled
+#
+# Keys are versioned: nlu:<PROMPT_VERSION>:<sha256(normalized query)>.
+# recommender.py also keeps ranked result sets here: rank:<filter fingerprint>.
+#
+#   uv run --env-file .env parse_cache.py warm --log queries.txt [--parse-missing]
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+from urllib.parse import urlparse
+
+from rec_core import normalize_query
+
+NLU_SHARED_CACHE = os.getenv("NLU_SHARED_CACHE", "sqlite")
+NLU_SHARED_CACHE_PATH = os.getenv("NLU_SHARED_CACHE_PATH", ".nlu_cache.sqlite3")
+NLU_REDIS_URL = os.getenv("NLU_REDIS_URL", "redis://localhost:6379/0")
+NLU_SHARED_CACHE_TTL_SEC = int(os.getenv("NLU_SHARED_CACHE_TTL_SEC", str(7 * 86400)))
+# one query per line; appended by the app, read by warm_up()
+NLU_QUERY_LOG = os.getenv("NLU_QUERY_LOG", "")
+# past this size the log is rotated to <log>.1 (one old file is kept)
+NLU_QUERY_LOG_MAX_MB = float(os.getenv("NLU_QUERY_LOG_MAX_MB", "16"))
+
+# Errors a backend may raise; the caller falls through to Gemini on these
+BACKEND_ERRORS = (OSError, sqlite3.Error, ValueError)
+
+
+@lru_cache(maxsize=1)
+def prompt_version() -> str:
+    from vertex_nlu import PROMPT_VERSION
+
+    return PROMPT_VERSION
+
+
+def cache_key(query: str) -> str:
+    digest = hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+    return f"nlu:{prompt_version()}:{digest}"
+
+
+# ---------------------------------------------------------
+# SQLite backend
+# ---------------------------------------------------------
+class SQLiteParseCache:
+    def __init__(self, path: str = NLU_SHARED_CACHE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS parses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL) WITHOUT ROWID"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[dict]]:
+        found: Dict[str, str] = {}
+        conn = self._conn()
+        for i in range(0, len(keys), 500):
+            chunk = list(keys[i : i + 500])
+            marks = ",".join("?" * len(chunk))
+            found.update(
+                conn.execute(
+                    f"SELECT key, value FROM parses WHERE key IN ({marks})"
+                    " AND expires_at > ?",
+                    (*chunk, time.time()),
+                ).fetchall()
+            )
+        return [json.loads(found[k]) if k in found else None for k in keys]
+
+    def set_many(self, items: Dict[str, dict], ttl: int = NLU_SHARED_CACHE_TTL_SEC):
+        expires = time.time() + ttl
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO parses (key, value, expires_at) VALUES (?, ?, ?)",
+                [
+                    (k, json.dumps(v, ensure_ascii=False), expires)
+                    for k, v in items.items()
+                ],
+            )
+            conn.execute("DELETE FROM parses WHERE expires_at <= ?", (time.time(),))
+
+
+# ---------------------------------------------------------
+# Redis backend (minimal RESP2 client; GET/MGET/SET EX only)
+# ---------------------------------------------------------
+class RedisParseCache:
+    def __init__(self, url: str = NLU_REDIS_URL, timeout: float = 0.5):
+        u = urlparse(url)
+        self.host = u.hostname or "localhost"
+        self.port = u.port or 6379
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.password = u.password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _sock(self):
+        f = getattr(self._local, "f", None)
+        if f is None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            f = self._local.f = sock.makefile("rwb")
+            try:
+                if self.password:
+                    self._call("AUTH", self.password)
+                if self.db:
+                    self._call("SELECT", str(self.db))
+            except BaseException:
+                self._local.f = None  # never reuse an unauthenticated socket
+                raise
+        return f
+
+    def _call(self, *args: str):
+        f = self._sock()
+        try:
+            f.write(_encode(args))
+            f.flush()
+            return _read_reply(f)
+        except OSError:
+            self._local.f = None  # reconnect on the next call
+            raise
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[dict]]:
+        if not keys:
+            return []
+        values = self._call("MGET", *keys)
+        return [json.loads(v) if v is not None else None for v in values]
+
+    def set_many(self, items: Dict[str, dict], ttl: int = NLU_SHARED_CACHE_TTL_SEC):
+        for k, v in items.items():
+            self._call("SET", k, json.dumps(v, ensure_ascii=False), "EX", str(ttl))
+
+
+def _encode(args: Sequence[str]) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        b = a.encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+    return b"".join(out)
+
+
+def _read_reply(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError("redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise ValueError(f"redis error: {rest.decode()}")
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0:
+            return None
+        data = f.read(n + 2)[:-2]
+        return data.decode("utf-8")
+    if kind == b"*":
+        n = int(rest)
+        return None if n < 0 else [_read_reply(f) for _ in range(n)]
+    raise ValueError(f"unexpected redis reply: {line!r}")
+
+
+@lru_cache(maxsize=1)
+def get_shared_parse_cache():
+    """Process-wide backend per NLU_SHARED_CACHE; None when disabled."""
+    if NLU_SHARED_CACHE == "redis":
+        return RedisParseCache()
+    if NLU_SHARED_CACHE == "sqlite" and NLU_SHARED_CACHE_PATH:
+        return SQLiteParseCache()
+    return None
+
+
+# ---------------------------------------------------------
+# Query log + warm-up
+# ---------------------------------------------------------
+_log_lock = threading.Lock()
+
+
+def log_query(
+    query: str, path: str = NLU_QUERY_LOG, max_mb: float = NLU_QUERY_LOG_MAX_MB
+) -> None:
+    q = normalize_query(query)
+    if not (path and q):
+        return
+    with _log_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(q + "\n")
+            size = f.tell()
+        if max_mb and size > max_mb * 1024 * 1024:
+            os.replace(path, path + ".1")
+
+
+def top_queries(path: str, top: int = 500) -> List[str]:
+    """Most frequent normalized queries in a log and its rotated copy."""
+    counts: Counter = Counter()
+    for p in (path + ".1", path):
+        if not os.path.exists(p):
+            continue
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                q = normalize_query(line)
+                if q:
+                    counts[q] += 1
+    return [q for q, _ in counts.most_common(top)]
+
+
+def warm_up(path: str = NLU_QUERY_LOG, top: int = 500, parse_missing: bool = False):
+    """
+    Load the log's most frequent queries from the shared backend into the
+    in-process NLU cache; optionally parse (and store) the ones not cached yet.
+    Returns (loaded, parsed).
+    """
+    from vertex_guard import NLU_CACHE, _parse_uncached
+
+    backend = get_shared_parse_cache()
+    logs = (path, path + ".1") if path else ()
+    if not any(os.path.exists(p) for p in logs) or backend is None:
+        return 0, 0
+    queries = top_queries(path, top)
+    try:
+        values = backend.get_many([cache_key(q) for q in queries])
+    except BACKEND_ERRORS as e:
+        print(f"[parse_cache] warm-up skipped ({e})")
+        return 0, 0
+    loaded = parsed = 0
+    for q, v in zip(queries, values):
+        if v is None and parse_missing:
+            v = _parse_uncached(q)  # also stores it in the backend
+            parsed += 1
+        if v:
+            NLU_CACHE.set(q, v)
+            loaded += 1
+    return loaded, parsed
+
+
+@lru_cache(maxsize=1)
+def warm_up_once() -> None:
+    """Startup hook: warm from NLU_QUERY_LOG once per process (hits only)."""
+    if NLU_QUERY_LOG:
+        loaded, _ = warm_up(NLU_QUERY_LOG)
+        print(f"[parse_cache] warmed {loaded} parses from {NLU_QUERY_LOG}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Shared NLU parse cache tools.")
+    ap.add_argument("command", choices=["warm"])
+    ap.add_argument("--log", default=NLU_QUERY_LOG, help="one query per line")
+    ap.add_argument("--top", type=int, default=500)
+    ap.add_argument("--parse-missing", action="store_true")
+    args = ap.parse_args()
+
+    t0 = time.time()
+    loaded, parsed = warm_up(args.log, args.top, args.parse_missing)
+    print(f"Warmed {loaded} parses ({parsed} new) in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
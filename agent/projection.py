@@ -0,0 +1,91 @@
+# projection.py
+# Reduced-dimension copy of each embedding, stored in `embedding_reduced`
+# next to the full 768-dim `embedding`.
+#
+# A projection is fitted offline (vector_index.py fit-projection) and saved
+# as one .npz file whose name carries its version, e.g. pca256-1a2b3c4d5e6f.npz:
+#
+#   kind        "pca" | "truncate"
+#   mean        (768,) subtracted before projecting (zeros for truncate)
+#   components  (dim, 768) rows of the projection
+#
+# EMBED_PROJECTION_PATH points the ETL and the agent at the same file. Every
+# reduced vector is stored with `embedding_projection` = the version, and
+# queries are projected with the same file, so the two spaces never mix.
+#
+# Kept identical to embed/projection.py: the ETL writes the vectors and the
+# agent projects queries the same way.
+from __future__ import annotations
+
+import hashlib
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+EMBED_PROJECTION_PATH = os.getenv("EMBED_PROJECTION_PATH", "")
+REDUCED_FIELD = "embedding_reduced"
+VERSION_FIELD = "embedding_projection"
+
+
+class Projection:
+    def __init__(self, kind: str, mean: np.ndarray, components: np.ndarray):
+        self.kind = kind
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        digest = hashlib.sha256(
+            kind.encode() + self.mean.tobytes() + self.components.tobytes()
+        ).hexdigest()
+        self.version = f"{kind}{self.dim}-{digest[:12]}"
+
+    @property
+    def dim(self) -> int:
+        return len(self.components)
+
+    def apply(self, x) -> np.ndarray:
+        """Project one vector or a (n, 768) matrix; rows are L2-normalized."""
+        x = np.asarray(x, dtype=np.float32)
+        x = x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+        y = (x - self.mean) @ self.components.T
+        return y / np.maximum(np.linalg.norm(y, axis=-1, keepdims=True), 1e-12)
+
+    # ---------- persistence ----------
+    def save(self, directory: str) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.version}.npz")
+        np.savez(path, kind=self.kind, mean=self.mean, components=self.components)
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "Projection":
+        with np.load(path) as z:
+            return cls(str(z["kind"]), z["mean"], z["components"])
+
+
+def fit_pca(X: np.ndarray, dim: int) -> Projection:
+    """Top `dim` principal axes of the L2-normalized rows of X."""
+    X = np.asarray(X, dtype=np.float32)
+    X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+    mean = X.mean(axis=0)
+    _, _, vt = np.linalg.svd(X - mean, full_matrices=False)
+    return Projection("pca", mean, vt[:dim])
+
+
+def truncation(full_dim: int, dim: int) -> Projection:
+    """First `dim` coordinates (what output_dimensionality would return)."""
+    return Projection(
+        "truncate",
+        np.zeros(full_dim, dtype=np.float32),
+        np.eye(dim, full_dim, dtype=np.float32),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_projection() -> Optional[Projection]:
+    """The configured projection, or None when EMBED_PROJECTION_PATH is unset."""
+    if not EMBED_PROJECTION_PATH:
+        return None
+    projection = Projection.load(EMBED_PROJECTION_PATH)
+    print(f"[projection] {projection.version} from {EMBED_PROJECTION_PATH}")
+    return projection
@@ -0,0 +1,165 @@
+# rag_cache.py
+# Persistent, bounded cache of RAG summaries.
+#
+# Key = sha256(prompt version, normalized query, ordered (_id, fingerprint)
+# of the candidates), where a listing's fingerprint hashes the exact context
+# line Gemini sees (price, walk, area, flags, url, ...). A listing edit thus
+# changes every key it is part of; the listing -> entry reverse index then
+# drops the entries built from its previous version.
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+RAG_CACHE_PATH = os.getenv("RAG_CACHE_PATH", ".rag_cache.sqlite3")
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "5000"))
+
+_EVICT_EVERY = 100  # puts between size checks
+# last_used is only rewritten once it is this old (see embed_cache.py)
+_TOUCH_AFTER_SEC = 3600.0
+
+
+def answer_key(
+    prompt_version: str, query: str, listings: Sequence[Tuple[str, str]]
+) -> str:
+    """listings: ordered (listing_id, fingerprint) as passed to the prompt."""
+    h = hashlib.sha256(f"{prompt_version}\n{query}".encode("utf-8"))
+    for listing_id, fp in listings:
+        h.update(f"\n{listing_id}:{fp}".encode("utf-8"))
+    return h.hexdigest()
+
+
+class RagAnswerCache:
+    def __init__(
+        self, path: str = RAG_CACHE_PATH, max_entries: int = RAG_CACHE_MAX_ENTRIES
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY, answer TEXT NOT NULL,"
+                " last_used REAL NOT NULL) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)"
+            )
+            # reverse index: which entries were built from which listing version
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_listings ("
+                " listing_id TEXT NOT NULL, fp TEXT NOT NULL, key TEXT NOT NULL,"
+                " PRIMARY KEY (listing_id, key)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS answer_listings_key"
+                " ON answer_listings (key)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT answer, last_used FROM answers WHERE key = ?", (key,)
+        ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] < now - _TOUCH_AFTER_SEC:  # otherwise a hit is a pure read
+            with conn:
+                conn.execute(
+                    "UPDATE answers SET last_used = ? WHERE key = ?", (now, key)
+                )
+        return row[0]
+
+    def put(self, key: str, answer: str, listings: Sequence[Tuple[str, str]]) -> None:
+        conn = self._conn()
+        with conn:
+            # entries built from an older version of any of these listings
+            # can never be hit again; drop them now
+            for listing_id, fp in listings:
+                self._delete_keys(
+                    conn,
+                    "SELECT key FROM answer_listings WHERE listing_id = ? AND fp != ?",
+                    (listing_id, fp),
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, answer, last_used)"
+                " VALUES (?, ?, ?)",
+                (key, answer, time.time()),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO answer_listings (listing_id, fp, key)"
+                " VALUES (?, ?, ?)",
+                [(listing_id, fp, key) for listing_id, fp in listings],
+            )
+        with self._lock:
+            self._puts += 1
+            check = self._puts >= _EVICT_EVERY
+            if check:
+                self._puts = 0
+        if check:
+            self.evict()
+
+    def invalidate_listings(self, listing_ids: Sequence[str]) -> int:
+        """Drop every entry that used any of these listings; returns the count."""
+        conn = self._conn()
+        dropped = 0
+        with conn:
+            for listing_id in listing_ids:
+                dropped += self._delete_keys(
+                    conn,
+                    "SELECT key FROM answer_listings WHERE listing_id = ?",
+                    (listing_id,),
+                )
+        return dropped
+
+    def evict(self) -> int:
+        """Drop least recently used entries down to 90% of max_entries."""
+        conn = self._conn()
+        (count,) = conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+        if count <= self.max_entries:
+            return 0
+        drop = count - int(0.9 * self.max_entries)
+        with conn:
+            return self._delete_keys(
+                conn, "SELECT key FROM answers ORDER BY last_used LIMIT ?", (drop,)
+            )
+
+    @staticmethod
+    def _delete_keys(conn: sqlite3.Connection, select_sql: str, args: tuple) -> int:
+        keys: List[str] = [k for (k,) in conn.execute(select_sql, args).fetchall()]
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            marks = ",".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM answers WHERE key IN ({marks})", chunk)
+            conn.execute(f"DELETE FROM answer_listings WHERE key IN ({marks})", chunk)
+        return len(keys)
+
+
+@lru_cache(maxsize=1)
+def get_rag_cache() -> Optional[RagAnswerCache]:
+    """Process-wide cache; None when RAG_CACHE_PATH is set to an empty string."""
+    if not RAG_CACHE_PATH:
+        return None
+    return RagAnswerCache()
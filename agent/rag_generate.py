@@ -1,13 +1,18 @@
 # rag_generate.py
-import os
+from __future__ import annotations
 
-import vertexai
-from vertexai.generative_models import Content, GenerativeModel, Part
+import hashlib
+import json
+import time
+from typing import TYPE_CHECKING, Iterator
 
-vertexai.init(
-    project=os.getenv("PROJECT_ID", "dev-projects-476011"),
-    location="asia-northeast1",
-)
+from clients import init_vertexai, lazy_client
+from metrics import observe, span, traced
+from rag_cache import answer_key, get_rag_cache
+from rec_core import normalize_query
+
+if TYPE_CHECKING:
+    from vertexai.generative_models import Content
 
 SYSTEM = (
     "あなたは不動産アドバイザーです。ユーザー条件と候補物件の一覧を読み、"
@@ -18,26 +23,51 @@ SYSTEM = (
     '{ "recommendations": [ {"name":"...","url":"...","reason":"..."} ] }'
 )
 
-MODEL = GenerativeModel("gemini-2.5-flash", system_instruction=SYSTEM)
+RAG_MODEL = "gemini-2.5-flash"
+# part of the answer-cache key: a prompt/model edit starts a fresh cache
+PROMPT_VERSION = hashlib.sha256(f"{RAG_MODEL}\n{SYSTEM}".encode()).hexdigest()[:16]
+
+
+@lazy_client("rag_model")
+def get_model():
+    from vertexai.generative_models import GenerativeModel
+
+    init_vertexai()
+    return GenerativeModel(RAG_MODEL, system_instruction=SYSTEM)
+
+
+def _context_line(it: dict) -> str:
+    return (
+        f"- {it.get('name', '(不明)')} | {it.get('address', '')} | "
+        f"{it.get('price_yen', '-')}円 | 徒歩{it.get('station_walk_minutes', '-')}分 | "
+        f"{it.get('area_sqm', '-')}㎡ | {it.get('layout_raw') or (('ワンルーム') if (it.get('rooms') == 0) else f'{it.get("rooms", "-")}R')} | "
+        f"設備: ペット可={bool(it.get('flags', {}).get('pet_ok'))}, 南向き={bool(it.get('flags', {}).get('south_facing'))}, "
+        f"角部屋={bool(it.get('flags', {}).get('corner'))}, バルコニー={bool(it.get('flags', {}).get('balcony'))}, "
+        f"タワマン={bool(it.get('flags', {}).get('tower_mansion'))} | URL={it.get('url', '#')}"
+    )
 
 
 def format_context(items: list[dict]) -> str:
-    lines = []
-    for it in items[:12]:
-        lines.append(
-            f"- {it.get('name', '(不明)')} | {it.get('address', '')} | "
-            f"{it.get('price_yen', '-')}円 | 徒歩{it.get('station_walk_minutes', '-')}分 | "
-            f"{it.get('area_sqm', '-')}㎡ | {it.get('layout_raw') or (('ワンルーム') if (it.get('rooms') == 0) else f'{it.get("rooms", "-")}R')} | "
-            f"設備: ペット可={bool(it.get('flags', {}).get('pet_ok'))}, 南向き={bool(it.get('flags', {}).get('south_facing'))}, "
-            f"角部屋={bool(it.get('flags', {}).get('corner'))}, バルコニー={bool(it.get('flags', {}).get('balcony'))}, "
-            f"タワマン={bool(it.get('flags', {}).get('tower_mansion'))} | URL={it.get('url', '#')}"
+    return "\n".join(_context_line(it) for it in items[:12])
+
+
+def _cache_entry(user_query: str, items: list[dict]):
+    """(key, [(listing_id, fingerprint)]) for the candidates in the prompt."""
+    listings = [
+        (
+            str(it.get("_id")),
+            hashlib.sha256(_context_line(it).encode("utf-8")).hexdigest()[:16],
         )
-    return "\n".join(lines)
+        for it in items[:12]
+    ]
+    return answer_key(PROMPT_VERSION, normalize_query(user_query), listings), listings
 
 
-def generate_summary(user_query: str, items: list[dict]) -> str:
+def _user_content(user_query: str, items: list[dict]) -> Content:
+    from vertexai.generative_models import Content, Part
+
     ctx = format_context(items)
-    user = Content(
+    return Content(
         role="user",
         parts=[
             Part.from_text(
@@ -46,6 +76,136 @@ def generate_summary(user_query: str, items: list[dict]) -> str:
             )
         ],
     )
-    resp = MODEL.generate_content([user], generation_config={"temperature": 0.1})
+
+
+@traced("generate_summary")
+def generate_summary(user_query: str, items: list[dict]) -> str:
+    cache = get_rag_cache()
+    if cache is not None:
+        key, listings = _cache_entry(user_query, items)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit
+    user = _user_content(user_query, items)
+    resp = get_model().generate_content([user], generation_config={"temperature": 0.1})
     # return raw text (should be JSON)
-    return resp.candidates[0].content.parts[0].text
+    text = resp.candidates[0].content.parts[0].text
+    if cache is not None and text:
+        cache.put(key, text, listings)
+    return text
+
+
+# ---------------------------------------------------------
+# Streaming: yield each recommendation as soon as its object closes
+# ---------------------------------------------------------
+class RecommendationParser:
+    """
+    Incremental scanner for {"recommendations": [ {...}, {...} ]}.
+    feed() returns the objects of the array completed by the new text;
+    anything around the JSON (code fences, stray prose) is ignored.
+    """
+
+    KEY = '"recommendations"'
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0  # next unscanned char
+        self._in_array = False
+        self._depth = 0
+        self._obj_start = -1
+        self._in_str = False
+        self._escape = False
+        self.done = False  # array closed
+
+    def feed(self, chunk: str) -> list[dict]:
+        self.text += chunk
+        out: list[dict] = []
+        if self.done:
+            return out
+        if not self._in_array:
+            k = self.text.find(self.KEY)
+            b = self.text.find("[", k + len(self.KEY)) if k >= 0 else -1
+            if b < 0:
+                return out
+            self._in_array = True
+            self._pos = b + 1
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._obj_start = i
+                self._depth += 1
+            elif ch == "]" and self._depth == 0:
+                self.done = True
+                break
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        out.append(json.loads(text[self._obj_start : i + 1]))
+                    except json.JSONDecodeError:
+                        pass  # malformed entry: skip it, keep streaming
+        self._pos = len(text)
+        return out
+
+
+class SummaryStream:
+    """
+    Iterates recommendations while Gemini is still generating; .text holds
+    the raw output once iteration ends (same string generate_summary returns).
+    """
+
+    def __init__(self, user_query: str, items: list[dict]):
+        self._user = _user_content(user_query, items)
+        self._entry = _cache_entry(user_query, items)
+        self.parser = RecommendationParser()
+        self.cached = False
+
+    @property
+    def text(self) -> str:
+        return self.parser.text
+
+    def __iter__(self) -> Iterator[dict]:
+        with span("generate_summary_stream"):
+            yield from self._iter()
+
+    def _iter(self) -> Iterator[dict]:
+        cache = get_rag_cache()
+        key, listings = self._entry
+        hit = cache.get(key) if cache is not None else None
+        if hit is not None:
+            self.cached = True
+            yield from self.parser.feed(hit)
+            return
+        responses = get_model().generate_content(
+            [self._user], generation_config={"temperature": 0.1}, stream=True
+        )
+        t0 = time.perf_counter()
+        first = True
+        for chunk in responses:
+            try:
+                piece = chunk.text
+            except ValueError:
+                continue  # chunk without text (e.g. safety / finish metadata)
+            for rec in self.parser.feed(piece):
+                if first:
+                    observe("generate_summary.first_item", time.perf_counter() - t0)
+                    first = False
+                yield rec
+        # only a fully streamed answer is cached
+        if cache is not None and self.text:
+            cache.put(key, self.text, listings)
+
+
+def generate_summary_stream(user_query: str, items: list[dict]) -> SummaryStream:
+    return SummaryStream(user_query, items)
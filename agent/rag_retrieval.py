@@ -4,25 +4,89 @@ from __future__ import annotations
 import os
 from typing import Any, Dict, List, Tuple
 
-import vertexai
-from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
+import numpy as np
+from bm25_index import get_bm25_index
+from bson import ObjectId
+from clients import init_vertexai, lazy_client
+from embed_cache import get_embed_cache
+from metrics import span, traced
+from projection import REDUCED_FIELD, VERSION_FIELD, get_projection
+from quantize import QUANTIZED_FIELDS, to_bson_vector
+from rec_core import normalize_query
+from ttl_cache import TTLCache
+from vector_index import (
+    VECTOR_NPROBE,
+    VECTOR_QUANTIZATION,
+    VECTOR_REDUCED,
+    VECTOR_RESCORE,
+    get_local_index,
+    to_vector_score,
+)
+
+# Hybrid retrieval: "rrf" fuses BM25 with the vector ranking, "off" = vector only
+RETRIEVAL_FUSION = os.getenv("RETRIEVAL_FUSION", "rrf")
+# Rank constant of reciprocal rank fusion and how deep each ranking is read
+RRF_K = 60
+RRF_DEPTH = int(os.getenv("RRF_DEPTH", "50"))
 
 # ----------------------------
-# Vertex AI Embeddings (init)
+# Vertex AI Embeddings (built on first use)
 # ----------------------------
-vertexai.init(
-    project=os.getenv("PROJECT_ID", "dev-projects-476011"),
-    location=os.getenv("LOCATION", "asia-northeast1"),
+EMBED_MODEL = "text-multilingual-embedding-002"
+# Cache key for TextEmbeddingInput without an explicit task_type
+QUERY_TASK_TYPE = "DEFAULT"
+
+
+@lazy_client("embedding_model")
+def get_embedding_model():
+    from vertexai.language_models import TextEmbeddingModel
+
+    init_vertexai()
+    return TextEmbeddingModel.from_pretrained(EMBED_MODEL)
+
+
+# In-process query-vector cache; identical concurrent queries share one call
+QUERY_CACHE = TTLCache(
+    maxsize=int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("QUERY_EMBED_CACHE_TTL_SEC", "3600")),
 )
-EMB = TextEmbeddingModel.from_pretrained("text-multilingual-embedding-002")
 
 
-def embed_query(text: str) -> List[float]:
-    """Return a 768-dim embedding for the query (or [] if blank)."""
+@traced("embed_query")
+def embed_query(text: str, reduced: bool = False) -> List[float]:
+    """
+    Return a 768-dim embedding for the query (or [] if blank); with reduced,
+    its projection into the `embedding_reduced` space (see projection.py).
+    """
     if not text or not text.strip():
         return []
     # Trim to safe size; VertexAI allows long, but keep practical.
-    return EMB.get_embeddings([TextEmbeddingInput(text[:7000])])[0].values
+    key = normalize_query(text)[:7000]
+    vec = QUERY_CACHE.get_or_compute(key, lambda: _embed_query_uncached(key))
+    return reduce_query(vec) if reduced else vec
+
+
+def reduce_query(qvec: List[float]) -> List[float]:
+    """Project a full query vector the same way the ETL reduced the listings."""
+    projection = get_projection()
+    if projection is None:
+        raise ValueError("reduced vectors need EMBED_PROJECTION_PATH")
+    return projection.apply(qvec).tolist() if qvec else []
+
+
+def _embed_query_uncached(text: str) -> List[float]:
+    cache = get_embed_cache()
+    if cache is not None:
+        (hit,) = cache.get_many(EMBED_MODEL, QUERY_TASK_TYPE, [text])
+        if hit is not None:
+            return hit
+    from vertexai.language_models import TextEmbeddingInput
+
+    emb = get_embedding_model().get_embeddings([TextEmbeddingInput(text)])
+    vec = list(emb[0].values)
+    if cache is not None:
+        cache.put_many(EMBED_MODEL, QUERY_TASK_TYPE, [text], [vec])
+    return vec
 
 
 # ---------------------------------------------------------
@@ -101,6 +165,24 @@ def _split_filters_for_vectorsearch(
 # -----------------------------------------
 # Main retrieval with $vectorSearch
 # -----------------------------------------
+RAG_PROJECTION = {
+    "name": 1,
+    "address": 1,
+    "image": 1,
+    "url": 1,
+    "price_yen": 1,
+    "area_sqm": 1,
+    "rooms": 1,
+    "layout_raw": 1,
+    "size": 1,
+    "station_line": 1,
+    "station_name": 1,
+    "station_walk_minutes": 1,
+    "flags": 1,
+    "description": 1,
+}
+
+
 def retrieve_semantic(
     PROPS,  # pymongo collection
     query_text: str,
@@ -116,9 +198,65 @@ def retrieve_semantic(
       - Safe prefilters (ranges/equals/booleans/$in) go into $vectorSearch.filter
       - Regex/complex bits go into a post $match stage
       - Projects vector score via $meta: 'vectorSearchScore'
+    With VECTOR_BACKEND=local the vector step runs on the in-process index
+    (vector_index.py) instead, with the same filter semantics.
     Fallback when no query_text: pure $match + $limit.
+    When a BM25 index is built (bm25_index.py), its lexical ranking is fused
+    with the vector ranking by reciprocal rank fusion; items then carry
+    "rrf_score" (0..1) and "lexical_score" next to "vector_score".
     """
     qvec = embed_query(query_text)
+    lexical = get_bm25_index() if qvec and RETRIEVAL_FUSION == "rrf" else None
+    if lexical is None:
+        return _retrieve_vector(PROPS, qvec, filters, k, limit, index, num_candidates)
+    depth = max(limit, RRF_DEPTH)
+    vec_items = _retrieve_vector(PROPS, qvec, filters, k, depth, index, num_candidates)
+    with span("bm25.search"):
+        rows, bm25 = lexical.search(query_text, k=depth, mask=lexical.mask(filters))
+    lex_ids = [ObjectId(lexical.ids[r]) for r in rows]
+    return _fuse_rrf(PROPS, vec_items, lex_ids, bm25.tolist(), limit)
+
+
+def rrf_scores(*rankings: List[Any], k: int = RRF_K) -> Dict[Any, float]:
+    """Reciprocal rank fusion: sum of 1 / (k + rank) over the rankings."""
+    fused: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+def _fuse_rrf(PROPS, vec_items, lex_ids, lex_scores, limit) -> List[dict]:
+    fused = rrf_scores([d["_id"] for d in vec_items], lex_ids)
+    top = sorted(fused, key=fused.__getitem__, reverse=True)[: max(1, limit)]
+    docs = {d["_id"]: d for d in vec_items}
+    missing = [_id for _id in top if _id not in docs]
+    if missing:
+        # lexical-only hits
+        with span("mongo.find"):
+            for d in PROPS.find({"_id": {"$in": missing}}, RAG_PROJECTION):
+                d["vector_score"] = None
+                docs[d["_id"]] = d
+    lexical = dict(zip(lex_ids, lex_scores))
+    best = 2.0 / (RRF_K + 1)  # first in both rankings
+    out = []
+    for _id in top:
+        if _id in docs:
+            d = docs[_id]
+            d["rrf_score"] = fused[_id] / best
+            d["lexical_score"] = lexical.get(_id)
+            out.append(d)
+    return out
+
+
+def _retrieve_vector(
+    PROPS, qvec, filters, k, limit, index, num_candidates
+) -> List[dict]:
+    local = get_local_index()
+    if qvec and local is not None:
+        # In-process index: build_match filters are applied as a row mask
+        return _retrieve_local(PROPS, local, qvec, filters, limit)
+
     mongo_match_filter = _safe_build_match(
         filters
     )  # wraps your existing build_match() safely
@@ -126,8 +264,12 @@ def retrieve_semantic(
 
     pipeline: List[Dict[str, Any]] = []
 
+    # int8/binary codes are of the full vectors, so reduced search skips them
+    reduced = bool(qvec) and VECTOR_REDUCED
+    quantized = bool(qvec) and VECTOR_QUANTIZATION != "off" and not reduced
     if qvec:
-        # $vectorSearch (limit is part of this stage)
+        # $vectorSearch (limit is part of this stage); with quantization it
+        # runs over the compact field and returns candidates to rescore
         vs_stage: Dict[str, Any] = {
             "$vectorSearch": {
                 "index": index,
@@ -137,6 +279,18 @@ def retrieve_semantic(
                 "limit": max(1, limit),
             }
         }
+        if reduced:
+            version = {VERSION_FIELD: get_projection().version}
+            vs_filter = {"$and": [*(vs_filter or {}).get("$and", []), version]}
+            vs_stage["$vectorSearch"].update(
+                path=REDUCED_FIELD, queryVector=reduce_query(qvec)
+            )
+        if quantized:
+            vs_stage["$vectorSearch"].update(
+                path=QUANTIZED_FIELDS[VECTOR_QUANTIZATION],
+                queryVector=to_bson_vector(qvec, VECTOR_QUANTIZATION),
+                limit=max(1, limit) * max(1, VECTOR_RESCORE),
+            )
         if vs_filter:
             vs_stage["$vectorSearch"]["filter"] = vs_filter
         pipeline.append(vs_stage)
@@ -149,21 +303,10 @@ def retrieve_semantic(
         pipeline.append(
             {
                 "$project": {
-                    "name": 1,
-                    "address": 1,
-                    "image": 1,
-                    "url": 1,
-                    "price_yen": 1,
-                    "area_sqm": 1,
-                    "rooms": 1,
-                    "layout_raw": 1,
-                    "size": 1,
-                    "station_line": 1,
-                    "station_name": 1,
-                    "station_walk_minutes": 1,
-                    "flags": 1,
-                    "description": 1,
+                    **RAG_PROJECTION,
                     "vector_score": {"$meta": "vectorSearchScore"},
+                    # float vectors of the candidates only, for rescoring
+                    **({"embedding": 1} if quantized else {}),
                 }
             }
         )
@@ -178,20 +321,7 @@ def retrieve_semantic(
                 {"$limit": max(1, limit)},
                 {
                     "$project": {
-                        "name": 1,
-                        "address": 1,
-                        "image": 1,
-                        "url": 1,
-                        "price_yen": 1,
-                        "area_sqm": 1,
-                        "rooms": 1,
-                        "layout_raw": 1,
-                        "size": 1,
-                        "station_line": 1,
-                        "station_name": 1,
-                        "station_walk_minutes": 1,
-                        "flags": 1,
-                        "description": 1,
+                        **RAG_PROJECTION,
                         # No vector score without $vectorSearch
                         "vector_score": {"$literal": None},
                     }
@@ -199,7 +329,10 @@ def retrieve_semantic(
             ]
         )
 
-    out = list(PROPS.aggregate(pipeline))
+    with span("mongo.vector_search"):
+        out = list(PROPS.aggregate(pipeline))
+    if quantized:
+        out = _rescore(out, qvec, limit)
     if not out:
         print(
             {
@@ -216,6 +349,42 @@ def retrieve_semantic(
     return out
 
 
+def _rescore(items: List[dict], qvec: List[float], limit: int) -> List[dict]:
+    """Full-precision cosine for candidates found on quantized codes."""
+    q = np.asarray(qvec, dtype=np.float32)
+    q /= np.linalg.norm(q) or 1.0
+    with_vec = []
+    for d in items:
+        emb = d.pop("embedding", None)
+        if emb:
+            v = np.asarray(emb, dtype=np.float32)
+            cos = float(q @ v) / (float(np.linalg.norm(v)) or 1.0)
+            d["vector_score"] = float(to_vector_score(cos))
+            with_vec.append(d)
+    with_vec.sort(key=lambda d: d["vector_score"], reverse=True)
+    return with_vec[: max(1, limit)]
+
+
+def _retrieve_local(PROPS, index, qvec, filters, limit) -> List[dict]:
+    """Local-index equivalent of the $vectorSearch branch (same output shape)."""
+    if index.projection:
+        qvec = reduce_query(qvec)  # get_local_index checked the version
+    with span("vector.local_search"):
+        rows, sims = index.search(
+            qvec, k=max(1, limit), mask=index.mask(filters), nprobe=VECTOR_NPROBE
+        )
+    ids = [ObjectId(index.ids[r]) for r in rows]
+    scores = dict(zip(ids, to_vector_score(sims).tolist()))
+    with span("mongo.find"):
+        docs = {d["_id"]: d for d in PROPS.find({"_id": {"$in": ids}}, RAG_PROJECTION)}
+    out = []
+    for _id in ids:
+        if _id in docs:
+            docs[_id]["vector_score"] = scores[_id]
+            out.append(docs[_id])
+    return out
+
+
 # -----------------------------------------
 # Safe wrapper around your rec_core.build_match
 # -----------------------------------------
@@ -0,0 +1,136 @@
+# rec_client.py
+# What the Streamlit app talks to. With REC_SERVICE_URL set, every call is
+# a JSON request to service.py and the UI process holds no Mongo client,
+# models or indexes; otherwise recommender.py runs in-process.
+import json
+import os
+import urllib.error
+import urllib.request
+from functools import lru_cache
+from typing import Any, Dict, List
+
+REC_SERVICE_URL = os.getenv("REC_SERVICE_URL", "").rstrip("/")
+REC_SERVICE_TIMEOUT_SEC = float(os.getenv("REC_SERVICE_TIMEOUT_SEC", "30"))
+
+# "parse_source" of a search result
+PARSE_EMPTY = "empty"
+PARSE_LOCAL = "local"
+PARSE_VERTEX = "vertex"
+PARSE_LIMIT = "limit"  # the caller's Vertex budget is spent
+PARSE_FALLBACK = "fallback"  # Vertex failed; see "parse_error"
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+class RemoteRecommender:
+    def __init__(self, base_url: str, timeout: float = REC_SERVICE_TIMEOUT_SEC):
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Any:
+        req = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode("utf-8", "replace")
+            raise ServiceError(f"{path}: HTTP {e.code} {detail}") from e
+        except (urllib.error.URLError, TimeoutError) as e:
+            raise ServiceError(f"{path}: {e}") from e
+
+    def search(
+        self,
+        query: str,
+        sidebar: Dict[str, Any],
+        k: int = 12,
+        allow_vertex: bool = True,
+        warm_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        return self._post(
+            "/search",
+            {
+                "query": query,
+                "filters": sidebar,
+                "k": k,
+                "allow_vertex": allow_vertex,
+                "warm_embedding": warm_embedding,
+            },
+        )
+
+    def results_page(
+        self, filters: Dict[str, Any], offset: int, k: int = 12
+    ) -> Dict[str, Any]:
+        return self._post("/results", {"filters": filters, "offset": offset, "k": k})
+
+    def similar(self, seed_id: str, filters: Dict[str, Any]) -> List[dict]:
+        return self._post("/similar", {"seed_id": seed_id, "filters": filters})["items"]
+
+    def rag_candidates(
+        self, query: str, filters: Dict[str, Any], limit: int = 20
+    ) -> List[dict]:
+        return self._post(
+            "/rag/candidates", {"query": query, "filters": filters, "limit": limit}
+        )["items"]
+
+    def log_event(self, user_id: str, item_id: str, action: str) -> None:
+        self._post(
+            "/events", {"user_id": user_id, "item_id": str(item_id), "action": action}
+        )
+
+
+class LocalRecommender:
+    """Same interface, in-process (single-container deployments, development)."""
+
+    def __init__(self):
+        import recommender
+        from clients import warm_up_from_env
+        from db import get_collections
+        from parse_cache import warm_up_once
+
+        self._rec = recommender
+        self.props, self.events = get_collections()
+        warm_up_once()
+        warm_up_from_env()
+
+    def search(
+        self,
+        query: str,
+        sidebar: Dict[str, Any],
+        k: int = 12,
+        allow_vertex: bool = True,
+        warm_embedding: bool = False,
+    ) -> Dict[str, Any]:
+        return self._rec.search(
+            self.props, query, sidebar, k, allow_vertex, warm_embedding
+        )
+
+    def results_page(
+        self, filters: Dict[str, Any], offset: int, k: int = 12
+    ) -> Dict[str, Any]:
+        return self._rec.recommend(self.props, filters, k, offset)
+
+    def similar(self, seed_id: str, filters: Dict[str, Any]) -> List[dict]:
+        return self._rec.similar(self.props, seed_id, filters)
+
+    def rag_candidates(
+        self, query: str, filters: Dict[str, Any], limit: int = 20
+    ) -> List[dict]:
+        return self._rec.rag_candidates(self.props, query, filters, limit)
+
+    def log_event(self, user_id: str, item_id: str, action: str) -> None:
+        self._rec.log_event(self.events, user_id, item_id, action)
+
+
+@lru_cache(maxsize=1)
+def get_recommender():
+    if REC_SERVICE_URL:
+        print(f"[rec_client] using recommendation service at {REC_SERVICE_URL}")
+        return RemoteRecommender(REC_SERVICE_URL)
+    return LocalRecommender()
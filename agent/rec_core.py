@@ -1,5 +1,23 @@
+from __future__ import annotations
+
+import hashlib
+import json
 import re
-from typing import Any, Dict, List
+import unicodedata
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+# (filter key, flags.* field) pairs shared by build_match / score_item / reasons
+FLAG_KEYS = [
+    ("bal_ok", "balcony"),
+    ("south_ok", "south_facing"),
+    ("corner_ok", "corner"),
+    ("tower_ok", "tower_mansion"),
+    ("pet_ok", "pet_ok"),
+]
+# flags.* field -> bit in the columnar `flags` bitmask
+FLAG_BITS = {flag: 1 << i for i, (_, flag) in enumerate(FLAG_KEYS)}
 
 
 def build_match(filters: dict) -> dict:
@@ -48,6 +66,92 @@ def build_match(filters: dict) -> dict:
     return match if match["$and"] else {}
 
 
+# ---------------------------------------------------------
+# Columnar view of listings (for in-memory filtering/scoring)
+# ---------------------------------------------------------
+# Missing numeric values are NaN, like a missing field in Mongo: every
+# range comparison against them is False, so `match_mask` keeps the same
+# semantics as the query emitted by `build_match`.
+def columns_from_docs(docs: Iterable[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    price, walk, rooms, area, flags, address, station = [], [], [], [], [], [], []
+    for d in docs:
+        price.append(_num(d.get("price_yen")))
+        walk.append(_num(d.get("station_walk_minutes")))
+        rooms.append(_num(d.get("rooms")))
+        area.append(_num(d.get("area_sqm")))
+        fl = d.get("flags") or {}
+        flags.append(sum(bit for name, bit in FLAG_BITS.items() if fl.get(name)))
+        address.append(d.get("address") or "")
+        station.append(d.get("station_name") or "")
+    return {
+        "price_yen": np.asarray(price, dtype=np.float64),
+        "station_walk_minutes": np.asarray(walk, dtype=np.float64),
+        "rooms": np.asarray(rooms, dtype=np.float64),
+        "area_sqm": np.asarray(area, dtype=np.float64),
+        "flags": np.asarray(flags, dtype=np.uint8),
+        "address": np.asarray(address, dtype=object),
+        "station_name": np.asarray(station, dtype=object),
+    }
+
+
+def _num(v: Any) -> float:
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return np.nan
+    return float(v)
+
+
+def contains_any(values: np.ndarray, needles: List[str]) -> np.ndarray:
+    # Same as the case-insensitive, unanchored $regex used by build_match
+    needles = [n.lower() for n in needles]
+    return np.fromiter(
+        (any(n in v.lower() for n in needles) for v in values),
+        dtype=bool,
+        count=len(values),
+    )
+
+
+def match_mask(cols: Dict[str, np.ndarray], filters: dict) -> np.ndarray:
+    """Boolean row mask equivalent to `PROPS.find(build_match(filters))`."""
+    mask = numeric_match_mask(cols, filters)
+    if not filters:
+        return mask
+
+    # string filters last, only over rows that survived the numeric ones
+    if filters.get("wards"):
+        rows = np.flatnonzero(mask)
+        mask[rows] = contains_any(cols["address"][rows], filters["wards"])
+    if filters.get("station_name"):
+        rows = np.flatnonzero(mask)
+        mask[rows] = contains_any(cols["station_name"][rows], [filters["station_name"]])
+    return mask
+
+
+def numeric_match_mask(cols: Dict[str, np.ndarray], filters: dict) -> np.ndarray:
+    """match_mask without the wards/station_name (regex) conditions."""
+    n = len(cols["price_yen"])
+    mask = np.ones(n, dtype=bool)
+    if not filters:
+        return mask
+
+    with np.errstate(invalid="ignore"):
+        if filters.get("budget_max") is not None:
+            mask &= cols["price_yen"] <= filters["budget_max"]
+        if filters.get("walk_max") is not None:
+            mask &= cols["station_walk_minutes"] <= filters["walk_max"]
+        if filters.get("min_rooms") and filters["min_rooms"] > 0:
+            mask &= cols["rooms"] >= filters["min_rooms"]
+        if filters.get("min_area_sqm") is not None:
+            mask &= cols["area_sqm"] >= filters["min_area_sqm"]
+
+    bits = 0
+    for key, flag in FLAG_KEYS:
+        if filters.get(key):
+            bits |= FLAG_BITS[flag]
+    if bits:
+        mask &= (cols["flags"] & bits) == bits
+    return mask
+
+
 def score_item(it: Dict[str, Any], f: Dict[str, Any]) -> float:
     price = it.get("price_yen") or 10**12
     budget = f.get("budget_max") or price
@@ -59,22 +163,185 @@ def score_item(it: Dict[str, Any], f: Dict[str, Any]) -> float:
     areaScore = (area / f.get("min_area_sqm", area)) if f.get("min_area_sqm") else 0
 
     # feature score based on individual flags
-    flag_keys = [
-        ("bal_ok", "balcony"),
-        ("south_ok", "south_facing"),
-        ("corner_ok", "corner"),
-        ("tower_ok", "tower_mansion"),
-        ("pet_ok", "pet_ok"),
-    ]
-    required = [k for k, _ in flag_keys if f.get(k)]
+    required = [k for k, _ in FLAG_KEYS if f.get(k)]
     matched = sum(
-        1 for key, flag in flag_keys if f.get(key) and it.get("flags", {}).get(flag)
+        1 for key, flag in FLAG_KEYS if f.get(key) and it.get("flags", {}).get(flag)
     )
     featScore = (matched / len(required)) if required else 0
 
     return 0.45 * affordability + 0.25 * walkScore + 0.20 * areaScore + 0.10 * featScore
 
 
+def score_batch(cols: Dict[str, np.ndarray], f: Dict[str, Any]) -> np.ndarray:
+    """
+    Vectorized score_item over columnar arrays (see columns_from_docs).
+    Gives the same value as score_item for every row.
+    """
+    n = len(cols["price_yen"])
+    # score_item treats missing *and* 0 as "unknown" (`x or default`)
+    price = _or_default(cols["price_yen"], 10**12)
+    walk = _or_default(cols["station_walk_minutes"], 999)
+    area = _or_default(cols["area_sqm"], 0.0)
+
+    score = np.zeros(n, dtype=np.float64)
+    if f.get("budget_max"):
+        budget = f["budget_max"]
+        score += 0.45 * np.clip((budget - price) / max(budget, 1), 0, 1)
+    # without a budget, budget == price and affordability is always 0
+    if f.get("walk_max"):
+        score += 0.25 * (1 - np.minimum(1, walk / f["walk_max"]))
+    if f.get("min_area_sqm"):
+        score += 0.20 * (area / f["min_area_sqm"])
+
+    required = [flag for key, flag in FLAG_KEYS if f.get(key)]
+    if required:
+        matched = np.zeros(n, dtype=np.float64)
+        for flag in required:
+            matched += (cols["flags"] & FLAG_BITS[flag]) != 0
+        score += 0.10 * (matched / len(required))
+    return score
+
+
+def _or_default(a: np.ndarray, default: float) -> np.ndarray:
+    return np.where(np.isnan(a) | (a == 0), default, a)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k best scores, best first. Ties keep input order, exactly
+    like a stable `sort(reverse=True)[:k]`, without sorting every row.
+    """
+    n = len(scores)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    kth = np.partition(scores, n - k)[n - k]  # k-th largest
+    above = np.flatnonzero(scores > kth)
+    ties = np.flatnonzero(scores == kth)[: k - len(above)]
+    idx = np.sort(np.concatenate([above, ties]))
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def rank_unique_names(
+    scores: np.ndarray, name_codes: np.ndarray, tiebreak: np.ndarray, k: int
+) -> np.ndarray:
+    """
+    Positions of the top k rows keeping only the best row per name, ordered by
+    score desc then `tiebreak` asc (the ranking of build_recommend_pipeline).
+    Rows with a negative name code (no name) are never merged.
+    """
+    order = np.lexsort((tiebreak, -scores))
+    named = name_codes[order] >= 0
+    _, first = np.unique(name_codes[order][named], return_index=True)
+    keep = np.concatenate([np.flatnonzero(named)[first], np.flatnonzero(~named)])
+    return order[np.sort(keep)][:k]
+
+
+# ---------------------------------------------------------
+# score_item as an aggregation expression (server-side ranking)
+# ---------------------------------------------------------
+# Fields needed to render a card and to build its reasons
+RECOMMEND_PROJECTION = {
+    "name": 1,
+    "address": 1,
+    "image": 1,
+    "url": 1,
+    "price_yen": 1,
+    "area_sqm": 1,
+    "rooms": 1,
+    "ldk": 1,
+    "layout_raw": 1,
+    "size": 1,
+    "station_name": 1,
+    "station_walk_minutes": 1,
+    "flags": 1,
+}
+# Matches scored per search ($limit before ranking)
+CANDIDATE_LIMIT = 1000
+
+
+def _field_or(field: str, default: float) -> dict:
+    # `doc.get(field) or default` for numeric fields
+    return {
+        "$let": {
+            "vars": {"v": {"$ifNull": [f"${field}", 0]}},
+            "in": {"$cond": [{"$eq": ["$$v", 0]}, default, "$$v"]},
+        }
+    }
+
+
+def score_expr(f: Dict[str, Any]) -> Any:
+    """
+    score_item(it, f) as an aggregation expression. Terms that are constant
+    for the given filters (e.g. no budget -> affordability 0) are dropped.
+    """
+    terms = []
+    if f.get("budget_max"):
+        budget = f["budget_max"]
+        ratio = {
+            "$divide": [
+                {"$subtract": [budget, _field_or("price_yen", 10**12)]},
+                max(budget, 1),
+            ]
+        }
+        terms.append({"$multiply": [0.45, {"$max": [0, {"$min": [1, ratio]}]}]})
+    if f.get("walk_max"):
+        walk = {"$divide": [_field_or("station_walk_minutes", 999), f["walk_max"]]}
+        terms.append({"$multiply": [0.25, {"$subtract": [1, {"$min": [1, walk]}]}]})
+    if f.get("min_area_sqm"):
+        area = {"$divide": [{"$ifNull": ["$area_sqm", 0.0]}, f["min_area_sqm"]]}
+        terms.append({"$multiply": [0.20, area]})
+
+    required = [flag for key, flag in FLAG_KEYS if f.get(key)]
+    if required:
+        matched = {"$add": [{"$cond": [f"$flags.{flag}", 1, 0]} for flag in required]}
+        terms.append({"$multiply": [0.10, {"$divide": [matched, len(required)]}]})
+
+    if not terms:
+        return {"$literal": 0.0}
+    return {"$add": terms}
+
+
+def build_recommend_pipeline(
+    filters: Dict[str, Any],
+    limit: int = 12,
+    candidate_limit: int | None = CANDIDATE_LIMIT,
+) -> List[dict]:
+    """
+    build_match + score + dedup-by-name + top-K in one aggregation, so only
+    the final `limit` lean rows leave the server. Per name, the best scoring
+    listing is kept; listings without a name are never merged.
+    """
+    pipeline: List[dict] = []
+    match = build_match(filters)
+    if match:
+        pipeline.append({"$match": match})
+    if candidate_limit:
+        pipeline.append({"$limit": candidate_limit})
+    pipeline += [
+        {"$project": RECOMMEND_PROJECTION},
+        {"$addFields": {"_score": score_expr(filters)}},
+        {"$sort": {"_score": -1, "_id": 1}},
+        {
+            "$group": {
+                "_id": {
+                    "$cond": [
+                        {"$eq": [{"$ifNull": ["$name", ""]}, ""]},
+                        "$_id",
+                        "$name",
+                    ]
+                },
+                "doc": {"$first": "$$ROOT"},
+            }
+        },
+        {"$replaceRoot": {"newRoot": "$doc"}},
+        {"$sort": {"_score": -1, "_id": 1}},
+        {"$limit": limit},
+    ]
+    return pipeline
+
+
 def reasons(it: Dict[str, Any], f: Dict[str, Any]) -> List[str]:
     r = []
     if f.get("wards") and any(w in it.get("address", "") for w in f["wards"]):
@@ -112,6 +379,33 @@ def reasons(it: Dict[str, Any], f: Dict[str, Any]) -> List[str]:
     return r
 
 
+def normalize_query(q: str) -> str:
+    """NFKC + collapsed whitespace: 全角/半角 variants of a query share one key."""
+    return " ".join(unicodedata.normalize("NFKC", q).split())
+
+
+# build_match tests these with `in`, so even a falsy value filters
+_PRESENCE_KEYS = ("budget_max", "walk_max", "min_area_sqm")
+
+
+def filter_fingerprint(filters: Dict[str, Any]) -> str:
+    """
+    Stable key for a filter set: filters that select and rank the same
+    listings (ward order, duplicate wards, unset flags, 10 vs 10.0) share it.
+    """
+    canon: Dict[str, Any] = {}
+    for k, v in filters.items():
+        if k not in _PRESENCE_KEYS and (v is None or v is False or v in ("", [])):
+            continue  # tested for truthiness everywhere: same as unset
+        if k == "wards":
+            v = sorted(set(v))
+        elif isinstance(v, float) and v.is_integer():
+            v = int(v)
+        canon[k] = v
+    raw = json.dumps(canon, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+
+
 # Fallback regex-based JP → filters (used only if Vertex fails/disabled)
 WARD_LIST = [
     "千代田区",
@@ -141,53 +435,11 @@ WARD_LIST = [
 
 
 def fallback_parse_query_to_filters(q: str) -> Dict[str, Any]:
-    f: Dict[str, Any] = {}
-    # normalize input a bit
-    qn = q.replace(",", "").replace("，", "").strip()
-
-    # ---- budget: “1.2億”, “6000万”, “6,000万円”など ----
-    m = re.search(r"(\d+(?:\.\d+)?)\s*億", qn)
-    if m:
-        f["budget_max"] = int(float(m.group(1)) * 100_000_000)
-    m = re.search(r"(\d{3,6}(?:\.\d+)?)\s*万", qn)  # 万 or 万円
-    if m and "budget_max" not in f:
-        f["budget_max"] = int(float(m.group(1)) * 10_000)
-
-    # ---- walk: “徒歩10分”, “徒歩10分以内” ----
-    m = re.search(r"徒歩\s*(\d{1,2})\s*分", qn)
-    if m:
-        f["walk_max"] = int(m.group(1))
-
-    # ---- pets ----
-    if "ペット" in q:
-        f["pet_ok"] = True
-
-    # ---- rooms: 1LDK/２LDK/３ＬＤＫ etc. (full/half width) ----
-    # check 3, then 2, then 1 to capture "以上"ニュアンス
-    for n in [3, 2, 1]:
-        if re.search(rf"[{n}１２３]LDK|[{n}１２３]ＬＤＫ", qn):
-            f["min_rooms"] = max(n, f.get("min_rooms", 0))
-            break
-
-    # ---- area: “45㎡”, “45m2” ----
-    m = re.search(r"(?:([0-9]{2,3})\s*㎡|([0-9]{2,3})\s*m2)", qn, re.IGNORECASE)
-    if m:
-        val = int(next(g for g in m.groups() if g))
-        f["min_area_sqm"] = val
-
-    # ---- wards ----
-    f["wards"] = [w for w in WARD_LIST if w in q]
-
-    # ---- feature flags (no more must_have) ----
-    if "南向き" in q:
-        f["south_ok"] = True
-    if "角部屋" in q:
-        f["corner_ok"] = True
-    if "バルコニー" in q:
-        f["bal_ok"] = True
-    if ("タワマン" in q) or ("タワーマンション" in q):
-        f["tower_ok"] = True
+    # local_nlu imports WARD_LIST from here, hence the local import
+    from local_nlu import local_parse
 
+    f, _ = local_parse(q)
+    f.setdefault("wards", [])
     return f
 
 
@@ -0,0 +1,381 @@
+# recommender.py
+# Recommendation logic with no UI: NLU parse, search, similar listings and
+# RAG candidates over the listing collection. The Streamlit app calls it
+# in-process (rec_client.LocalRecommender) or through service.py.
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from listing_snapshot import get_snapshot
+from local_nlu import local_parse
+from metrics import inc, span, traced
+from parse_cache import BACKEND_ERRORS, get_shared_parse_cache, log_query
+from rec_client import (
+    PARSE_EMPTY,
+    PARSE_FALLBACK,
+    PARSE_LIMIT,
+    PARSE_LOCAL,
+    PARSE_VERTEX,
+)
+from rec_core import (
+    RECOMMEND_PROJECTION,
+    build_match,
+    build_recommend_pipeline,
+    columns_from_docs,
+    combined_text,
+    fallback_parse_query_to_filters,
+    filter_fingerprint,
+    reasons,
+    score_batch,
+)
+from search_pipeline import run_search
+from similar_vector import similar_items_by_vector
+from tfidf_index import get_tfidf_index
+from ttl_cache import TTLCache
+from vertex_guard import cached_ttl_parse, parse_cache_stats
+
+# Share of the query the local parser must explain to skip Gemini
+LOCAL_NLU_MIN_COVERAGE = float(os.getenv("LOCAL_NLU_MIN_COVERAGE", "1.0"))
+# Ranked rows kept per filter set (the ranking itself looks at <= 1000)
+RESULT_SET_LIMIT = int(os.getenv("RESULT_SET_LIMIT", "1000"))
+
+
+@traced("parse")
+def parse_query(
+    q: str, allow_vertex: bool = True
+) -> Tuple[Dict[str, Any], str, Optional[str]]:
+    """(filters, source, error); source is one of the PARSE_* constants."""
+    if not q.strip():
+        print("Empty query received for parsing.")
+        return {}, PARSE_EMPTY, None
+    log_query(q)
+    # Simple queries are fully explained locally: no Gemini round trip
+    local, coverage = local_parse(q)
+    if local and coverage >= LOCAL_NLU_MIN_COVERAGE:
+        inc("parse.local")
+        return local, PARSE_LOCAL, None
+    if not allow_vertex:
+        inc("parse.fallback")
+        return fallback_parse_query_to_filters(q), PARSE_LIMIT, None
+    try:
+        out = cached_ttl_parse(q, ttl_sec=600)
+        inc("parse.vertex")
+        return out, PARSE_VERTEX, None
+    except Exception as e:
+        inc("parse.fallback")
+        return fallback_parse_query_to_filters(q), PARSE_FALLBACK, str(e)
+
+
+def merge_filters(parsed: Dict[str, Any], sidebar: Dict[str, Any]) -> Dict[str, Any]:
+    # sidebar overrides; copy so a cached parse result is never mutated
+    f = dict(parsed)
+    for key, v in sidebar.items():
+        if key == "wards":
+            f["wards"] = [*f.get("wards", []), *v]
+        elif key in ("budget_max", "walk_max") and key in f:
+            f[key] = min(f[key], v)
+        elif key in ("min_rooms", "min_area_sqm") and key in f:
+            f[key] = max(f[key], v)
+        else:
+            f[key] = v
+    return f
+
+
+# ---------------------------------------------------------
+# Ranked result sets: ranked once per filter fingerprint, then paged
+# ---------------------------------------------------------
+class RankedResults:
+    """
+    Full ranking for one filter set: ids and scores in rank order, plus the
+    lean docs fetched so far (all of them unless ranked from the snapshot).
+    """
+
+    __slots__ = ("ids", "scores", "docs")
+
+    def __init__(self, ids: List[ObjectId], scores: List[float], docs: Dict):
+        self.ids = ids
+        self.scores = scores
+        self.docs = docs
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_docs(cls, docs: List[dict]) -> "RankedResults":
+        return cls(
+            [d["_id"] for d in docs],
+            [d["_score"] for d in docs],
+            {d["_id"]: d for d in docs},
+        )
+
+
+RESULT_CACHE_TTL_SEC = float(os.getenv("RESULT_CACHE_TTL_SEC", "300"))
+# per process; rankings are also shared through parse_cache's backend so the
+# other service workers (and replicas, with Redis) page the same result set
+RESULT_CACHE = TTLCache(
+    maxsize=int(os.getenv("RESULT_CACHE_SIZE", "256")), ttl=RESULT_CACHE_TTL_SEC
+)
+
+
+def _load_shared(fingerprint: str) -> Optional[RankedResults]:
+    backend = get_shared_parse_cache()
+    if backend is None:
+        return None
+    try:
+        (v,) = backend.get_many([f"rank:{fingerprint}"])
+    except BACKEND_ERRORS as e:
+        print(f"[results] shared cache read failed: {e}")
+        return None
+    if v is None:
+        return None
+    return RankedResults([ObjectId(i) for i in v["ids"]], v["scores"], {})
+
+
+def _store_shared(fingerprint: str, ranked: RankedResults) -> None:
+    backend = get_shared_parse_cache()
+    if backend is None:
+        return
+    value = {"ids": [str(i) for i in ranked.ids], "scores": ranked.scores}
+    try:
+        backend.set_many(
+            {f"rank:{fingerprint}": value}, ttl=max(1, int(RESULT_CACHE_TTL_SEC))
+        )
+    except BACKEND_ERRORS as e:
+        print(f"[results] shared cache write failed: {e}")
+
+
+def _rank_all(PROPS, filters: Dict[str, Any]) -> RankedResults:
+    snap = get_snapshot()
+    if snap is not None:
+        # Filter + score in memory; docs are fetched page by page
+        ranked = snap.recommend(filters, k=RESULT_SET_LIMIT)
+        return RankedResults([o for o, _ in ranked], [s for _, s in ranked], {})
+    # Dedup, scoring and ranking run inside MongoDB; only lean rows come back
+    with span("mongo.aggregate"):
+        docs = list(
+            PROPS.aggregate(build_recommend_pipeline(filters, limit=RESULT_SET_LIMIT))
+        )
+    return RankedResults.from_docs(docs)
+
+
+def ranked_results(PROPS, filters: Dict[str, Any]) -> RankedResults:
+    fingerprint = filter_fingerprint(filters)
+
+    def compute() -> RankedResults:
+        ranked = _load_shared(fingerprint)
+        if ranked is None:
+            ranked = _rank_all(PROPS, filters)
+            _store_shared(fingerprint, ranked)
+        return ranked
+
+    return RESULT_CACHE.get_or_compute(fingerprint, compute)
+
+
+def results_page(
+    PROPS, filters: Dict[str, Any], ranked: RankedResults, offset: int, k: int
+) -> List[dict]:
+    """Rows [offset, offset + k) with _score and _reasons for these filters."""
+    ids = ranked.ids[offset : offset + k]
+    missing = [oid for oid in ids if oid not in ranked.docs]
+    if missing:
+        with span("mongo.find"):
+            for d in PROPS.find({"_id": {"$in": missing}}, RECOMMEND_PROJECTION):
+                ranked.docs[d["_id"]] = d
+    items = []
+    for oid, score in zip(ids, ranked.scores[offset : offset + k]):
+        d = ranked.docs.get(oid)
+        if d is None:
+            continue  # deleted since it was ranked
+        # copies: the cached docs are shared between requests
+        it = {**d, "_score": score}
+        it["_reasons"] = reasons(it, filters)
+        items.append(it)
+    return items
+
+
+@traced("recommend")
+def recommend(
+    PROPS, filters: Dict[str, Any], k: int = 12, offset: int = 0
+) -> Dict[str, Any]:
+    """One page of the (cached) ranking: {"items", "total", "offset", "fingerprint"}."""
+    ranked = ranked_results(PROPS, filters)
+    return {
+        "items": results_page(PROPS, filters, ranked, offset, k),
+        "total": len(ranked),
+        "offset": offset,
+        "fingerprint": filter_fingerprint(filters),
+    }
+
+
+@traced("search")
+def search(
+    PROPS,
+    query: str,
+    sidebar: Dict[str, Any],
+    k: int = 12,
+    allow_vertex: bool = True,
+    warm_embedding: bool = False,
+) -> Dict[str, Any]:
+    """
+    Parse + merge + rank. Returns {"parsed", "filters", "items", "total",
+    "offset", "fingerprint", "timings", "parse_source", "parse_error"};
+    later pages come from recommend(filters, offset=...).
+    """
+    parse_info: Dict[str, Any] = {"parse_source": PARSE_EMPTY, "parse_error": None}
+
+    def parse(q: str) -> Dict[str, Any]:
+        parsed, parse_info["parse_source"], parse_info["parse_error"] = parse_query(
+            q, allow_vertex
+        )
+        return parsed
+
+    was_cached = {"ranked": False}
+
+    def cached(filters: Dict[str, Any]) -> Optional[RankedResults]:
+        fingerprint = filter_fingerprint(filters)
+        hit, ranked = RESULT_CACHE.get(fingerprint)
+        ranked = ranked if hit else _load_shared(fingerprint)
+        was_cached["ranked"] = ranked is not None
+        return ranked
+
+    # Gemini parse runs here while the candidate prefetch (and the query
+    # embedding, when RAG is on) run on worker threads; a cached ranking
+    # for the parsed filters skips ranking altogether
+    res = run_search(
+        PROPS,
+        query,
+        parse,
+        lambda parsed: merge_filters(parsed, sidebar),
+        sidebar,
+        lambda filters: _rank_all(PROPS, filters),
+        k=RESULT_SET_LIMIT,
+        warm_embedding=warm_embedding,
+        use_prefetch=get_snapshot() is None,
+        cached_fn=cached,
+        with_reasons=False,
+    )
+    filters, ranked = res["filters"], res["items"]
+    if not isinstance(ranked, RankedResults):
+        ranked = RankedResults.from_docs(ranked)  # ranked from the prefetch
+    fingerprint = filter_fingerprint(filters)
+    RESULT_CACHE.set(fingerprint, ranked)
+    if not was_cached["ranked"]:
+        _store_shared(fingerprint, ranked)
+    res.update(parse_info)
+    res.update(
+        items=results_page(PROPS, filters, ranked, 0, k),
+        total=len(ranked),
+        offset=0,
+        fingerprint=fingerprint,
+    )
+    print(f"Search timings: {res['timings']}, NLU cache: {parse_cache_stats()}")
+    return res
+
+
+SIMILAR_CARD_PROJECTION = {
+    "_id": 1,
+    "name": 1,
+    "image": 1,
+    "url": 1,
+    "description": 1,
+    "address": 1,
+    "flags": 1,
+    "price_yen": 1,
+    "area_sqm": 1,
+    "rooms": 1,
+    "layout_raw": 1,
+    "size": 1,
+    "station_name": 1,
+    "station_walk_minutes": 1,
+    "station_line": 1,
+}
+
+
+@traced("similar")
+def similar(PROPS, seed_id: str, filters: Dict[str, Any]) -> List[dict]:
+    # 1) try vector search
+    vec = similar_items_by_vector(PROPS, seed_id, filters)
+    if vec:
+        return vec
+    # 2) fallback to TF-IDF
+    return similar_by_tfidf(PROPS, seed_id, filters)
+
+
+def similar_by_tfidf(PROPS, seed_id: str, filters: Dict[str, Any]) -> List[dict]:
+    # Precomputed TF-IDF: one sparse product over the filtered rows
+    index = get_tfidf_index()
+    ranked = index.similar(seed_id, filters, k=9) if index is not None else None
+    if ranked is not None:
+        ids = [ObjectId(oid) for oid, _ in ranked]
+        with span("mongo.find"):
+            docs = {
+                d["_id"]: d
+                for d in PROPS.find({"_id": {"$in": ids}}, SIMILAR_CARD_PROJECTION)
+            }
+        top = [docs[_id] for _id in ids if _id in docs]
+        for it in top:
+            it["_reasons"] = ["似ている説明/設備/駅情報（類似検索）"]
+        return top
+
+    # Seed not indexed yet (or no index built): fit on a small candidate set
+    seed = PROPS.find_one(
+        {"_id": ObjectId(seed_id)},
+        {
+            "name": 1,
+            "description": 1,
+            "address": 1,
+            "flags": 1,
+            "station_line": 1,
+            "station_name": 1,
+        },
+    )
+    if not seed:
+        return []
+    match = build_match(filters)
+    with span("mongo.find"):
+        cands = list(PROPS.find(match, SIMILAR_CARD_PROJECTION).limit(400))
+    from bm25_index import char_ngrams
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    texts = [combined_text(seed)] + [combined_text(c) for c in cands]
+    tf = TfidfVectorizer(analyzer=char_ngrams, min_df=2).fit_transform(texts)
+    sims = cosine_similarity(tf[0:1], tf[1:]).ravel()
+    paired = list(zip(cands, sims))
+    paired.sort(key=lambda x: x[1], reverse=True)
+    top = [p[0] for p in paired[:9]]
+    for it in top:
+        it["_reasons"] = ["似ている説明/設備/駅情報（類似検索）"]
+    return top
+
+
+@traced("rag_candidates")
+def rag_candidates(
+    PROPS, query: str, filters: Dict[str, Any], limit: int = 20
+) -> List[dict]:
+    """Semantic retrieval re-ranked with the business score, best first."""
+    from rag_retrieval import retrieve_semantic
+
+    sem_items = retrieve_semantic(PROPS, query, filters, k=300, limit=limit)
+    print(f"RAG retrieved {len(sem_items)} items.")
+    biz = score_batch(columns_from_docs(sem_items), filters)
+    for it, b in zip(sem_items, biz.tolist()):
+        # fused rank score when BM25 is on; lexical-only hits have no vector score
+        relevance = it.get("rrf_score", it.get("vector_score") or 0.0)
+        it["_score"] = 0.55 * relevance + 0.45 * b
+    sem_items.sort(key=lambda x: x["_score"], reverse=True)
+    for it in sem_items[:12]:
+        it["_reasons"] = reasons(it, filters)
+    return sem_items
+
+
+def log_event(EVENTS, user_id: str, item_id: str, action: str) -> None:
+    EVENTS.insert_one(
+        {
+            "user_id": user_id,
+            "item_id": str(item_id),
+            "action": action,
+            "ts": time.time(),
+        }
+    )
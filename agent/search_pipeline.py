@@ -0,0 +1,161 @@
+# search_pipeline.py
+# Concurrent search: NLU parse, query embedding and a broad Mongo prefetch
+# start together; once the parsed filters arrive the prefetched candidates
+# are narrowed and ranked in memory. Latency ~ the slowest call, not the sum.
+#
+#   parse (Gemini, caller thread) ──┐
+#   embed_query (warms its cache) ──┤── merge filters ── narrow + rank prefetched
+#   prefetch(sidebar filters) ──────┘
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from metrics import span
+from rec_core import (
+    CANDIDATE_LIMIT,
+    RECOMMEND_PROJECTION,
+    build_match,
+    columns_from_docs,
+    match_mask,
+    rank_unique_names,
+    reasons,
+    score_batch,
+)
+
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+# Above this many broad candidates, rank with the aggregation instead. Every
+# prefetched row crosses the wire while the aggregation returns only k, so
+# the limit stays near its candidate window; a cut prefetch is thrown away.
+PREFETCH_LIMIT = int(os.getenv("SEARCH_PREFETCH_LIMIT", str(CANDIDATE_LIMIT)))
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+
+def prefetch_filters(sidebar: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The part of the sidebar filters that the merged filters always imply
+    (the parse can only tighten ranges/flags). Wards are unioned with the
+    parsed wards, so they cannot narrow the prefetch.
+    """
+    return {k: v for k, v in sidebar.items() if k != "wards"}
+
+
+def prefetch(PROPS, filters: Dict[str, Any], limit: int = PREFETCH_LIMIT) -> List[dict]:
+    # limit + 1 so the caller can tell a complete candidate set from a cut one
+    with span("mongo.find"):
+        return list(
+            PROPS.find(build_match(filters), RECOMMEND_PROJECTION).limit(limit + 1)
+        )
+
+
+def rank_candidates(
+    docs: List[dict],
+    filters: Dict[str, Any],
+    k: int = 12,
+    candidate_limit: int = CANDIDATE_LIMIT,
+    with_reasons: bool = True,
+) -> List[dict]:
+    """
+    build_recommend_pipeline evaluated over already fetched docs: first
+    `candidate_limit` matches in natural order, best listing per name, top k.
+    """
+    if not docs:
+        return []
+    cols = columns_from_docs(docs)
+    rows = np.flatnonzero(match_mask(cols, filters))[:candidate_limit]
+    if not len(rows):
+        return []
+    scores = score_batch({c: v[rows] for c, v in cols.items()}, filters)
+    name_of: Dict[str, int] = {}
+    names = np.asarray(
+        [
+            name_of.setdefault(n, len(name_of)) if (n := docs[r].get("name")) else -1
+            for r in rows
+        ]
+    )
+    oids = np.asarray([docs[r]["_id"].binary for r in rows], dtype="S12")
+    out = []
+    for i in rank_unique_names(scores, names, oids, k):
+        it = docs[rows[i]]
+        it["_score"] = float(scores[i])
+        if with_reasons:
+            it["_reasons"] = reasons(it, filters)
+        out.append(it)
+    return out
+
+
+def run_search(
+    PROPS,
+    query: str,
+    parse_fn: Callable[[str], Dict[str, Any]],
+    merge_fn: Callable[[Dict[str, Any]], Dict[str, Any]],
+    sidebar: Dict[str, Any],
+    recommend_fn: Callable[[Dict[str, Any]], List[dict]],
+    k: int = 12,
+    warm_embedding: bool = False,
+    use_prefetch: bool = True,
+    cached_fn: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    with_reasons: bool = True,
+) -> Dict[str, Any]:
+    """
+    Returns {"parsed", "filters", "items", "timings"}.
+
+    The prefetch (and optional query embedding) run on worker threads while
+    parse_fn runs on the calling thread, so parse_fn may use Streamlit state.
+    recommend_fn ranks with the final filters when the prefetch cannot.
+    A non-None cached_fn(filters) is returned as "items" without ranking.
+    """
+    t0 = time.perf_counter()
+    timings: Dict[str, float] = {}
+
+    def timed(name, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    prefetch_fut = None
+    if use_prefetch:
+        # copy_context: worker spans join the caller's trace
+        prefetch_fut = _EXECUTOR.submit(
+            contextvars.copy_context().run,
+            timed,
+            "prefetch",
+            prefetch,
+            PROPS,
+            prefetch_filters(sidebar),
+        )
+    if warm_embedding and query.strip():
+        # fills rag_retrieval's query-vector cache for the RAG step; not awaited
+        from rag_retrieval import embed_query
+
+        _EXECUTOR.submit(
+            contextvars.copy_context().run, timed, "embed", embed_query, query
+        )
+
+    parsed = timed("parse", parse_fn, query) if query.strip() else {}
+    filters = merge_fn(parsed)
+
+    items: Any = cached_fn(filters) if cached_fn is not None else None
+    if items is not None:
+        if prefetch_fut is not None:
+            prefetch_fut.cancel()  # no-op if already running
+    elif prefetch_fut is not None:
+        docs = prefetch_fut.result()
+        if len(docs) <= PREFETCH_LIMIT:
+            with span("score"):
+                items = timed(
+                    "rank",
+                    lambda: rank_candidates(
+                        docs, filters, k, with_reasons=with_reasons
+                    ),
+                )
+    if items is None:
+        items = timed("recommend", recommend_fn, filters)
+
+    timings["total"] = time.perf_counter() - t0
+    return {"parsed": parsed, "filters": filters, "items": items, "timings": timings}
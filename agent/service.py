@@ -0,0 +1,276 @@
+# service.py
+# Headless recommendation service (ASGI, JSON in / JSON out).
+#
+#   uv run uvicorn service:app --host 0.0.0.0 --port 8081 --workers 4
+#
+#   GET  /healthz
+#   GET  /metrics        Prometheus text of the worker that answers
+#   POST /search         {"query", "filters"?, "k"?, "allow_vertex"?, "warm_embedding"?}
+#   POST /search/batch   {"searches": [<search body>, ...]}
+#   POST /results        {"filters", "offset"?, "k"?}   a page of a search
+#   POST /similar        {"seed_id", "filters"?}
+#   POST /rag/candidates {"query", "filters"?, "limit"?}
+#   POST /events         {"user_id", "item_id", "action"}
+#
+# "filters" are the sidebar conditions (same keys as parsed filters). The
+# handlers block on Mongo/Vertex, so they run on a thread pool; batch
+# searches run concurrently on that pool.
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict
+
+import numpy as np
+import recommender
+from bson import ObjectId
+from clients import warm_up_from_env
+from db import get_collections
+from metrics import REGISTRY, span
+from parse_cache import warm_up_once
+
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "16"))
+SERVICE_MAX_BATCH = int(os.getenv("SERVICE_MAX_BATCH", "16"))
+MAX_BODY_BYTES = 1 << 20
+
+# request handlers; batch items get their own pool so a batch request never
+# waits on a worker that is itself waiting on the batch
+_EXECUTOR = ThreadPoolExecutor(max_workers=SERVICE_WORKERS, thread_name_prefix="svc")
+_BATCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=SERVICE_WORKERS, thread_name_prefix="svc-batch"
+)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the request body was read."""
+
+
+def _json_default(o: Any):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"not JSON serializable: {type(o).__name__}")
+
+
+def _dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, default=_json_default).encode("utf-8")
+
+
+def _field(body: Dict[str, Any], name: str, typ: type, default: Any = ...) -> Any:
+    if name not in body:
+        if default is ...:
+            raise BadRequest(f"missing field: {name}")
+        return default
+    v = body[name]
+    if typ is float and isinstance(v, int) and not isinstance(v, bool):
+        v = float(v)
+    if not isinstance(v, typ) or (typ is int and isinstance(v, bool)):
+        raise BadRequest(f"{name}: expected {typ.__name__}")
+    return v
+
+
+# ---------------------------------------------------------
+# Handlers (blocking; run on the executor)
+# ---------------------------------------------------------
+def handle_search(body: Dict[str, Any]) -> Dict[str, Any]:
+    k = _field(body, "k", int, 12)
+    if not 1 <= k <= 100:
+        raise BadRequest("k: must be in 1..100")
+    PROPS = get_collections()[0]
+    with span("service.search"):
+        return recommender.search(
+            PROPS,
+            _field(body, "query", str),
+            _field(body, "filters", dict, {}),
+            k=k,
+            allow_vertex=_field(body, "allow_vertex", bool, True),
+            warm_embedding=_field(body, "warm_embedding", bool, False),
+        )
+
+
+def handle_results(body: Dict[str, Any]) -> Dict[str, Any]:
+    k = _field(body, "k", int, 12)
+    offset = _field(body, "offset", int, 0)
+    if not 1 <= k <= 100 or offset < 0:
+        raise BadRequest("k: must be in 1..100, offset: >= 0")
+    PROPS = get_collections()[0]
+    with span("service.results"):
+        return recommender.recommend(
+            PROPS, _field(body, "filters", dict), k=k, offset=offset
+        )
+
+
+def handle_search_batch(body: Dict[str, Any]) -> Dict[str, Any]:
+    searches = _field(body, "searches", list)
+    if len(searches) > SERVICE_MAX_BATCH:
+        raise BadRequest(f"searches: at most {SERVICE_MAX_BATCH} per request")
+    if not all(isinstance(s, dict) for s in searches):
+        raise BadRequest("searches: expected a list of objects")
+
+    def one(s: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return handle_search(s)
+        except BadRequest as e:
+            return {"error": str(e)}
+        except Exception as e:
+            print(f"[service] batch search failed: {e}")
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    with span("service.search_batch"):
+        return {"results": list(_BATCH_EXECUTOR.map(one, searches))}
+
+
+def handle_similar(body: Dict[str, Any]) -> Dict[str, Any]:
+    seed_id = _field(body, "seed_id", str)
+    if not ObjectId.is_valid(seed_id):
+        raise BadRequest("seed_id: not an ObjectId")
+    PROPS = get_collections()[0]
+    with span("service.similar"):
+        items = recommender.similar(PROPS, seed_id, _field(body, "filters", dict, {}))
+    return {"items": items}
+
+
+def handle_rag_candidates(body: Dict[str, Any]) -> Dict[str, Any]:
+    limit = _field(body, "limit", int, 20)
+    if not 1 <= limit <= 100:
+        raise BadRequest("limit: must be in 1..100")
+    PROPS = get_collections()[0]
+    with span("service.rag_candidates"):
+        items = recommender.rag_candidates(
+            PROPS, _field(body, "query", str), _field(body, "filters", dict, {}), limit
+        )
+    return {"items": items}
+
+
+def handle_event(body: Dict[str, Any]) -> Dict[str, Any]:
+    recommender.log_event(
+        get_collections()[1],
+        _field(body, "user_id", str),
+        _field(body, "item_id", str),
+        _field(body, "action", str),
+    )
+    return {"ok": True}
+
+
+ROUTES: Dict[tuple, Callable[[Dict[str, Any]], Any]] = {
+    ("POST", "/search"): handle_search,
+    ("POST", "/search/batch"): handle_search_batch,
+    ("POST", "/results"): handle_results,
+    ("POST", "/similar"): handle_similar,
+    ("POST", "/rag/candidates"): handle_rag_candidates,
+    ("POST", "/events"): handle_event,
+    ("GET", "/healthz"): lambda body: {"ok": True},
+    # served here, not on METRICS_PORT, so --workers N never race for a port
+    ("GET", "/metrics"): lambda body: REGISTRY.prometheus_text(),
+}
+
+
+def startup() -> None:
+    get_collections()
+    warm_up_once()
+    warm_up_from_env()
+
+
+# ---------------------------------------------------------
+# ASGI
+# ---------------------------------------------------------
+async def _send_json(send, status: int, obj: Any) -> None:
+    body = _dumps(obj)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_text(send, text: str) -> None:
+    body = text.encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/plain; version=0.0.4"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive) -> bytes:
+    chunks, size = [], 0
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        chunk = msg.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise BadRequest("request body too large")
+        chunks.append(chunk)
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            try:
+                await asyncio.get_running_loop().run_in_executor(_EXECUTOR, startup)
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            _BATCH_EXECUTOR.shutdown(wait=False)
+            _EXECUTOR.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await _send_json(send, 404, {"error": f"no route {scope['path']}"})
+        return
+    try:
+        raw = await _read_body(receive)
+        body = json.loads(raw) if raw.strip() else {}
+        if not isinstance(body, dict):
+            raise BadRequest("body: expected a JSON object")
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(_EXECUTOR, handler, body)
+    except ClientDisconnected:
+        return
+    except (BadRequest, json.JSONDecodeError, UnicodeDecodeError) as e:
+        await _send_json(send, 400, {"error": str(e)})
+        return
+    except Exception as e:
+        print(f"[service] {scope['path']} failed: {type(e).__name__}: {e}")
+        await _send_json(send, 500, {"error": f"{type(e).__name__}: {e}"})
+        return
+    if isinstance(result, str):
+        await _send_text(send, result)  # /metrics
+        return
+    await _send_json(send, 200, result)
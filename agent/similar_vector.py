@@ -2,47 +2,91 @@
 from typing import Any, Dict, List
 
 from bson import ObjectId
+from projection import REDUCED_FIELD, VERSION_FIELD, get_projection
 from rec_core import build_match
+from vector_index import (
+    VECTOR_NPROBE,
+    VECTOR_REDUCED,
+    get_local_index,
+    to_vector_score,
+)
+
+CARD_PROJECTION = {
+    "name": 1,
+    "address": 1,
+    "image": 1,
+    "url": 1,
+    "price_yen": 1,
+    "area_sqm": 1,
+    "rooms": 1,
+    "layout_raw": 1,
+    "size": 1,
+    "station_name": 1,
+    "station_walk_minutes": 1,
+    "flags": 1,
+}
 
 
 def similar_items_by_vector(
     PROPS, seed_id: str, filters: Dict[str, Any], index_name="rec_search"
 ) -> List[dict]:
-    seed = PROPS.find_one({"_id": ObjectId(seed_id)}, {"embedding": 1})
-    if not seed or not seed.get("embedding"):
+    local = get_local_index()
+    if local is not None:
+        items = _similar_items_local(PROPS, local, seed_id, filters)
+    else:
+        items = _similar_items_atlas(PROPS, seed_id, filters, index_name)
+    if items is None:
         print(f"No embedding found for seed_id: {seed_id}, using TF-IDF fallback.")
         return []  # caller can fallback to TF-IDF
 
+    for it in items:
+        score = it.get("vector_score", 0.0)
+        it["_reasons"] = [f"似ている物件（ベクトル検索 スコア: {score:.3f}）"]
+    return items[:9]
+
+
+def _similar_items_atlas(PROPS, seed_id, filters, index_name):
+    field = REDUCED_FIELD if VECTOR_REDUCED else "embedding"
+    seed = PROPS.find_one({"_id": ObjectId(seed_id)}, {field: 1, VERSION_FIELD: 1})
+    if not seed or not seed.get(field):
+        return None
+
     match = build_match(filters)  # from your rec_core
+    if VECTOR_REDUCED:
+        # neighbours must be reduced with the seed's projection
+        version = get_projection().version
+        if seed.get(VERSION_FIELD) != version:
+            return None
+        match = {**match, VERSION_FIELD: version}
     pipeline = [
         {
             "$search": {
                 "index": index_name,
-                "knnBeta": {"path": "embedding", "vector": seed["embedding"], "k": 200},
+                "knnBeta": {"path": field, "vector": seed[field], "k": 200},
             }
         },
         {"$match": match if match else {}},
         {"$limit": 20},
-        {
-            "$project": {
-                "name": 1,
-                "address": 1,
-                "image": 1,
-                "url": 1,
-                "price_yen": 1,
-                "area_sqm": 1,
-                "rooms": 1,
-                "layout_raw": 1,
-                "size": 1,
-                "station_name": 1,
-                "station_walk_minutes": 1,
-                "flags": 1,
-                "vector_score": {"$meta": "searchScore"},
-            }
-        },
+        {"$project": {**CARD_PROJECTION, "vector_score": {"$meta": "searchScore"}}},
     ]
-    items = list(PROPS.aggregate(pipeline))
-    for it in items:
-        score = it.get("vector_score", 0.0)
-        it["_reasons"] = [f"似ている物件（ベクトル検索 スコア: {score:.3f}）"]
-    return items[:9]
+    return list(PROPS.aggregate(pipeline))
+
+
+def _similar_items_local(PROPS, index, seed_id, filters):
+    """Same candidates as the Atlas path, ranked in-process; one _id lookup for cards."""
+    seed_vec = index.vector_of(seed_id)
+    if seed_vec is None:
+        return None
+
+    rows, sims = index.search(
+        seed_vec, k=20, mask=index.mask(filters), nprobe=VECTOR_NPROBE
+    )
+    ids = [ObjectId(index.ids[r]) for r in rows]
+    scores = dict(zip(ids, to_vector_score(sims).tolist()))
+    docs = {d["_id"]: d for d in PROPS.find({"_id": {"$in": ids}}, CARD_PROJECTION)}
+    items = []
+    for _id in ids:
+        if _id in docs:
+            docs[_id]["vector_score"] = scores[_id]
+            items.append(docs[_id])
+    return items
@@ -0,0 +1,196 @@
+# tfidf_index.py
+# Precomputed TF-IDF model for the "似た物件" fallback.
+#
+# Layout of an index directory:
+#   vectorizer.joblib  fitted TfidfVectorizer over combined_text
+#   matrix.npz         CSR matrix (n, vocab), rows L2-normalized
+#   ids.npy            ObjectId hex strings, row i <-> matrix[i]
+#   columns.npz        filter columns (see rec_core.columns_from_docs)
+#
+# Build offline:   uv run --env-file .env tfidf_index.py build
+# New listings:    uv run --env-file .env tfidf_index.py update
+# `update` keeps the fitted vocabulary/idf; run `build` again now and then
+# so new terms and document frequencies are picked up.
+from __future__ import annotations
+
+import argparse
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import numpy as np
+from bson import ObjectId
+from rec_core import columns_from_docs, combined_text, match_mask
+
+if TYPE_CHECKING:
+    import scipy.sparse as sp
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+TFIDF_INDEX_DIR = os.getenv("TFIDF_INDEX_DIR", "./tfidf_index")
+
+# fields needed by combined_text + columns_from_docs
+TEXT_PROJECTION = {
+    "_id": 1,
+    "name": 1,
+    "description": 1,
+    "address": 1,
+    "flags": 1,
+    "station_line": 1,
+    "station_name": 1,
+    "price_yen": 1,
+    "station_walk_minutes": 1,
+    "rooms": 1,
+    "area_sqm": 1,
+}
+
+
+class TfidfIndex:
+    def __init__(
+        self,
+        vectorizer: TfidfVectorizer,
+        matrix: sp.csr_matrix,
+        ids: np.ndarray,
+        columns: Dict[str, np.ndarray],
+    ):
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.ids = ids
+        self.columns = columns
+        self.row_of = {oid: i for i, oid in enumerate(ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path: str = TFIDF_INDEX_DIR) -> "TfidfIndex":
+        import joblib
+        import scipy.sparse as sp
+
+        vectorizer = joblib.load(os.path.join(path, "vectorizer.joblib"))
+        matrix = sp.load_npz(os.path.join(path, "matrix.npz")).tocsr()
+        ids = np.load(os.path.join(path, "ids.npy"))
+        with np.load(os.path.join(path, "columns.npz")) as z:
+            columns = {k: z[k] for k in z.files}
+        return cls(vectorizer, matrix, ids, columns)
+
+    def save(self, path: str = TFIDF_INDEX_DIR) -> None:
+        import joblib
+        import scipy.sparse as sp
+
+        os.makedirs(path, exist_ok=True)
+        joblib.dump(self.vectorizer, os.path.join(path, "vectorizer.joblib"))
+        sp.save_npz(os.path.join(path, "matrix.npz"), self.matrix)
+        np.save(os.path.join(path, "ids.npy"), self.ids)
+        np.savez(os.path.join(path, "columns.npz"), **self.columns)
+
+    def similar(
+        self, seed_id: str, filters: Dict[str, Any], k: int = 9
+    ) -> Optional[List[tuple]]:
+        """
+        [(oid, cosine)] of the k most similar filtered rows, best first.
+        None if the seed is not in the index (caller refits on the fly).
+        """
+        seed_row = self.row_of.get(seed_id)
+        if seed_row is None:
+            return None
+        rows = np.flatnonzero(match_mask(self.columns, filters))
+        if not len(rows):
+            return []
+        # one sparse (rows x vocab) @ (vocab x 1) product
+        sims = (self.matrix[rows] @ self.matrix[seed_row].T).toarray().ravel()
+        if len(sims) > k:
+            top = np.argpartition(-sims, k - 1)[:k]
+        else:
+            top = np.arange(len(sims))
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [(str(self.ids[rows[i]]), float(sims[i])) for i in top]
+
+    def append(self, docs: List[Dict[str, Any]]) -> int:
+        """Add unseen listings using the already fitted vocabulary/idf."""
+        docs = [d for d in docs if str(d["_id"]) not in self.row_of]
+        if not docs:
+            return 0
+        import scipy.sparse as sp
+
+        new = self.vectorizer.transform([combined_text(d) for d in docs])
+        self.matrix = sp.vstack([self.matrix, new], format="csr")
+        self.ids = np.concatenate(
+            [self.ids, np.asarray([str(d["_id"]) for d in docs], dtype="U24")]
+        )
+        cols = _storable(columns_from_docs(docs))
+        self.columns = {
+            k: np.concatenate([self.columns[k], cols[k]]) for k in self.columns
+        }
+        self.row_of = {oid: i for i, oid in enumerate(self.ids.tolist())}
+        return len(docs)
+
+
+def _storable(cols: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    # plain unicode arrays so the file loads without pickle
+    return {k: v.astype(str) if v.dtype == object else v for k, v in cols.items()}
+
+
+@lru_cache(maxsize=1)
+def get_tfidf_index() -> Optional[TfidfIndex]:
+    """Loaded once per process; None if no index has been built."""
+    try:
+        return TfidfIndex.load(TFIDF_INDEX_DIR)
+    except FileNotFoundError:
+        print(f"[tfidf_index] no index at {TFIDF_INDEX_DIR}; refitting per request.")
+        return None
+
+
+# ---------------------------------------------------------
+# Offline build / incremental update
+# ---------------------------------------------------------
+def build_tfidf_index(PROPS, path: str = TFIDF_INDEX_DIR) -> TfidfIndex:
+    index = tfidf_index_from_docs(
+        list(PROPS.find({}, TEXT_PROJECTION).batch_size(1000))
+    )
+    index.save(path)
+    return index
+
+
+def tfidf_index_from_docs(docs: List[Dict[str, Any]]) -> TfidfIndex:
+    from bm25_index import char_ngrams
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    texts = [combined_text(d) for d in docs]
+    # same vectorizer settings as the per-request fallback; character
+    # n-grams because the default token pattern barely splits Japanese
+    vectorizer = TfidfVectorizer(analyzer=char_ngrams, min_df=2)
+    matrix = vectorizer.fit_transform(texts).tocsr()
+    ids = np.asarray([str(d["_id"]) for d in docs], dtype="U24")
+    return TfidfIndex(vectorizer, matrix, ids, _storable(columns_from_docs(docs)))
+
+
+def update_tfidf_index(PROPS, path: str = TFIDF_INDEX_DIR) -> int:
+    """Append listings inserted since the newest _id in the index."""
+    index = TfidfIndex.load(path)
+    query = {}
+    if len(index):
+        query = {"_id": {"$gt": max(ObjectId(i) for i in index.ids.tolist())}}
+    added = index.append(list(PROPS.find(query, TEXT_PROJECTION).batch_size(1000)))
+    if added:
+        index.save(path)
+    return added
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build/update the TF-IDF index.")
+    ap.add_argument("command", choices=["build", "update"])
+    ap.add_argument("--out", default=TFIDF_INDEX_DIR)
+    args = ap.parse_args()
+
+    from db import get_collections
+
+    PROPS, _ = get_collections()
+    if args.command == "build":
+        index = build_tfidf_index(PROPS, args.out)
+        print(f"Indexed {len(index)} listings into {args.out}")
+    else:
+        print(f"Added {update_tfidf_index(PROPS, args.out)} listings to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# ttl_cache.py
+# Bounded, thread-safe LRU cache with per-entry TTL and single-flight:
+# concurrent misses on the same key share one computation.
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: BaseException | None = None
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 256, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (t, v)
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _get_locked(self, key: Hashable, now: float, ttl: Optional[float] = None):
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        t, v = entry
+        if now - t >= (self.ttl if ttl is None else min(ttl, self.ttl)):
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, v
+
+    def get(self, key: Hashable):
+        """(hit, value); expired entries count as misses."""
+        with self._lock:
+            hit, v = self._get_locked(key, time.monotonic())
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return hit, v
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(
+        self, key: Hashable, fn: Callable[[], Any], ttl: Optional[float] = None
+    ) -> Any:
+        """
+        Cached value, or fn() computed once for all concurrent callers.
+        `ttl` can only shorten the cache-wide TTL for this lookup.
+        """
+        with self._lock:
+            hit, v = self._get_locked(key, time.monotonic(), ttl)
+            if hit:
+                self.hits += 1
+                return v
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fn()
+            self.set(key, flight.value)
+            return flight.value
+        except BaseException as e:
+            flight.error = e  # errors are shared with waiters, never cached
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "size": len(self._data),
+            }
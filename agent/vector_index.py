@@ -0,0 +1,533 @@
+# vector_index.py
+# In-process vector index over the `embedding` field.
+#
+# Layout of an index directory:
+#   vectors.f32   raw float32 matrix (n, dim), L2-normalized, memory-mapped
+#   vectors.i8    int8 codes (n, dim), see quantize.py, memory-mapped
+#   code_norms.npy  L2 norm of each row of vectors.i8
+#   bits.u8       sign bits (n, dim / 8), packed MSB first, memory-mapped
+#   ids.npy       ObjectId hex strings, row i <-> vectors[i]
+#   columns.npz   filter columns (see rec_core.columns_from_docs)
+#   ivf.npz       optional: centroids + rows grouped by cluster
+#   meta.json     {"n": ..., "dim": ..., "field": ..., "projection": version|null}
+#
+# Build offline:  uv run --env-file .env vector_index.py build [--ivf 256]
+# With --reduced the index holds `embedding_reduced` (see projection.py),
+# fitted beforehand with:  vector_index.py fit-projection --dim 256
+# Then set VECTOR_BACKEND=local (and VECTOR_INDEX_DIR) for the app.
+# VECTOR_QUANTIZATION=int8|binary scans the compact codes and rescores the
+# best VECTOR_RESCORE * k rows with the float vectors.
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from projection import (
+    EMBED_PROJECTION_PATH,
+    REDUCED_FIELD,
+    VERSION_FIELD,
+    get_projection,
+)
+from rec_core import columns_from_docs, match_mask
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "./vector_index")
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "atlas")  # "atlas" | "local"
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE", "8"))  # IVF lists probed per query
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "off")  # "off"|"int8"|"binary"
+VECTOR_RESCORE = int(os.getenv("VECTOR_RESCORE", "4"))  # candidates per result
+# Atlas search on `embedding_reduced` (needs EMBED_PROJECTION_PATH)
+VECTOR_REDUCED = os.getenv("VECTOR_REDUCED", "0") == "1"
+if VECTOR_REDUCED and not EMBED_PROJECTION_PATH:
+    # queries could not be projected; fail at startup, not on every search
+    raise ValueError("VECTOR_REDUCED=1 needs EMBED_PROJECTION_PATH (see projection.py)")
+EMBED_DIM = 768
+# Atlas index definition; its numDimensions must match the fitted projection
+VECTOR_INDEX_JSON = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "vectorIndex.json"
+)
+
+# Same fields as columns_from_docs needs
+COLUMN_PROJECTION = {
+    "price_yen": 1,
+    "station_walk_minutes": 1,
+    "rooms": 1,
+    "area_sqm": 1,
+    "flags": 1,
+    "address": 1,
+    "station_name": 1,
+}
+
+_SEARCH_CHUNK = 65_536  # rows per matmul block in exact search
+# Up to this many queries, int8 codes are scored with integer dot products;
+# larger batches upcast each block once and share a float BLAS matmul
+_INT8_DOT_MAX_QUERIES = 2
+
+
+class LocalVectorIndex:
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        columns: Dict[str, np.ndarray],
+        centroids: Optional[np.ndarray] = None,
+        list_rows: Optional[np.ndarray] = None,
+        list_offsets: Optional[np.ndarray] = None,
+        codes: Optional[np.ndarray] = None,
+        code_norms: Optional[np.ndarray] = None,
+        bits: Optional[np.ndarray] = None,
+        quantization: str = "off",
+        projection: Optional[str] = None,
+    ):
+        self.vectors = vectors
+        # version of the projection the rows were reduced with (None = full)
+        self.projection = projection
+        self.ids = ids
+        self.columns = columns
+        self.row_of = {oid: i for i, oid in enumerate(ids.tolist())}
+        # IVF (clustered) mode
+        self.centroids = centroids
+        self.list_rows = list_rows
+        self.list_offsets = list_offsets
+        # compact codes, scanned before rescoring with `vectors`
+        self.codes = codes
+        self.code_inv_norms = None
+        if code_norms is not None:
+            self.code_inv_norms = (1.0 / np.maximum(code_norms, 1e-9)).astype(
+                np.float32
+            )
+        self.bits = bits
+        if quantization != "off" and not self.has_codes(quantization):
+            print(f"[vector_index] no {quantization} codes; searching float vectors.")
+            quantization = "off"
+        self.quantization = quantization
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def has_ivf(self) -> bool:
+        return self.centroids is not None
+
+    def has_codes(self, quantization: str) -> bool:
+        if quantization == "int8":
+            return self.codes is not None and self.code_inv_norms is not None
+        if quantization == "binary":
+            return self.bits is not None
+        return quantization == "off"
+
+    # ---------- persistence ----------
+    @classmethod
+    def load(
+        cls, path: str = VECTOR_INDEX_DIR, quantization: str = VECTOR_QUANTIZATION
+    ) -> "LocalVectorIndex":
+        with open(os.path.join(path, "meta.json")) as fh:
+            meta = json.load(fh)
+        if meta["n"]:
+            vectors = np.memmap(
+                os.path.join(path, "vectors.f32"),
+                dtype=np.float32,
+                mode="r",
+                shape=(meta["n"], meta["dim"]),
+            )
+        else:  # mmap of an empty file is not allowed
+            vectors = np.zeros((0, meta["dim"]), dtype=np.float32)
+        ids = np.load(os.path.join(path, "ids.npy"))
+        with np.load(os.path.join(path, "columns.npz")) as z:
+            columns = {k: z[k] for k in z.files}
+        ivf = {}
+        ivf_path = os.path.join(path, "ivf.npz")
+        if os.path.exists(ivf_path):
+            with np.load(ivf_path) as z:
+                ivf = dict(
+                    centroids=z["centroids"],
+                    list_rows=z["rows"],
+                    list_offsets=z["offsets"],
+                )
+        return cls(
+            vectors,
+            ids,
+            columns,
+            **ivf,
+            **_load_codes(path, meta),
+            quantization=quantization,
+            projection=meta.get("projection"),
+        )
+
+    def vector_of(self, oid: str) -> Optional[np.ndarray]:
+        row = self.row_of.get(oid)
+        return None if row is None else np.asarray(self.vectors[row])
+
+    # ---------- search ----------
+    def mask(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Row mask with build_match semantics (None = no filtering)."""
+        return match_mask(self.columns, filters) if filters else None
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int = 20,
+        mask: Optional[np.ndarray] = None,
+        nprobe: Optional[int] = None,
+        quantization: Optional[str] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k rows by cosine similarity. Returns (rows, cosine) sorted desc.
+        Exact unless nprobe is given and the index was built with IVF, or a
+        quantization (default: the index's) picks the candidates to rescore.
+        """
+        q = _normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))
+        rows, sims = self.search_many(
+            q, k, mask=mask, nprobe=nprobe, quantization=quantization
+        )
+        return rows[0], sims[0]
+
+    def search_many(
+        self,
+        queries: np.ndarray,
+        k: int = 20,
+        mask: Optional[np.ndarray] = None,
+        nprobe: Optional[int] = None,
+        quantization: Optional[str] = None,
+    ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """Batched version of `search`: one (rows, cosine) pair per query row."""
+        Q = _normalize(np.asarray(queries, dtype=np.float32))
+        quantization = quantization or self.quantization
+        if not self.has_codes(quantization):
+            raise ValueError(f"index has no {quantization} codes")
+        if nprobe and self.has_ivf:
+            return self._search_ivf(Q, k, mask, nprobe, quantization)
+        cand = None if mask is None else np.flatnonzero(mask)
+        return self._topk(Q, k, cand, quantization)
+
+    def _topk(self, Q, k, cand, quantization):
+        if quantization == "off":
+            return _topk_over(self.vectors, Q, k, cand)
+        # scan the compact codes, then rescore the survivors exactly
+        depth = k * max(1, VECTOR_RESCORE)
+        if quantization == "int8":
+            inv = self.code_inv_norms
+            Qc = int8_codes(Q).astype(np.int32)
+
+            def approx(Q, block, rows):
+                if len(Q) > _INT8_DOT_MAX_QUERIES:
+                    return (Q @ block.T.astype(np.float32)) * inv[rows]
+                # the query's own int8 scale is the same for every row
+                dots = [np.einsum("ij,j->i", block, q, dtype=np.int32) for q in Qc]
+                return np.stack(dots) * inv[rows]
+
+            cands, _ = _topk_over(self.codes, Q, depth, cand, approx)
+        else:
+            cands, _ = _topk_over(
+                self.bits, np.packbits(Q > 0, axis=1), depth, cand, _hamming_sims
+            )
+        out_rows, out_sims = [], []
+        for qi, rows in enumerate(cands):
+            r, s = _topk_over(self.vectors, Q[qi : qi + 1], k, np.sort(rows))
+            out_rows.append(r[0])
+            out_sims.append(s[0])
+        return out_rows, out_sims
+
+    def _search_ivf(self, Q, k, mask, nprobe, quantization="off"):
+        out_rows, out_sims = [], []
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(-(Q @ self.centroids.T), axis=1)[:, :nprobe]
+        for qi in range(len(Q)):
+            cand = np.concatenate(
+                [
+                    self.list_rows[self.list_offsets[c] : self.list_offsets[c + 1]]
+                    for c in probes[qi]
+                ]
+            )
+            if mask is not None:
+                cand = cand[mask[cand]]
+            cand.sort()  # sequential reads from the memmap
+            rows, sims = self._topk(Q[qi : qi + 1], k, cand, quantization)
+            out_rows.append(rows[0])
+            out_sims.append(sims[0])
+        return out_rows, out_sims
+
+
+def _normalize(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+def _hamming_sims(Qbits, block, rows):
+    """Negated Hamming distance between packed sign bits (higher = closer)."""
+    return -np.stack(
+        [np.bitwise_count(block ^ q).sum(axis=1, dtype=np.int32) for q in Qbits]
+    )
+
+
+def _topk_over(vectors, Q, k, cand=None, score=None):
+    """
+    Exact top-k of Q @ vectors[cand].T, scanned in blocks; `score(Q, block,
+    rows)` replaces the dot product for compact codes.
+    """
+    nq = len(Q)
+    total = len(vectors) if cand is None else len(cand)
+    best_rows = [np.empty(0, dtype=np.int64) for _ in range(nq)]
+    best_sims = [np.empty(0, dtype=np.float32) for _ in range(nq)]
+    for start in range(0, total, _SEARCH_CHUNK):
+        if cand is None:
+            rows = np.arange(start, min(start + _SEARCH_CHUNK, total))
+            block = np.asarray(vectors[start : start + _SEARCH_CHUNK])
+        else:
+            rows = cand[start : start + _SEARCH_CHUNK]
+            block = np.asarray(vectors[rows])
+        sims = (
+            Q @ block.T if score is None else score(Q, block, rows)
+        )  # (nq, len(rows))
+        for qi in range(nq):
+            r = np.concatenate([best_rows[qi], rows])
+            s = np.concatenate([best_sims[qi], sims[qi]])
+            if len(s) > k:
+                top = np.argpartition(-s, k - 1)[:k]
+                r, s = r[top], s[top]
+            best_rows[qi], best_sims[qi] = r, s
+    for qi in range(nq):
+        order = np.argsort(-best_sims[qi], kind="stable")
+        best_rows[qi] = best_rows[qi][order]
+        best_sims[qi] = best_sims[qi][order]
+    return best_rows, best_sims
+
+
+def int8_codes(m: np.ndarray) -> np.ndarray:
+    """Row-wise quantize.int8_codes."""
+    peak = np.abs(m).max(axis=1, keepdims=True)
+    peak[peak == 0] = 1.0
+    return np.clip(np.rint(m * (127.0 / peak)), -127, 127).astype(np.int8)
+
+
+def _load_codes(path: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact codes of an index directory (absent in indexes built before them)."""
+    out: Dict[str, Any] = {}
+    n, dim = meta["n"], meta["dim"]
+    if os.path.exists(os.path.join(path, "code_norms.npy")):
+        out["code_norms"] = np.load(os.path.join(path, "code_norms.npy"))
+    for key, name, dtype, width in (
+        ("codes", "vectors.i8", np.int8, dim),
+        ("bits", "bits.u8", np.uint8, (dim + 7) // 8),
+    ):
+        f = os.path.join(path, name)
+        if not os.path.exists(f):
+            continue
+        if n:
+            out[key] = np.memmap(f, dtype=dtype, mode="r", shape=(n, width))
+        else:
+            out[key] = np.zeros((0, width), dtype=dtype)
+    return out
+
+
+def to_vector_score(cosine: np.ndarray) -> np.ndarray:
+    # Atlas reports cosine similarity as (1 + cos) / 2; keep the same scale.
+    return (1.0 + cosine) / 2.0
+
+
+@lru_cache(maxsize=1)
+def get_local_index() -> Optional[LocalVectorIndex]:
+    """Process-wide index, or None when the local backend is not enabled/built."""
+    if VECTOR_BACKEND != "local":
+        return None
+    try:
+        index = LocalVectorIndex.load(VECTOR_INDEX_DIR)
+    except FileNotFoundError:
+        print(f"[vector_index] no index at {VECTOR_INDEX_DIR}; using Atlas search.")
+        return None
+    projection = get_projection()
+    if index.projection and (
+        projection is None or projection.version != index.projection
+    ):
+        # queries would be projected differently from the indexed rows
+        print(
+            f"[vector_index] index holds {index.projection} vectors but "
+            f"EMBED_PROJECTION_PATH is {projection and projection.version}; "
+            "using Atlas search."
+        )
+        return None
+    return index
+
+
+# ---------------------------------------------------------
+# Offline build
+# ---------------------------------------------------------
+def build_index(
+    PROPS, path: str = VECTOR_INDEX_DIR, dim: int = EMBED_DIM, reduced: bool = False
+) -> int:
+    """Stream every embedded listing into a fresh index directory."""
+    os.makedirs(path, exist_ok=True)
+    field, version, query = "embedding", None, {"embedding": {"$type": "array"}}
+    if reduced:
+        projection = get_projection()
+        if projection is None:
+            raise ValueError("--reduced needs EMBED_PROJECTION_PATH")
+        field, version, dim = REDUCED_FIELD, projection.version, projection.dim
+        query = {REDUCED_FIELD: {"$type": "array"}, VERSION_FIELD: version}
+    cur = PROPS.find(query, {"_id": 1, field: 1, **COLUMN_PROJECTION}).batch_size(1000)
+
+    ids: List[str] = []
+    docs: List[Dict[str, Any]] = []
+    code_norms: List[np.ndarray] = []
+    files = ("vectors.f32", "vectors.i8", "bits.u8")
+    tmps = [os.path.join(path, f + ".tmp") for f in files]
+    with (
+        open(tmps[0], "wb") as fh,
+        open(tmps[1], "wb") as fc,
+        open(tmps[2], "wb") as fb,
+    ):
+
+        def flush(buf: List[List[float]]) -> None:
+            block = _normalize(np.asarray(buf, dtype=np.float32))
+            fh.write(block.tobytes())
+            codes = int8_codes(block)
+            code_norms.append(np.linalg.norm(codes.astype(np.float32), axis=1))
+            fc.write(codes.tobytes())
+            fb.write(np.packbits(block > 0, axis=1).tobytes())
+
+        buf: List[List[float]] = []
+        for d in cur:
+            emb = d.pop(field)
+            if len(emb) != dim:
+                continue
+            buf.append(emb)
+            ids.append(str(d["_id"]))
+            docs.append(d)
+            if len(buf) >= 4096:
+                flush(buf)
+                buf = []
+        if buf:
+            flush(buf)
+    for f, tmp in zip(files, tmps):
+        os.replace(tmp, os.path.join(path, f))
+    np.save(
+        os.path.join(path, "code_norms.npy"),
+        np.concatenate(code_norms) if code_norms else np.zeros(0, dtype=np.float32),
+    )
+
+    np.save(os.path.join(path, "ids.npy"), np.asarray(ids, dtype="U24"))
+    cols = columns_from_docs(docs)
+    # plain unicode arrays so the file loads without pickle
+    cols = {k: v.astype(str) if v.dtype == object else v for k, v in cols.items()}
+    np.savez(os.path.join(path, "columns.npz"), **cols)
+    # a rebuilt matrix invalidates old clusters
+    if os.path.exists(os.path.join(path, "ivf.npz")):
+        os.remove(os.path.join(path, "ivf.npz"))
+    with open(os.path.join(path, "meta.json"), "w") as fh:
+        json.dump(
+            {"n": len(ids), "dim": dim, "field": field, "projection": version}, fh
+        )
+    return len(ids)
+
+
+def build_ivf(
+    path: str = VECTOR_INDEX_DIR,
+    n_lists: int = 256,
+    iters: int = 10,
+    sample: int = 50_000,
+    seed: int = 0,
+) -> None:
+    """Spherical k-means over the stored vectors; rows are grouped per cluster."""
+    index = LocalVectorIndex.load(path)
+    X = index.vectors
+    n = len(X)
+    n_lists = max(1, min(n_lists, n))
+    rng = np.random.default_rng(seed)
+    train = np.asarray(X[np.sort(rng.choice(n, size=min(sample, n), replace=False))])
+    centroids = train[rng.choice(len(train), size=n_lists, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(train @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = train[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+
+    assign = np.empty(n, dtype=np.int32)
+    for start in range(0, n, _SEARCH_CHUNK):
+        block = np.asarray(X[start : start + _SEARCH_CHUNK])
+        assign[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    rows = np.argsort(assign, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+    np.savez(
+        os.path.join(path, "ivf.npz"), centroids=centroids, rows=rows, offsets=offsets
+    )
+
+
+def fit_projection_from(
+    PROPS, dim: int, kind: str = "pca", sample: int = 50_000, seed: int = 0
+):
+    """Fit a projection on a random sample of the stored full embeddings."""
+    from projection import fit_pca, truncation
+
+    if kind == "truncate":
+        return truncation(EMBED_DIM, dim)
+    cur = PROPS.aggregate(
+        [
+            {"$match": {"embedding": {"$type": "array"}}},
+            {"$sample": {"size": sample}},
+            {"$project": {"_id": 0, "embedding": 1}},
+        ]
+    )
+    X = np.asarray(
+        [d["embedding"] for d in cur if len(d["embedding"]) == EMBED_DIM],
+        dtype=np.float32,
+    )
+    if len(X) < dim:
+        raise ValueError(f"need at least {dim} embeddings to fit, found {len(X)}")
+    return fit_pca(X, dim)
+
+
+def atlas_num_dimensions(field: str, path: str = VECTOR_INDEX_JSON) -> Optional[int]:
+    """numDimensions declared for `field` in the Atlas index definition."""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        fields = json.load(f).get("fields", [])
+    return next(
+        (f.get("numDimensions") for f in fields if f.get("path") == field), None
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build the local vector index.")
+    ap.add_argument("command", choices=["build", "fit-projection"])
+    ap.add_argument("--out", help=f"default: {VECTOR_INDEX_DIR} or ./projections")
+    ap.add_argument("--ivf", type=int, default=0, help="number of IVF lists (0=off)")
+    ap.add_argument("--reduced", action="store_true", help="index embedding_reduced")
+    ap.add_argument("--dim", type=int, default=256, help="fit-projection: target dim")
+    ap.add_argument("--kind", choices=["pca", "truncate"], default="pca")
+    ap.add_argument("--sample", type=int, default=50_000)
+    args = ap.parse_args()
+    if args.command == "fit-projection":
+        declared = atlas_num_dimensions(REDUCED_FIELD)
+        if declared and declared != args.dim:
+            ap.error(
+                f"vectorIndex.json declares {REDUCED_FIELD} with {declared} "
+                f"dimensions; change numDimensions there (and in the Atlas "
+                f"index) before fitting --dim {args.dim}"
+            )
+
+    from db import get_collections
+
+    PROPS, _ = get_collections()
+    if args.command == "fit-projection":
+        projection = fit_projection_from(PROPS, args.dim, args.kind, args.sample)
+        path = projection.save(args.out or "./projections")
+        print(f"Saved {projection.version} to {path}; set EMBED_PROJECTION_PATH={path}")
+        return
+    args.out = args.out or VECTOR_INDEX_DIR
+    n = build_index(PROPS, args.out, reduced=args.reduced)
+    print(f"Indexed {n} embeddings into {args.out}")
+    if args.ivf and n:
+        build_ivf(args.out, n_lists=args.ivf)
+        print(f"Built IVF with {args.ivf} lists")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,52 @@
-import time
-from functools import lru_cache
+import copy
+import os
+
+from parse_cache import BACKEND_ERRORS, cache_key, get_shared_parse_cache
+from rec_core import normalize_query
+from ttl_cache import TTLCache
+
+# Bounded LRU + TTL, keyed on the NFKC/whitespace-normalized query;
+# concurrent identical queries share one Gemini call (single-flight)
+NLU_CACHE = TTLCache(
+    maxsize=int(os.getenv("NLU_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("NLU_CACHE_TTL_SEC", "600")),
+)
+
+
+def _parse_uncached(query: str) -> dict:
+    # shared backend first: other replicas / earlier processes may have it
+    backend = get_shared_parse_cache()
+    key = cache_key(query) if backend is not None else None
+    if backend is not None:
+        try:
+            (v,) = backend.get_many([key])
+            if v is not None:
+                return v
+        except BACKEND_ERRORS as e:
+            print(f"[parse_cache] shared cache unavailable ({e})")
 
-
-# 10 min cache; simplest: LRU of last 256 queries
-@lru_cache(maxsize=256)
-def cached_parse(query: str) -> dict:
     from vertex_nlu import parse_query_to_filters_with_vertex
 
-    return parse_query_to_filters_with_vertex(query)
+    v = parse_query_to_filters_with_vertex(query)
+    # an empty result may be a swallowed API error; don't persist it
+    if backend is not None and v:
+        try:
+            backend.set_many({key: v})
+        except BACKEND_ERRORS as e:
+            print(f"[parse_cache] shared cache unavailable ({e})")
+    return v
 
 
-# optional TTL wrapper
-_CACHE = {}
+def cached_ttl_parse(query: str, ttl_sec=600):
+    key = normalize_query(query)
+    v = NLU_CACHE.get_or_compute(key, lambda: _parse_uncached(key), ttl=ttl_sec)
+    # callers merge sidebar filters into the result; keep the cached copy intact
+    return copy.deepcopy(v)
 
 
-def cached_ttl_parse(query: str, ttl_sec=600):
-    now = time.time()
-    hit = _CACHE.get(query)
-    if hit and now - hit["t"] < ttl_sec:
-        return hit["v"]
-    from vertex_nlu import parse_query_to_filters_with_vertex
+def cached_parse(query: str) -> dict:
+    return cached_ttl_parse(query, ttl_sec=NLU_CACHE.ttl)
 
-    v = parse_query_to_filters_with_vertex(query)
-    _CACHE[query] = {"v": v, "t": now}
-    return v
+
+def parse_cache_stats() -> dict:
+    return NLU_CACHE.stats()
@@ -1,46 +1,59 @@
-import os
+import hashlib
+import json
+from functools import lru_cache
 from typing import Any, Dict
 
-from google import genai
-from google.genai import types
+from clients import LOCATION, PROJECT_ID, lazy_client
+
+
+# ---- Client (Vertex mode), built on first use ----
+@lazy_client("genai")
+def get_client():
+    from google import genai
+
+    return genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
 
-# ---- Client (Vertex mode; uses project/location like your old code) ----
-client = genai.Client(
-    vertexai=True,
-    project=os.environ.get("PROJECT_ID", "dev-projects-476011"),
-    location="asia-northeast1",
-)
 
 # ---- Function declaration & tool (schema equivalent to your original) ----
-extract_filters_fn = types.FunctionDeclaration(
-    name="extract_filters",
-    description="Extract structured real-estate filters from Japanese text.",
-    parameters=types.Schema(
-        type="OBJECT",
-        properties={
-            "budget_max": types.Schema(
-                type="NUMBER",
-                description="Budget upper bound in yen",
-            ),
-            "wards": types.Schema(
-                type="ARRAY",
-                items=types.Schema(type="STRING"),
-            ),
-            "walk_max": types.Schema(type="NUMBER"),
-            "station_name": types.Schema(type="STRING"),
-            "pet_ok": types.Schema(type="BOOLEAN"),
-            "min_rooms": types.Schema(type="NUMBER"),
-            "min_area_sqm": types.Schema(type="NUMBER"),
-            "balcony": types.Schema(type="BOOLEAN"),
-            "south_facing": types.Schema(type="BOOLEAN"),
-            "corner": types.Schema(type="BOOLEAN"),
-            "tower_mansion": types.Schema(type="BOOLEAN"),
-        },
-        additional_properties=False,
-    ),
-)
+# field -> (schema type, description); plain data so PROMPT_VERSION can be
+# computed without importing the SDK
+FILTER_FIELDS = {
+    "budget_max": ("NUMBER", "Budget upper bound in yen"),
+    "wards": ("ARRAY", None),
+    "walk_max": ("NUMBER", None),
+    "station_name": ("STRING", None),
+    "pet_ok": ("BOOLEAN", None),
+    "min_rooms": ("NUMBER", None),
+    "min_area_sqm": ("NUMBER", None),
+    "balcony": ("BOOLEAN", None),
+    "south_facing": ("BOOLEAN", None),
+    "corner": ("BOOLEAN", None),
+    "tower_mansion": ("BOOLEAN", None),
+}
+FUNCTION_DESCRIPTION = "Extract structured real-estate filters from Japanese text."
+
 
-tool = types.Tool(function_declarations=[extract_filters_fn])
+@lru_cache(maxsize=1)
+def get_tool():
+    from google.genai import types
+
+    def field(t, desc):
+        items = types.Schema(type="STRING") if t == "ARRAY" else None
+        return types.Schema(type=t, description=desc, items=items)
+
+    extract_filters_fn = types.FunctionDeclaration(
+        name="extract_filters",
+        description=FUNCTION_DESCRIPTION,
+        parameters=types.Schema(
+            type="OBJECT",
+            properties={k: field(t, d) for k, (t, d) in FILTER_FIELDS.items()},
+            additional_properties=False,
+        ),
+    )
+    return types.Tool(function_declarations=[extract_filters_fn])
+
+
+NLU_MODEL = "gemini-2.5-flash"
 
 SYSTEM = (
     "あなたは日本の不動産検索条件を抽出するアシスタントです。"
@@ -54,18 +67,29 @@ SYSTEM = (
 )
 
 
+# Changes whenever the prompt, schema or model changes; part of the shared
+# parse-cache key so stale parses are never served after a prompt edit.
+PROMPT_VERSION = hashlib.sha256(
+    json.dumps(
+        [NLU_MODEL, SYSTEM, FUNCTION_DESCRIPTION, FILTER_FIELDS], ensure_ascii=False
+    ).encode()
+).hexdigest()[:16]
+
+
 def parse_query_to_filters_with_vertex(query: str) -> Dict[str, Any]:
     """
     Generates a function call to `extract_filters` and returns its arguments as a dict.
     Mirrors the behavior of your previous Vertex SDK code.
     """
     try:
-        resp = client.models.generate_content(
-            model="gemini-2.5-flash",
+        from google.genai import types
+
+        resp = get_client().models.generate_content(
+            model=NLU_MODEL,
             contents=f"クエリ: {query}",
             config=types.GenerateContentConfig(
                 system_instruction=SYSTEM,
-                tools=[tool],  # manual declaration; model returns a function call
+                tools=[get_tool()],  # manual declaration; model returns a function call
                 temperature=0.1,
             ),
         )
@@ -1,12 +1,19 @@
 # embed_batch_genai.py
+import hashlib
 import os
+import queue
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List
-
-import pymongo
-from google import genai
-from google.genai import types
+from functools import lru_cache
+from typing import Dict, List
+
+from embed_cache import get_embed_cache
+from mongo_client import get_client
+from projection import REDUCED_FIELD, VERSION_FIELD, get_projection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from quantize import QUANTIZED_FIELDS, quantized_fields
 from search_text import build_search_text
 
 # ---------------------------
@@ -25,11 +32,37 @@ EMBED_MAX_WORKERS = int(os.getenv("EMBED_MAX_WORKERS", "8"))
 EMBED_TASK_TYPE = os.getenv(
     "EMBED_TASK_TYPE", "RETRIEVAL_DOCUMENT"
 )  # or RETRIEVAL_QUERY
+# Pipeline: batches embedded at once, queue depths (backpressure), write size
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "2"))
+QUEUE_DEPTH = int(os.getenv("EMBED_QUEUE_DEPTH", "4"))
+WRITE_BATCH_SIZE = int(os.getenv("EMBED_WRITE_BATCH_SIZE", "500"))
+STATS_EVERY_SEC = float(os.getenv("EMBED_STATS_EVERY_SEC", "10"))
+# "changed": re-embed docs whose search text or model changed (full
+#            collection scan over the text fields)
+# "quick":   only docs never embedded with this model, or with stale codes
+#            (indexed query)
+EMBED_MODE = os.getenv("EMBED_MODE", "changed")
+# Compact copies written next to `embedding` ("int8", "binary"; "" = none)
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "int8,binary")
+QUANTIZATIONS = [q.strip() for q in EMBED_QUANTIZE.split(",") if q.strip()]
+for _q in QUANTIZATIONS:
+    if _q not in QUANTIZED_FIELDS:
+        raise ValueError(f"EMBED_QUANTIZE: unknown quantization {_q!r}")
+# stored with each embedding so a changed setting marks the doc as stale
+QUANTIZATION_TAG = ",".join(QUANTIZATIONS)
+# Optional reduced-dimension copy (EMBED_PROJECTION_PATH, see projection.py)
+PROJECTION = get_projection()
+
 
 # ---------------------------
-# Client (Vertex routing)
+# Client (Vertex routing), built on the first embedding call so that
+# importing run_pipeline with an injected embed_fn needs no credentials
 # ---------------------------
-client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
+@lru_cache(maxsize=1)
+def get_genai_client():
+    from google import genai
+
+    return genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
 
 
 # ---------------------------
@@ -93,6 +126,9 @@ def _embed_single(text: str, retries: int = 3, backoff: float = 0.7) -> List[flo
     Embed one string. Tries multiple call signatures for broad SDK compatibility.
     Returns [] on failure (keeps position alignment).
     """
+    from google.genai import types
+
+    client = get_genai_client()
     for attempt in range(retries):
         try:
             cfg = types.EmbedContentConfig(task_type=EMBED_TASK_TYPE)
@@ -168,9 +204,30 @@ def _embed_single(text: str, retries: int = 3, backoff: float = 0.7) -> List[flo
 def embed_texts(texts: List[str]) -> List[List[float]]:
     """
     Returns one embedding vector per input text.
+    Texts already in the local embedding cache never reach the API.
+    """
+    cache = get_embed_cache()
+    if cache is None:
+        return _embed_texts_remote(texts)
+
+    out = cache.get_many(EMBED_MODEL, EMBED_TASK_TYPE, texts)
+    miss = [i for i, v in enumerate(out) if v is None]
+    if miss:
+        fresh = _embed_texts_remote([texts[i] for i in miss])
+        cache.put_many(EMBED_MODEL, EMBED_TASK_TYPE, [texts[i] for i in miss], fresh)
+        for i, v in zip(miss, fresh):
+            out[i] = v
+    return out
+
+
+def _embed_texts_remote(texts: List[str]) -> List[List[float]]:
+    """
     - If batch API exists in the installed SDK, use it.
     - Otherwise, do parallel single calls with retries.
     """
+    from google.genai import types
+
+    client = get_genai_client()
     cfg = types.EmbedContentConfig(task_type=EMBED_TASK_TYPE)
 
     # Try batch if available
@@ -212,17 +269,153 @@ def embed_texts(texts: List[str]) -> List[List[float]]:
     return [v if isinstance(v, list) else [] for v in out]
 
 
+def text_hash(text: str) -> str:
+    """Hash of the exact (truncated) text sent to the embedding model."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def is_current(doc: dict, h: str) -> bool:
+    return (
+        doc.get("embedding_text_hash") == h
+        and doc.get("embedding_model") == EMBED_MODEL
+    )
+
+
+def codes_current(doc: dict) -> bool:
+    """Are the codes and reduced vector derived from `embedding` up to date?"""
+    return doc.get("embedding_quantization", "") == QUANTIZATION_TAG and (
+        PROJECTION is None or doc.get(VERSION_FIELD) == PROJECTION.version
+    )
+
+
+def codes_update(vec: List[float]) -> dict:
+    """Update that rebuilds the compact copies of a stored embedding."""
+    update = {
+        "$set": {
+            **quantized_fields(vec, QUANTIZATIONS),
+            "embedding_quantization": QUANTIZATION_TAG,
+        }
+    }
+    if PROJECTION is not None:
+        update["$set"][REDUCED_FIELD] = PROJECTION.apply(vec).tolist()
+        update["$set"][VERSION_FIELD] = PROJECTION.version
+    # codes of a quantization that was switched off would go stale
+    dropped = [f for q, f in QUANTIZED_FIELDS.items() if q not in QUANTIZATIONS]
+    if dropped:
+        update["$unset"] = {f: "" for f in dropped}
+    return update
+
+
+def embedding_update(vec: List[float], h: str) -> dict:
+    update = codes_update(vec)
+    update["$set"].update(
+        {"embedding": vec, "embedding_text_hash": h, "embedding_model": EMBED_MODEL}
+    )
+    return update
+
+
+# ---------------------------
+# Pipeline stats
+# ---------------------------
+class StageStats:
+    """Thread-safe per-stage counters: calls, docs and busy time."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.docs = 0
+        self.busy = 0.0
+        self.errors = 0
+        self.latencies: List[float] = []
+        self._lock = threading.Lock()
+
+    def add(self, docs: int, seconds: float, errors: int = 0):
+        with self._lock:
+            self.calls += 1
+            self.docs += docs
+            self.errors += errors
+            self.busy += seconds
+            self.latencies.append(seconds)
+
+    def summary(self, elapsed: float) -> str:
+        with self._lock:
+            lat = sorted(self.latencies)
+            calls, docs, errors = self.calls, self.docs, self.errors
+        if not calls:
+            return f"{self.name}: idle"
+        p50 = lat[len(lat) // 2]
+        p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+        return (
+            f"{self.name}: {docs} docs, {docs / max(elapsed, 1e-9):.1f} docs/s, "
+            f"{calls} calls, latency p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms"
+            + (f", {errors} errors" if errors else "")
+        )
+
+
 # ---------------------------
 # Main ETL
 # ---------------------------
-def main():
-    mongo = pymongo.MongoClient(MONGO_URI)
-    col = mongo[DB_NAME][COLL]
+# reader -> [embed_q] -> N embedders -> [write_q] -> writer
+# Bounded queues keep the cursor from running ahead of the embedding API and
+# the API from running ahead of MongoDB.
+_DONE = object()
+
 
+def main():
+    # tuned pool / compression / timeouts; reads stay on the primary because
+    # the same collection is written back
+    col = get_client()[DB_NAME][COLL]
+
+    # Selection of stale embeddings; text hash and model are stored next to
+    # each embedding, so one index answers "never embedded with this model".
+    col.create_index(
+        [("embedding_model", 1), ("embedding_text_hash", 1)],
+        name="embedding_model_text_hash",
+    )
+    # Every $or branch needs an index of its own, or the whole query scans
+    # the collection; these serve the recode branches below.
+    col.create_index([("embedding_quantization", 1)], name="embedding_quantization")
+    if PROJECTION is not None:
+        col.create_index([(VERSION_FIELD, 1)], name=VERSION_FIELD)
+    if EMBED_MODE == "quick":
+        query = {
+            "$or": [
+                # same docs as {"embedding_text_hash": None}, but on the
+                # index prefix
+                {"embedding_model": EMBED_MODEL, "embedding_text_hash": None},
+                {"embedding_model": {"$ne": EMBED_MODEL}},
+                {"embedding_quantization": {"$ne": QUANTIZATION_TAG}},
+            ]
+        }
+        if PROJECTION is not None:
+            query["$or"].append({VERSION_FIELD: {"$ne": PROJECTION.version}})
+    else:
+        # MQL cannot hash text, so text changes are found client-side over a
+        # projection that leaves the stored vectors on the server.
+        query = {}
+
+    stats = run_pipeline(col, query)
+    if stats["embed"].errors:
+        print(
+            f"{stats['embed'].errors} documents failed to embed; "
+            "they will be retried next run."
+        )
+
+
+def run_pipeline(col, query: dict, embed_fn=embed_texts) -> Dict[str, StageStats]:
+    """
+    Re-embed the stale docs `query` selects; returns per-stage stats.
+    Docs whose text and model are current but whose codes or reduced vector
+    are stale are recoded from their stored embedding, without embed_fn.
+    """
     cur = col.find(
-        {"$or": [{"embedding": {"$exists": False}}, {"embedding": None}]},
+        query,
         {
             "_id": 1,
+            "embedding_text_hash": 1,
+            "embedding_model": 1,
+            "embedding_quantization": 1,
+            VERSION_FIELD: 1,
             "name": 1,
             "description": 1,
             "category": 1,
@@ -235,28 +428,168 @@ def main():
         },
     ).batch_size(200)
 
-    batch_ids, batch_txts = [], []
-
-    def flush_batch():
-        nonlocal batch_ids, batch_txts
-        if not batch_txts:
-            print("No texts to embed in this batch.")
-            return
-        print(f"Embedding batch of {len(batch_txts)} items...")
-        vecs = embed_texts(batch_txts)
-        for _id, v in zip(batch_ids, vecs):
-            if v:  # only update if embedding succeeded
-                col.update_one({"_id": _id}, {"$set": {"embedding": v}})
-        batch_ids, batch_txts = [], []
-
-    for d in cur:
-        batch_ids.append(d["_id"])
-        # Safety truncation (avoid overlong inputs)
-        batch_txts.append(build_search_text(d)[:7000])
-        if len(batch_txts) >= BATCH_SIZE:
-            flush_batch()
-
-    flush_batch()
+    embed_q: queue.Queue = queue.Queue(maxsize=QUEUE_DEPTH)
+    write_q: queue.Queue = queue.Queue(maxsize=QUEUE_DEPTH * EMBED_CONCURRENCY)
+    read_stats = StageStats("read")
+    embed_stats = StageStats("embed")
+    write_stats = StageStats("write")
+    recode_stats = StageStats("recode")
+
+    # First stage error. Sentinels are always sent (finally) and downstream
+    # stages keep draining after a failure, so no thread blocks on a queue;
+    # run_pipeline re-raises the error once every stage has stopped.
+    failures: List[BaseException] = []
+    failed = threading.Event()
+
+    def fail(stage: str, e: BaseException) -> None:
+        if not failed.is_set():
+            failures.append(e)
+            failed.set()
+        print(f"[{stage}] failed: {type(e).__name__}: {e}")
+
+    def recode(ids: list) -> None:
+        # the reader's projection leaves the vectors on the server
+        t0 = time.perf_counter()
+        ops = [
+            UpdateOne({"_id": d["_id"]}, codes_update(d["embedding"]))
+            for d in col.find({"_id": {"$in": ids}}, {"_id": 1, "embedding": 1})
+            if d.get("embedding")
+        ]
+        recode_stats.add(len(ids), time.perf_counter() - t0, len(ids) - len(ops))
+        if ops:
+            write_q.put(ops)
+
+    def reader():
+        try:
+            batch_ids, batch_txts, batch_hashes = [], [], []
+            recode_ids = []
+            t0 = time.perf_counter()
+            for d in cur:
+                if failed.is_set():
+                    return
+                # Safety truncation (avoid overlong inputs)
+                txt = build_search_text(d)[:7000]
+                h = text_hash(txt)
+                if is_current(d, h):
+                    if not codes_current(d):
+                        recode_ids.append(d["_id"])
+                        if len(recode_ids) >= WRITE_BATCH_SIZE:
+                            recode(recode_ids)
+                            recode_ids = []
+                    continue
+                batch_ids.append(d["_id"])
+                batch_txts.append(txt)
+                batch_hashes.append(h)
+                if len(batch_txts) >= BATCH_SIZE:
+                    read_stats.add(len(batch_ids), time.perf_counter() - t0)
+                    embed_q.put((batch_ids, batch_txts, batch_hashes))
+                    batch_ids, batch_txts, batch_hashes = [], [], []
+                    t0 = time.perf_counter()
+            if batch_txts:
+                read_stats.add(len(batch_ids), time.perf_counter() - t0)
+                embed_q.put((batch_ids, batch_txts, batch_hashes))
+            if recode_ids:
+                recode(recode_ids)
+        except BaseException as e:
+            fail("reader", e)
+        finally:
+            for _ in range(EMBED_CONCURRENCY):
+                embed_q.put(_DONE)
+
+    def embedder():
+        try:
+            while (item := embed_q.get()) is not _DONE:
+                if failed.is_set():
+                    continue  # drain so the reader never blocks
+                try:
+                    batch_ids, batch_txts, batch_hashes = item
+                    t0 = time.perf_counter()
+                    vecs = embed_fn(batch_txts)
+                    ops = [
+                        UpdateOne({"_id": _id}, embedding_update(v, h))
+                        for _id, v, h in zip(batch_ids, vecs, batch_hashes)
+                        if v  # only update if embedding succeeded
+                    ]
+                    embed_stats.add(
+                        len(batch_txts),
+                        time.perf_counter() - t0,
+                        len(batch_ids) - len(ops),
+                    )
+                    if ops:
+                        write_q.put(ops)
+                except BaseException as e:
+                    fail("embedder", e)
+        finally:
+            write_q.put(_DONE)
+
+    def writer():
+        pending: List[UpdateOne] = []
+        remaining = EMBED_CONCURRENCY
+
+        def flush():
+            nonlocal pending
+            t0 = time.perf_counter()
+            errors = 0
+            try:
+                col.bulk_write(pending, ordered=False)
+            except BulkWriteError as e:
+                errors = len(e.details.get("writeErrors", []))
+                print(f"[writer] {errors} write errors")
+            finally:
+                write_stats.add(len(pending), time.perf_counter() - t0, errors)
+                pending = []
+
+        while remaining:
+            ops = write_q.get()
+            if ops is _DONE:
+                remaining -= 1
+                continue
+            if failed.is_set():
+                continue  # drain so the embedders never block
+            pending.extend(ops)
+            if len(pending) >= WRITE_BATCH_SIZE:
+                try:
+                    flush()
+                except BaseException as e:
+                    fail("writer", e)
+        if pending and not failed.is_set():
+            try:
+                flush()
+            except BaseException as e:
+                fail("writer", e)
+
+    threads = [threading.Thread(target=reader, name="reader")]
+    threads += [
+        threading.Thread(target=embedder, name=f"embedder-{i}")
+        for i in range(EMBED_CONCURRENCY)
+    ]
+    threads.append(threading.Thread(target=writer, name="writer"))
+
+    started = time.perf_counter()
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    def report():
+        elapsed = time.perf_counter() - started
+        for st in (read_stats, recode_stats, embed_stats, write_stats):
+            print(f"[stats] {st.summary(elapsed)}")
+        print(f"[stats] queues: embed={embed_q.qsize()} write={write_q.qsize()}")
+
+    while any(t.is_alive() for t in threads):
+        threads[-1].join(timeout=STATS_EVERY_SEC)
+        if threads[-1].is_alive():
+            report()
+
+    report()
+    if failures:
+        raise failures[0]
+    return {
+        "read": read_stats,
+        "recode": recode_stats,
+        "embed": embed_stats,
+        "write": write_stats,
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+# embed_cache.py
+# Disk-backed cache: (model, task_type, sha256(text)) -> float32 vector.
+#
+# Kept identical to agent/embed_cache.py: the agent and the ETL are built as
+# separate images and share the cache through the SQLite file itself when
+# EMBED_CACHE_PATH points at a common volume. WAL mode lets several
+# processes read and write it concurrently.
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", ".embed_cache.sqlite3")
+EMBED_CACHE_MAX_MB = float(os.getenv("EMBED_CACHE_MAX_MB", "512"))
+
+_SQL_CHUNK = 500  # keys per IN (...) lookup; below SQLite's variable limit
+_EVICT_EVERY = 1000  # puts between size checks
+# last_used is only rewritten once it is this old, so a hit stays a read and
+# does not queue behind the other process's writes; LRU order is this coarse
+_TOUCH_AFTER_SEC = 3600.0
+
+
+def _text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self, path: str = EMBED_CACHE_PATH, max_mb: float = EMBED_CACHE_MAX_MB
+    ):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._local = threading.local()
+        self._puts = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL, task_type TEXT NOT NULL,"
+                " text_hash BLOB NOT NULL, vec BLOB NOT NULL,"
+                " last_used REAL NOT NULL,"
+                " PRIMARY KEY (model, task_type, text_hash)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used"
+                " ON embeddings (last_used)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread; the ETL embeds from several threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(
+        self, model: str, task_type: str, texts: Sequence[str]
+    ) -> List[Optional[List[float]]]:
+        """One entry per text: the cached vector or None."""
+        hashes = [_text_hash(t) for t in texts]
+        found = {}
+        stale: List[bytes] = []
+        now = time.time()
+        conn = self._conn()
+        for i in range(0, len(hashes), _SQL_CHUNK):
+            chunk = hashes[i : i + _SQL_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                "SELECT text_hash, vec, last_used FROM embeddings"
+                f" WHERE model = ? AND task_type = ? AND text_hash IN ({marks})",
+                (model, task_type, *chunk),
+            ).fetchall()
+            found.update((h, vec) for h, vec, _ in rows)
+            stale.extend(h for h, _, used in rows if used < now - _TOUCH_AFTER_SEC)
+        if stale:
+            with conn:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ?"
+                    " WHERE model = ? AND task_type = ? AND text_hash = ?",
+                    [(now, model, task_type, h) for h in stale],
+                )
+        out: List[Optional[List[float]]] = []
+        for h in hashes:
+            blob = found.get(h)
+            out.append(array("f", blob).tolist() if blob is not None else None)
+        with self._lock:
+            hit = sum(v is not None for v in out)
+            self.hits += hit
+            self.misses += len(out) - hit
+        return out
+
+    def put_many(
+        self,
+        model: str,
+        task_type: str,
+        texts: Sequence[str],
+        vecs: Sequence[Sequence[float]],
+    ) -> None:
+        now = time.time()
+        rows = [
+            (model, task_type, _text_hash(t), array("f", v).tobytes(), now)
+            for t, v in zip(texts, vecs)
+            if v
+        ]
+        if not rows:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings"
+                " (model, task_type, text_hash, vec, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        with self._lock:
+            self._puts += len(rows)
+            check = self._puts >= _EVICT_EVERY
+            if check:
+                self._puts = 0
+        if check:
+            self.evict()
+
+    def size_bytes(self) -> int:
+        conn = self._conn()
+        (size,) = conn.execute(
+            "SELECT COALESCE(SUM(length(vec)), 0) FROM embeddings"
+        ).fetchone()
+        return int(size)
+
+    def evict(self) -> int:
+        """Drop least recently used vectors until the cache is under 90% of max."""
+        size = self.size_bytes()
+        if size <= self.max_bytes:
+            return 0
+        conn = self._conn()
+        (count,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        avg = size / max(count, 1)
+        drop = int((size - 0.9 * self.max_bytes) / avg) + 1
+        with conn:
+            conn.execute(
+                "DELETE FROM embeddings WHERE (model, task_type, text_hash) IN ("
+                " SELECT model, task_type, text_hash FROM embeddings"
+                " ORDER BY last_used LIMIT ?)",
+                (drop,),
+            )
+        return drop
+
+
+@lru_cache(maxsize=1)
+def get_embed_cache() -> Optional[EmbeddingCache]:
+    """Process-wide cache; None when EMBED_CACHE_PATH is set to an empty string."""
+    if not EMBED_CACHE_PATH:
+        return None
+    return EmbeddingCache()
@@ -0,0 +1,104 @@
+# mongo_client.py
+# One tuned MongoClient per process, shared by the agent and the embedding ETL.
+#
+# Kept identical to agent/mongo_client.py: the two are built as separate
+# images, so each ships its own copy.
+#
+#   MONGO_MAX_POOL_SIZE=50              connections per server
+#   MONGO_MIN_POOL_SIZE=0
+#   MONGO_MAX_IDLE_MS=300000            close pooled connections idle this long
+#   MONGO_COMPRESSORS=zstd,snappy,zlib  wire compression, in preference order;
+#                                       ones whose library is missing are skipped
+#   MONGO_ZLIB_LEVEL=1
+#   MONGO_SERVER_SELECTION_TIMEOUT_MS=5000
+#   MONGO_CONNECT_TIMEOUT_MS=5000
+#   MONGO_SOCKET_TIMEOUT_MS=60000       0 = no timeout
+#   MONGO_READ_PREFERENCE=secondaryPreferred   for read_only() collections
+#   MONGO_MAX_STALENESS_SEC=-1          >= 90 to bound secondary lag
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import pymongo
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+
+MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", "300000"))
+COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib")
+ZLIB_LEVEL = int(os.getenv("MONGO_ZLIB_LEVEL", "1"))
+SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")
+)
+CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "60000"))
+READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "secondaryPreferred")
+MAX_STALENESS_SEC = int(os.getenv("MONGO_MAX_STALENESS_SEC", "-1"))
+
+
+def available_compressors(names: str) -> List[str]:
+    """Keep the compressors pymongo can actually use (no warning per client)."""
+    from pymongo import compression_support as cs
+
+    have = {
+        "zstd": getattr(cs, "_have_zstd", None),
+        "snappy": getattr(cs, "_have_snappy", None),
+        "zlib": getattr(cs, "_have_zlib", None),
+    }
+    out = []
+    for name in (n.strip() for n in names.split(",")):
+        check = have.get(name)
+        if name and (check is None or check()):
+            out.append(name)
+    return out
+
+
+def client_kwargs(compressors: Optional[str] = None, **overrides) -> Dict[str, Any]:
+    """MongoClient options from the environment; overrides win."""
+    kw: Dict[str, Any] = {
+        "maxPoolSize": MAX_POOL_SIZE,
+        "minPoolSize": MIN_POOL_SIZE,
+        "maxIdleTimeMS": MAX_IDLE_MS,
+        "serverSelectionTimeoutMS": SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": SOCKET_TIMEOUT_MS or None,
+        "appname": os.getenv("MONGO_APPNAME", "realestate"),
+    }
+    comp = available_compressors(COMPRESSORS if compressors is None else compressors)
+    if comp:
+        kw["compressors"] = ",".join(comp)
+        if "zlib" in comp:
+            kw["zlibCompressionLevel"] = ZLIB_LEVEL
+    kw.update(overrides)
+    return kw
+
+
+def build_client(uri: Optional[str] = None, **kwargs) -> pymongo.MongoClient:
+    """A new client with the tuned options (benchmarks, one-off scripts)."""
+    return pymongo.MongoClient(
+        uri or os.environ["MONGO_URI"], **client_kwargs(**kwargs)
+    )
+
+
+@lru_cache(maxsize=1)
+def get_client() -> pymongo.MongoClient:
+    """Process-wide client; pooling makes one per process enough."""
+    kw = client_kwargs()
+    print(
+        f"[mongo] pool={MAX_POOL_SIZE} compressors={kw.get('compressors', 'none')} "
+        f"reads={READ_PREFERENCE}"
+    )
+    return pymongo.MongoClient(os.environ["MONGO_URI"], **kw)
+
+
+def read_preference():
+    mode = read_pref_mode_from_name(READ_PREFERENCE)
+    return make_read_preference(mode, None, MAX_STALENESS_SEC)
+
+
+def read_only(collection):
+    """
+    The collection with MONGO_READ_PREFERENCE applied, for queries that can
+    tolerate replication lag (search, similar items, snapshots).
+    """
+    return collection.with_options(read_preference=read_preference())
@@ -0,0 +1,48 @@
+# quantize.py
+# Compact codes stored next to each float `embedding`:
+#
+#   embedding_int8  int8 codes: x * 127 / max|x|, rounded   (BSON int8 vector)
+#   embedding_bits  one bit per dimension (x > 0), MSB first (BSON packed-bit vector)
+#
+# Cosine similarity ignores the per-vector scale, so neither needs a side
+# table. Search scans a compact form and rescores the best candidates with
+# the float vector (see agent/vector_index.py).
+#
+# Kept identical to agent/quantize.py: the ETL writes the codes and the agent
+# quantizes queries the same way.
+from typing import Dict, List, Sequence
+
+from bson.binary import Binary, BinaryVectorDtype
+
+QUANTIZED_FIELDS = {"int8": "embedding_int8", "binary": "embedding_bits"}
+
+
+def int8_codes(vec: Sequence[float]) -> List[int]:
+    peak = max((abs(x) for x in vec), default=0.0)
+    if not peak:
+        return [0] * len(vec)
+    scale = 127.0 / peak
+    return [max(-127, min(127, round(x * scale))) for x in vec]
+
+
+def packed_bits(vec: Sequence[float]) -> bytes:
+    out = bytearray((len(vec) + 7) // 8)
+    for i, x in enumerate(vec):
+        if x > 0:
+            out[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(out)
+
+
+def to_bson_vector(vec: Sequence[float], quantization: str) -> Binary:
+    if quantization == "int8":
+        return Binary.from_vector(int8_codes(vec), BinaryVectorDtype.INT8)
+    if quantization == "binary":
+        return Binary.from_vector(list(packed_bits(vec)), BinaryVectorDtype.PACKED_BIT)
+    raise ValueError(f"unknown quantization: {quantization!r}")
+
+
+def quantized_fields(
+    vec: Sequence[float], quantizations: Sequence[str]
+) -> Dict[str, Binary]:
+    """{"embedding_int8": ..., "embedding_bits": ...} for the given kinds."""
+    return {QUANTIZED_FIELDS[q]: to_bson_vector(vec, q) for q in quantizations}